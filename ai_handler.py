@@ -4,52 +4,48 @@
 نسخه نهایی با لاگ‌گیری حرفه‌ای، دیباگ دقیق، مدیریت خطا و استریم
 """
 
-import httpx
-import json
 import logging
 import asyncio
 import time
 from datetime import datetime
-from pathlib import Path
 
-# تنظیم مسیر فایل لاگ
-LOG_FILE = Path("peak_ai.log")
+from ai_scheduler import AdmissionTicket, AIScheduler, QueueFullError, get_ai_scheduler, traffic_high_text
+from context_builder import ContextBuilder, get_context_builder
+from http_client import SharedHTTPClient
+from log_setup import new_request_id
+from model_router import ModelRouter, get_model_router
+from openrouter_stream import CHAT_COMPLETIONS_URL, OpenRouterChat
+from response_cache import CACHEABLE_TASKS, ResponseCache, make_cache_key, replay_stream
+from singleflight import get_single_flight
 
-# تنظیم لاگر
+# هندلرها در log_setup.setup_logging() و فقط در نقطه شروع برنامه اضافه می‌شوند
 logger = logging.getLogger("PeakAI")
-logger.setLevel(logging.DEBUG)
-
-# فرمت لاگ با میلی‌ثانیه
-formatter = logging.Formatter(
-    "[%(asctime)s.%(msecs)03d] [%(levelname)s] [%(funcName)s:%(lineno)d] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-
-# Handler فایل (همه سطوح)
-file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
-file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(formatter)
-
-# Handler کنسول (INFO و بالاتر)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(formatter)
-
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
-logger.propagate = False
-
-logger.info("لاگ‌گیری PeakAI شروع شد → فایل: %s", LOG_FILE.absolute())
 
 
 class PeakAI:
-    def __init__(self, api_key: str, model: str = "stepfun/step-3.5-flash:free"):
+    def __init__(self, api_key: str, model: str = "stepfun/step-3.5-flash:free",
+                 http_client: SharedHTTPClient | None = None, cache: ResponseCache | None = None,
+                 coalesce: bool = True, scheduler: AIScheduler | None = None,
+                 router: ModelRouter | None = None, context_builder: ContextBuilder | None = None):
         """
         مقداردهی اولیه کلاس
+        cache: کش اختیاری پاسخ‌ها (مثلاً response_cache.load_response_cache())
+        coalesce: درخواست‌های هم‌زمان یکسان به یک استریم upstream متصل شوند
+        scheduler: زمان‌بند اولویت‌دار درخواست‌ها (پیش‌فرض: زمان‌بند مشترک پروسه)
+        router: زنجیره مدل‌های جایگزین و تلاش مجدد (پیش‌فرض: مسیریاب مشترک پروسه)
+        context_builder: سازنده زمینه گفتگوهای چندنوبتی (پیش‌فرض: سازنده مشترک پروسه)
         """
         self.api_key = api_key.strip()
         self.model = model.strip()
-        self.base_url = "https://openrouter.ai/api/v1/chat/completions"
+        self.base_url = CHAT_COMPLETIONS_URL
+        # موتور مشترک استریم (کلاینت HTTP مشترک + پارسر تدریجی SSE)
+        self.engine = OpenRouterChat(self.api_key, "PeakTube AI Bot", logger, http_client, self.base_url,
+                                     router or get_model_router())
+        self.http = self.engine.http
+        self.cache = cache
+        self.single_flight = get_single_flight() if coalesce else None
+        self.scheduler = scheduler or get_ai_scheduler()
+        self._context_builder = context_builder
 
         self.system_prompt = (
             "شما PeakAI هستید، دستیار رسمی و هوشمند ربات PeakTube. "
@@ -66,40 +62,20 @@ class PeakAI:
 
     async def check_health(self) -> bool:
         """بررسی وضعیت اتصال به OpenRouter"""
-        start = time.perf_counter()
-        logger.debug("شروع بررسی سلامت API")
+        return await self.engine.check_health()
 
-        try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                resp = await client.get(
-                    "https://openrouter.ai/api/v1/models",
-                    headers={"Authorization": f"Bearer {self.api_key}"}
-                )
-
-                elapsed = time.perf_counter() - start
-                logger.info("بررسی سلامت → کد: %d | زمان: %.3f ثانیه", resp.status_code, elapsed)
-
-                if resp.status_code == 200:
-                    logger.debug("اتصال برقرار است")
-                    return True
-                else:
-                    logger.warning("بررسی سلامت ناموفق → کد: %d | پاسخ: %s", resp.status_code, resp.text[:300])
-                    return False
-
-        except httpx.RequestError as e:
-            logger.error("خطای شبکه در health check: %s", str(e))
-            return False
-        except Exception as e:
-            logger.exception("خطای غیرمنتظره در health check")
-            return False
-
-    async def generate_response(self, user_message: str, task_type: str = "summarize"):
+    @property
+    def context_builder(self) -> ContextBuilder:
+        if self._context_builder is None:
+            self._context_builder = get_context_builder()
+        return self._context_builder
+
+    def build_messages(self, user_message: str, task_type: str = "summarize",
+                       user_id: int | None = None, conversation_id: str | None = None) -> list:
         """
-        تولید پاسخ استریم‌شده - فقط yield مجاز است
+        ساخت پیام‌های درخواست (system + user) بر اساس نوع وظیفه
+        با conversation_id، نوبت‌های اخیر گفتگو در سقف بودجه توکن و خلاصه نوبت‌های قدیمی‌تر اضافه می‌شوند
         """
-        start_time = time.perf_counter()
-        logger.info("درخواست جدید | وظیفه: %s | طول پیام: %d کاراکتر", task_type, len(user_message))
-
         task_prompts = {
             "summarize": "لطفاً محتوای ویدیو یوتیوب را به صورت خلاصه، رسمی و کتابی خلاصه کنید. فقط خلاصه ارائه دهید.",
             "search": "لطفاً ویدیوها یا محتوای مرتبط با سؤال کاربر در یوتیوب را جستجو و پیشنهاد کنید. پیشنهادها را به صورت لیست مرتب ارائه دهید.",
@@ -107,93 +83,89 @@ class PeakAI:
         }
         task_prompt = task_prompts.get(task_type, "")
 
-        messages = [
+        if conversation_id and user_id is not None:
+            return self.context_builder.build(
+                user_id, conversation_id, self.system_prompt + " " + task_prompt, user_message
+            )
+
+        return [
             {"role": "system", "content": self.system_prompt + " " + task_prompt},
             {"role": "user", "content": user_message}
         ]
 
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://t.me/PeakTubeBot",
-            "X-Title": "PeakTube AI Bot",
-        }
-
-        safe_headers = {k: v if k != "Authorization" else f"Bearer {v[:6]}***" for k, v in headers.items()}
-        logger.debug("ارسال درخواست → URL: %s | مدل: %s | هدرها: %s", self.base_url, self.model, safe_headers)
+    async def stream_events(self, user_message: str, task_type: str = "summarize",
+                            user_id: int | None = None, conversation_id: str | None = None):
+        """استریم نوع‌دار (content / finish / usage / error / done) برای دسترسی به آمار توکن و تأخیر"""
+        logger.info("درخواست جدید | وظیفه: %s | طول پیام: %d کاراکتر", task_type, len(user_message))
+        messages = self.build_messages(user_message, task_type, user_id, conversation_id)
+        async for event in self.engine.events(self.model, messages):
+            yield event
 
+    async def generate_response(self, user_message: str, task_type: str = "summarize",
+                                plan: str | None = None, lang: str = "fa",
+                                user_id: int | None = None, conversation_id: str | None = None):
+        """
+        تولید پاسخ استریم‌شده - فقط yield مجاز است
+        plan: پلن کاربر برای اولویت در صف (professional > premium > free)
+        lang: زبان پیام ترافیک بالا در صورت حذف بار
+        user_id + conversation_id: پاسخ چندنوبتی با زمینه گفتگو (بدون کش و یکی‌سازی)
+        """
+        start_time = time.perf_counter()
+        new_request_id()
+        logger.info("درخواست جدید | وظیفه: %s | طول پیام: %d کاراکتر", task_type, len(user_message),
+                    extra={"task": task_type})
+
+        # پاسخ وابسته به تاریخچه گفتگو قابل اشتراک بین کاربران نیست
+        with_context = bool(conversation_id) and user_id is not None
+        cache_key = None
+        if task_type in CACHEABLE_TASKS and not with_context:
+            cache_key = make_cache_key(self.model, task_type, user_message)
+
+        if self.cache is not None and cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.info("پاسخ از کش | وظیفه: %s | طول: %d کاراکتر", task_type, len(cached))
+                async for chunk in replay_stream(cached):
+                    yield chunk
+                return
+
+        def store_in_cache(event):
+            if self.cache is not None and cache_key is not None:
+                self.cache.put(cache_key, event.content)
+
+        messages = self.build_messages(user_message, task_type, user_id, conversation_id)
+
+        ticket = AdmissionTicket(plan)
+
+        def upstream():
+            return self.scheduler.run_admitted(
+                lambda: self.engine.stream_text(self.model, messages, on_done=store_in_cache),
+                ticket=ticket
+            )
+
+        # درخواست‌های یکسان هم‌زمان (مثلاً خلاصه یک ویدیوی پربازدید) یک درخواست upstream مشترک دارند
+        # درخواست مشترک در صف با اولویت بالاترین پلن بین متصل‌شده‌ها منتظر می‌ماند
+        if self.single_flight is not None and cache_key is not None:
+            source = self.single_flight.stream(
+                cache_key, upstream, context=ticket,
+                on_join=lambda leader: self.scheduler.promote(leader, plan)
+            )
+        else:
+            source = upstream()
+
+        chars = 0
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(
-                    self.base_url,
-                    headers=headers,
-                    json={
-                        "model": self.model,
-                        "messages": messages,
-                        "stream": True,
-                    }
-                )
-
-                elapsed_initial = time.perf_counter() - start_time
-                logger.info("پاسخ اولیه دریافت شد → کد: %d | زمان تا پاسخ اول: %.3f ثانیه",
-                            response.status_code, elapsed_initial)
-
-                if response.status_code != 200:
-                    error_body = await response.aread()
-                    error_text = error_body.decode(errors="replace")
-                    error_msg = f"خطا {response.status_code}: {error_text[:300]}"
-                    logger.error("خطای HTTP → کد: %d | بدنه پاسخ: %s", response.status_code, error_text[:1000])
-                    yield error_msg
-                    return
-
-                full_text = ""
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
-                        if line.strip() == "data: [DONE]":
-                            break
-                        try:
-                            data = json.loads(line[6:].strip())
-                            delta = data.get("choices", [{}])[0].get("delta", {})
-                            content = delta.get("content", "")
-                            if content:
-                                full_text += content
-                                yield content
-                        except json.JSONDecodeError:
-                            logger.debug("خط JSON نامعتبر رد شد")
-                            continue
-                        except Exception as inner_e:
-                            logger.warning("خطا در پردازش خط استریم: %s", inner_e)
-                            continue
-
-                total_time = time.perf_counter() - start_time
-                logger.info("پاسخ کامل شد → طول: %d کاراکتر | زمان کل: %.3f ثانیه", len(full_text), total_time)
-
-                if not full_text.strip():
-                    logger.warning("پاسخ خالی دریافت شد")
-                    yield "متأسفانه پاسخی تولید نشد. لطفاً دوباره تلاش کنید."
-
-        except httpx.HTTPStatusError as http_err:
-            try:
-                error_body = await http_err.response.aread()
-                error_text = error_body.decode(errors="replace")
-            except:
-                error_text = "(نتوانست بدنه پاسخ خوانده شود)"
-
-            error_msg = f"خطای ارتباط (کد {http_err.response.status_code}): {error_text[:300]}"
-            logger.error("خطای HTTP → کد: %d | بدنه: %s", http_err.response.status_code, error_text[:1000])
-            yield error_msg
-
-        except httpx.RequestError as req_err:
-            logger.error("خطای شبکه/درخواست: %s", str(req_err))
-            yield "مشکل ارتباط شبکه با سرویس هوش مصنوعی رخ داد."
-
-        except Exception as e:
-            logger.exception("خطای غیرمنتظره در generate_response")
-            yield "خطای داخلی در پردازش درخواست. لطفاً با پشتیبانی تماس بگیرید."
-
+            async for chunk in source:
+                chars += len(chunk)
+                yield chunk
+        except QueueFullError:
+            # پیام حذف بار به زبان همین درخواست‌کننده (نه درخواست اول استریم مشترک)
+            yield traffic_high_text(lang)
         finally:
             total_time = time.perf_counter() - start_time
-            logger.debug("پایان متد generate_response | زمان کل: %.3f ثانیه", total_time)
+            logger.debug("پایان متد generate_response | زمان کل: %.3f ثانیه", total_time,
+                         extra={"task": task_type, "model": self.model, "latency": round(total_time, 3),
+                                "chars": chars})
 
 
 # تست سریع (برای چک کردن)
@@ -220,4 +192,6 @@ async def test_peak_ai():
 
 
 if __name__ == "__main__":
+    from log_setup import setup_logging
+    setup_logging()
     asyncio.run(test_peak_ai())
\ No newline at end of file
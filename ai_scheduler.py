@@ -0,0 +1,291 @@
+# ai_scheduler.py
+"""
+زمان‌بند درخواست‌های هوش مصنوعی (PeakAI و SalesAI)
+- سقف درخواست‌های هم‌زمان به OpenRouter (max_in_flight)
+- صف اولویت‌دار بر اساس پلن: professional > premium > free
+- حذف بار (load-shedding): اگر صف بیش از حد عمیق باشد یا انتظار طولانی شود،
+  پیام support_traffic_high به کاربر برگردانده می‌شود
+- ظرفیت در فاصله backoff تلاش مجدد موقتاً آزاد می‌شود (released_slot)
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from metrics import AI_SCHEDULER_IN_FLIGHT, AI_SCHEDULER_QUEUE_DEPTH, AI_SCHEDULER_SHED, AI_SCHEDULER_WAIT_SECONDS
+from storage import load_config_section
+
+logger = logging.getLogger("PeakScheduler")
+
+PLAN_PRIORITY = {"professional": 0, "premium": 1, "free": 2}
+LOWEST_PRIORITY = max(PLAN_PRIORITY.values())
+PLAN_NAMES = {v: k for k, v in PLAN_PRIORITY.items()}
+LANG_FILES = {"fa": "fa.json", "en": "en.json"}
+
+
+class QueueFullError(Exception):
+    """صف بیش از حد عمیق است یا زمان انتظار تمام شد"""
+
+
+def plan_priority(plan: str | None) -> int:
+    return PLAN_PRIORITY.get((plan or "free").lower(), LOWEST_PRIORITY)
+
+
+_texts: dict[str, str] = {}
+
+
+def traffic_high_text(lang: str = "fa") -> str:
+    """متن support_traffic_high از فایل زبان (کش‌شده)"""
+    lang = lang if lang in LANG_FILES else "fa"
+    if lang not in _texts:
+        try:
+            with open(LANG_FILES[lang], 'r', encoding='utf-8') as f:
+                _texts[lang] = json.load(f)["support_traffic_high"]
+        except (OSError, KeyError, json.JSONDecodeError):
+            _texts[lang] = "در حال حاضر ترافیک سیستم بالاست، لطفاً کمی بعد دوباره تلاش کنید."
+    return _texts[lang]
+
+
+class AdmissionTicket:
+    """
+    درخواست در انتظار ظرفیت؛ تا قبل از پذیرش، اولویت آن قابل ارتقا است
+    (مثلاً وقتی کاربر پلن بالاتر به استریم مشترک یک کاربر free متصل می‌شود)
+    """
+
+    __slots__ = ("priority", "waiter")
+
+    def __init__(self, plan: str | None = None):
+        self.priority = plan_priority(plan)
+        self.waiter: asyncio.Future | None = None
+
+
+class _Admission:
+    """ظرفیتی که استریم جاری در اختیار دارد (held=False یعنی در backoff موقتاً پس داده شده)"""
+
+    __slots__ = ("scheduler", "ticket", "held")
+
+    def __init__(self, scheduler: "AIScheduler", ticket: AdmissionTicket):
+        self.scheduler = scheduler
+        self.ticket = ticket
+        self.held = False
+
+
+# ظرفیت زمان‌بندی که task فعلی در اختیار دارد (برای آزادسازی موقت در backoff)
+_current_admission: contextvars.ContextVar[_Admission | None] = contextvars.ContextVar(
+    "peak_ai_admission", default=None)
+
+
+@asynccontextmanager
+async def released_slot():
+    """
+    آزاد کردن موقت ظرفیت زمان‌بند در بدنه (مثلاً sleep بین تلاش‌های مجدد) و گرفتن دوباره آن بعد از آن
+    اگر task فعلی ظرفیتی نداشته باشد کاری انجام نمی‌دهد؛ در صورت حذف بار هنگام گرفتن دوباره QueueFullError می‌دهد
+    """
+    admission = _current_admission.get()
+    if admission is None or not admission.held:
+        yield
+        return
+    admission.held = False
+    admission.scheduler.release()
+    yield
+    await admission.scheduler.acquire(ticket=admission.ticket)
+    admission.held = True
+
+
+class AIScheduler:
+    def __init__(self, max_in_flight: int = 8, max_queue_depth: int = 50, max_wait: float = 30.0):
+        self.max_in_flight = max_in_flight
+        self.max_queue_depth = max_queue_depth
+        self.max_wait = max_wait
+        self._in_flight = 0
+        self._queues: dict[int, deque] = {p: deque() for p in sorted(set(PLAN_PRIORITY.values()))}
+        self._wait_times: deque = deque(maxlen=1000)
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0, "timeouts": 0}
+
+    # ---------- وضعیت ----------
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def queue_depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _publish(self):
+        """به‌روزرسانی gaugeهای /metrics"""
+        AI_SCHEDULER_IN_FLIGHT.set(self._in_flight)
+        for priority, queue in self._queues.items():
+            AI_SCHEDULER_QUEUE_DEPTH.set(len(queue), plan=PLAN_NAMES[priority])
+
+    def _record_wait(self, seconds: float, priority: int):
+        self._wait_times.append(seconds)
+        AI_SCHEDULER_WAIT_SECONDS.observe(seconds, plan=PLAN_NAMES[priority])
+
+    def _shed(self, reason: str):
+        self.stats["shed"] += 1
+        AI_SCHEDULER_SHED.inc(reason=reason)
+
+    def metrics(self) -> dict:
+        waits = sorted(self._wait_times)
+        p95 = waits[int(len(waits) * 0.95) - 1] if waits else 0.0
+        return {
+            **self.stats,
+            "in_flight": self._in_flight,
+            "queue_depth": self.queue_depth(),
+            "queue_depth_by_plan": {PLAN_NAMES[p]: len(q) for p, q in self._queues.items()},
+            "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p95": p95,
+            "wait_max": waits[-1] if waits else 0.0,
+        }
+
+    # ---------- گرفتن و آزاد کردن ظرفیت ----------
+    def _shed_lower_priority(self, priority: int) -> bool:
+        """برای جا باز کردن، جدیدترین درخواست با اولویت پایین‌تر را از صف حذف می‌کند"""
+        for p in sorted(self._queues, reverse=True):
+            if p <= priority:
+                break
+            queue = self._queues[p]
+            while queue:
+                waiter = queue.pop()
+                if not waiter.done():
+                    waiter.set_exception(QueueFullError())
+                    self._shed("displaced")
+                    return True
+        return False
+
+    def promote(self, ticket: AdmissionTicket, plan: str | None):
+        """ارتقای اولویت درخواست (در صورت انتظار در صف، به صف اولویت جدید منتقل می‌شود)"""
+        priority = plan_priority(plan)
+        if priority >= ticket.priority:
+            return
+        waiter = ticket.waiter
+        old_queue = self._queues[ticket.priority]
+        if waiter is not None and not waiter.done() and waiter in old_queue:
+            old_queue.remove(waiter)
+            self._queues[priority].append(waiter)
+            self._publish()
+        ticket.priority = priority
+
+    async def acquire(self, plan: str | None = None, ticket: AdmissionTicket | None = None):
+        ticket = ticket or AdmissionTicket(plan)
+        priority = ticket.priority
+        if self._in_flight < self.max_in_flight and self.queue_depth() == 0:
+            self._in_flight += 1
+            self.stats["admitted"] += 1
+            self._record_wait(0.0, priority)
+            self._publish()
+            return
+
+        if self.queue_depth() >= self.max_queue_depth and not self._shed_lower_priority(priority):
+            self._shed("queue_full")
+            logger.warning("صف درخواست‌های AI پر است | عمق: %d | پلن: %s", self.queue_depth(), plan)
+            raise QueueFullError()
+
+        waiter = asyncio.get_running_loop().create_future()
+        ticket.waiter = waiter
+        self._queues[priority].append(waiter)
+        self.stats["queued"] += 1
+        self._publish()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            self._shed("timeout")
+            raise QueueFullError() from None
+        except asyncio.CancelledError:
+            # اگر همزمان با لغو، ظرفیت به ما داده شده بود، آن را پس می‌دهیم
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.release()
+            raise
+        finally:
+            # صف فعلی (ممکن است با promote عوض شده باشد)
+            queue = self._queues[ticket.priority]
+            if waiter in queue:
+                queue.remove(waiter)
+            ticket.waiter = None
+            self._publish()
+        self.stats["admitted"] += 1
+        self._record_wait(time.perf_counter() - start, ticket.priority)
+
+    def release(self):
+        """ظرفیت آزادشده مستقیماً به پراولویت‌ترین منتظر داده می‌شود"""
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    self._publish()
+                    return
+        self._in_flight -= 1
+        self._publish()
+
+    @asynccontextmanager
+    async def slot(self, plan: str | None = None):
+        await self.acquire(plan)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def run_admitted(self, factory, plan: str | None = None, ticket: AdmissionTicket | None = None):
+        """
+        مثل run_stream ولی در صورت حذف بار QueueFullError می‌دهد
+        (برای استریم‌های مشترک که هر مشترک پیام را به زبان خودش نمایش می‌دهد)
+        """
+        admission = _Admission(self, ticket or AdmissionTicket(plan))
+        await self.acquire(plan, ticket=admission.ticket)
+        async for chunk in self._run_holding(admission, factory):
+            yield chunk
+
+    async def _run_holding(self, admission: _Admission, factory):
+        """اجرای استریم با ظرفیت گرفته‌شده؛ ظرفیت فقط در صورتی آزاد می‌شود که هنوز در اختیار باشد"""
+        admission.held = True
+        previous = _current_admission.get()
+        _current_admission.set(admission)
+        try:
+            async for chunk in factory():
+                yield chunk
+        finally:
+            _current_admission.set(previous)
+            if admission.held:
+                admission.held = False
+                self.release()
+
+    async def run_stream(self, plan: str | None, factory, lang: str = "fa"):
+        """
+        اجرای یک استریم متنی در ظرفیت زمان‌بند
+        در صورت حذف بار، فقط پیام support_traffic_high yield می‌شود
+        """
+        admission = _Admission(self, AdmissionTicket(plan))
+        try:
+            await self.acquire(plan, ticket=admission.ticket)
+        except QueueFullError:
+            yield traffic_high_text(lang)
+            return
+        try:
+            async for chunk in self._run_holding(admission, factory):
+                yield chunk
+        except QueueFullError:
+            # حذف بار هنگام گرفتن دوباره ظرفیت بعد از backoff (هنوز متنی نمایش داده نشده)
+            yield traffic_high_text(lang)
+
+
+_scheduler: AIScheduler | None = None
+
+
+def get_ai_scheduler() -> AIScheduler:
+    """زمان‌بند مشترک پروسه (تنظیمات از بخش ai_scheduler در config.json)"""
+    global _scheduler
+    if _scheduler is None:
+        config = load_config_section("ai_scheduler")
+        _scheduler = AIScheduler(
+            max_in_flight=int(config.get("max_in_flight", 8)),
+            max_queue_depth=int(config.get("max_queue_depth", 50)),
+            max_wait=float(config.get("max_wait", 30.0)),
+        )
+    return _scheduler
@@ -0,0 +1,534 @@
+# bench.py
+"""
+بنچمارک و تست بار PeakTube بدون سرویس‌های واقعی
+- سرور محلی SSE شبیه chat/completions در OpenRouter (نرخ توکن، خطا و 429 قابل تنظیم)
+- تولید users.json مصنوعی (۱ هزار تا ۱ میلیون کاربر)
+- تغذیه رویدادهای جعلی Telethon به هندلر sales_userbot
+- گزارش ops/sec و p50/p95/p99 برای هر زیرسیستم و مقایسه با baseline ذخیره‌شده
+
+اجرا:
+    python bench.py                        # همه زیرسیستم‌ها، مقایسه با bench_baseline.json
+    python bench.py --save-baseline        # ذخیره نتایج فعلی به عنوان baseline
+    python bench.py --only quota --users 1000000 --backend sqlite
+    python bench.py --generate-users 100000 --output users.json   # فقط تولید فایل
+خروج با کد 1 اگر نسبت به baseline پسرفتی بیش از tolerance دیده شود
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BASELINE_FILE = "bench_baseline.json"
+OUTPUT_FILE = "bench_output.txt"
+SUBSYSTEMS = ("peak_ai", "sales_ai", "quota", "sales_handler")
+
+PLAN_WEIGHTS = {"free": 0.85, "premium": 0.12, "professional": 0.03}
+
+
+# ==================== سرور ساختگی OpenRouter ====================
+class MockOpenRouterServer:
+    """
+    سرور HTTP/1.1 محلی که chat/completions را به صورت SSE شبیه‌سازی می‌کند
+    token_rate: توکن در ثانیه برای هر استریم؛ error_rate / rate_limit_rate: احتمال 500 / 429
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, token_rate: float = 200.0, tokens: int = 60,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, seed: int | None = None):
+        self.host = host
+        self.port = port
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.stats = {"requests": 0, "streams": 0, "errors": 0, "rate_limited": 0}
+        self._server: asyncio.AbstractServer | None = None
+        self._handlers: set[asyncio.Task] = set()
+
+    @property
+    def chat_url(self) -> str:
+        return f"http://{self.host}:{self.port}/api/v1/chat/completions"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # اتصال‌های keep-alive باز قبل از wait_closed بسته می‌شوند
+            handlers = list(self._handlers)
+            for task in handlers:
+                task.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> tuple[str, str] | None:
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path = request_line.decode("latin-1").split()[:2]
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value.strip())
+        if length:
+            await reader.readexactly(length)
+        return method, path
+
+    @staticmethod
+    def _head(status: str, content_type: str, extra: str = "", length: int | None = None) -> bytes:
+        head = f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n{extra}"
+        head += f"Content-Length: {length}\r\n" if length is not None else "Transfer-Encoding: chunked\r\n"
+        return (head + "\r\n").encode("latin-1")
+
+    @staticmethod
+    def _chunk(data: bytes) -> bytes:
+        return f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                await self._respond(request[0], request[1], writer)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            self._handlers.discard(task)
+            writer.close()
+
+    async def _respond(self, method: str, path: str, writer: asyncio.StreamWriter):
+        self.stats["requests"] += 1
+        if method == "GET" and path.startswith("/api/v1/auth/key"):
+            body = b'{"data": {"label": "bench"}}'
+            writer.write(self._head("200 OK", "application/json", length=len(body)) + body)
+            await writer.drain()
+            return
+        if not path.startswith("/api/v1/chat/completions"):
+            writer.write(self._head("404 Not Found", "text/plain", length=0))
+            await writer.drain()
+            return
+
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            body = b'{"error": {"code": 429, "message": "rate limited"}}'
+            writer.write(self._head("429 Too Many Requests", "application/json", "Retry-After: 0\r\n", len(body)) + body)
+            await writer.drain()
+            return
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.stats["errors"] += 1
+            body = b'{"error": {"code": 500, "message": "upstream error"}}'
+            writer.write(self._head("500 Internal Server Error", "application/json", length=len(body)) + body)
+            await writer.drain()
+            return
+
+        self.stats["streams"] += 1
+        writer.write(self._head("200 OK", "text/event-stream"))
+        writer.write(self._chunk(b": OPENROUTER PROCESSING\n\n"))
+        delay = 1.0 / self.token_rate if self.token_rate > 0 else 0.0
+        for i in range(self.tokens):
+            payload = {"choices": [{"delta": {"content": f"توکن{i} "}}]}
+            writer.write(self._chunk(b"data: " + json.dumps(payload, ensure_ascii=False).encode() + b"\n\n"))
+            await writer.drain()
+            if delay:
+                await asyncio.sleep(delay)
+        final = {"choices": [{"delta": {}, "finish_reason": "stop"}],
+                 "usage": {"prompt_tokens": 20, "completion_tokens": self.tokens}}
+        writer.write(self._chunk(b"data: " + json.dumps(final).encode() + b"\n\n"))
+        writer.write(self._chunk(b"data: [DONE]\n\n"))
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+# ==================== داده مصنوعی ====================
+def synthetic_user(user_id: int, rng: random.Random, now: datetime) -> dict:
+    plan = rng.choices(list(PLAN_WEIGHTS), weights=list(PLAN_WEIGHTS.values()))[0]
+    window_start = (now - timedelta(hours=rng.uniform(0, 30))).isoformat()
+    return {
+        "plan": plan,
+        "downloads_today": rng.randint(0, 3),
+        "downloads_total": rng.randint(0, 500),
+        "last_reset": window_start,
+        "username": f"User_{user_id}",
+        "ai_used_count": rng.randint(0, 10),
+        "ai_window_start_time": window_start,
+    }
+
+
+def generate_users(count: int, path: str, seed: int = 42, first_id: int = 100_000_000) -> list[int]:
+    """
+    نوشتن users.json با count کاربر (به صورت جریانی تا ۱ میلیون کاربر حافظه زیادی نگیرد)
+    بازگشت: شناسه کاربران ساخته‌شده
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+    ids = [first_id + i for i in range(count)]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{")
+        for i, user_id in enumerate(ids):
+            if i:
+                f.write(",")
+            f.write(f'\n"{user_id}": ')
+            f.write(json.dumps(synthetic_user(user_id, rng, now), ensure_ascii=False))
+        f.write("\n}")
+    return ids
+
+
+# ==================== رویدادهای جعلی Telethon ====================
+SALES_MESSAGES = (
+    "سلام وقت بخیر", "کیفیت 4k دارید؟", "ارتباط با ادمین", "کد تخفیف دارید؟",
+    "مطمئن باشم کلاهبرداری نیست؟", "قیمت چنده و چجوری بخرم", "واریز کردم", "ممنون عالی بود",
+    "خداحافظ", "یک پیام بی‌ربط برای مسیر پیش‌فرض",
+)
+
+
+class FakeSender:
+    def __init__(self, user_id: int, bot: bool = False):
+        self.id = user_id
+        self.bot = bot
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, text: str, photo=None):
+        self.id = message_id
+        self.message = text
+        self.photo = photo
+
+
+class FakeEvent:
+    """حداقل سطح NewMessage.Event که هندلر فروش استفاده می‌کند"""
+
+    def __init__(self, sender_id: int, text: str, message_id: int, photo=None):
+        self.is_private = True
+        self.sender_id = sender_id
+        self.chat_id = sender_id
+        self.message = FakeMessage(message_id, text, photo)
+        self.replies = 0
+
+    async def get_sender(self):
+        return FakeSender(self.sender_id)
+
+    async def reply(self, *args, **kwargs):
+        self.replies += 1
+        return FakeMessage(self.message.id + 1, args[0] if args else "")
+
+    async def respond(self, *args, **kwargs):
+        return await self.reply(*args, **kwargs)
+
+
+class FakeClient:
+    """جایگزین TelegramClient؛ همه درخواست‌ها بدون شبکه پاسخ داده می‌شوند"""
+
+    def __init__(self, self_id: int = 1):
+        self.me = FakeSender(self_id)
+        self.calls = 0
+
+    async def get_me(self):
+        return self.me
+
+    async def __call__(self, request):
+        self.calls += 1
+
+    async def send_file(self, *args, **kwargs):
+        self.calls += 1
+        return FakeMessage(0, kwargs.get("caption", ""))
+
+    async def send_message(self, *args, **kwargs):
+        self.calls += 1
+        return FakeMessage(0, args[1] if len(args) > 1 else "")
+
+    async def send_read_acknowledge(self, *args, **kwargs):
+        self.calls += 1
+
+
+def fake_events(count: int, user_ids: list[int], seed: int = 7):
+    rng = random.Random(seed)
+    for i in range(count):
+        photo = object() if rng.random() < 0.05 else None
+        yield FakeEvent(rng.choice(user_ids), "" if photo else rng.choice(SALES_MESSAGES), i + 1, photo)
+
+
+# ==================== اندازه‌گیری ====================
+def percentile(sorted_values: list[float], q: float) -> float:
+    """صدک به روش nearest-rank روی لیست مرتب‌شده"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list[float], elapsed: float, errors: int = 0) -> dict:
+    values = sorted(latencies)
+    return {
+        "ops": len(values),
+        "errors": errors,
+        "ops_per_sec": len(values) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
+
+
+async def run_concurrent(operation, total: int, concurrency: int) -> dict:
+    """اجرای operation(i) به تعداد total با concurrency کارگر هم‌زمان"""
+    latencies: list[float] = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                await operation(i)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+
+# خطاهای upstream عملیات جاری (generate_response خطا را به صورت متن yield می‌کند و استثنا نمی‌دهد)
+_operation_errors: contextvars.ContextVar[list | None] = contextvars.ContextVar("bench_operation_errors", default=None)
+
+
+def track_upstream_errors(engine):
+    """رویدادهای error موتور استریم در لیست خطاهای عملیات جاری ثبت می‌شوند"""
+    from openrouter_stream import EVENT_ERROR
+
+    events = engine.events
+
+    async def tracked(*args, **kwargs):
+        async for event in events(*args, **kwargs):
+            if event.kind == EVENT_ERROR:
+                errors = _operation_errors.get()
+                if errors is not None:
+                    errors.append(event)
+            yield event
+
+    engine.events = tracked
+
+
+async def consume_checked(chunks):
+    """مصرف کامل استریم؛ RuntimeError اگر upstream خطا داده باشد (برای شمارش در run_concurrent)"""
+    errors: list = []
+    token = _operation_errors.set(errors)
+    try:
+        async for _ in chunks:
+            pass
+    finally:
+        _operation_errors.reset(token)
+    if errors:
+        raise RuntimeError(errors[-1].content)
+
+
+# ==================== زیرسیستم‌ها ====================
+async def bench_peak_ai(server: MockOpenRouterServer, requests: int, concurrency: int) -> dict:
+    from ai_handler import PeakAI
+
+    ai = PeakAI("sk-bench", coalesce=False)
+    ai.base_url = ai.engine.base_url = server.chat_url
+    track_upstream_errors(ai.engine)
+
+    async def operation(i):
+        await consume_checked(ai.generate_response(f"سوال شماره {i}", "general", plan="free"))
+
+    return await run_concurrent(operation, requests, concurrency)
+
+
+async def bench_sales_ai(server: MockOpenRouterServer, requests: int, concurrency: int) -> dict:
+    from sales_ai import SalesAI
+
+    ai = SalesAI("sk-bench")
+    ai.base_url = ai.engine.base_url = server.chat_url
+    track_upstream_errors(ai.engine)
+
+    async def operation(i):
+        await consume_checked(ai.generate_sales_response(f"قیمت پلن {i}", plan="free"))
+
+    return await run_concurrent(operation, requests, concurrency)
+
+
+async def bench_quota(user_ids: list[int], operations: int, concurrency: int) -> dict:
+    import stats
+
+    rng = random.Random(3)
+    targets = [rng.choice(user_ids) for _ in range(operations)]
+
+    async def operation(i):
+        user_id = targets[i]
+        if i % 4 == 0:
+            await stats.try_consume_download(user_id)
+        elif i % 4 == 1:
+            await stats.try_consume_ai(user_id)
+        elif i % 4 == 2:
+            stats.can_user_download(user_id)
+        else:
+            stats.check_ai_support_limit(user_id)
+
+    return await run_concurrent(operation, operations, concurrency)
+
+
+async def bench_sales_handler(user_ids: list[int], events_count: int, concurrency: int) -> dict:
+    import sales_userbot
+    from receipt_outbox import ReceiptOutbox
+    from sender_cache import SenderCache
+    from voice_cache import VoiceMediaCache
+
+    # همه وابستگی‌هایی که در زمان import با TelegramClient واقعی ساخته شده‌اند با کلاینت جعلی ساخته می‌شوند
+    # (مسیرها نسبی‌اند و در پوشه موقت bench قرار می‌گیرند)
+    client = FakeClient()
+    sales_userbot.client = client
+    sales_userbot.VOICES = VoiceMediaCache(client)
+    sales_userbot.RECEIPTS = ReceiptOutbox(client, sales_userbot.BOT_ID, db_path="bench_outbox.db")
+    sales_userbot.SENDERS = SenderCache()
+    events = list(fake_events(events_count, user_ids))
+
+    async def operation(i):
+        await sales_userbot.handle_message(events[i])
+
+    return await run_concurrent(operation, events_count, concurrency)
+
+
+# ==================== baseline ====================
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """لیست پسرفت‌ها: افت ops/sec یا افزایش p95 بیش از tolerance"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: ops/sec {result['ops_per_sec']:.1f} < baseline {base['ops_per_sec']:.1f}")
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']:.2f}ms > baseline {base['p95_ms']:.2f}ms")
+    return regressions
+
+
+def format_report(results: dict) -> str:
+    lines = [f"{'subsystem':<15}{'ops':>8}{'err':>6}{'ops/sec':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+    for name, r in results.items():
+        lines.append(f"{name:<15}{r['ops']:>8}{r['errors']:>6}{r['ops_per_sec']:>12.1f}"
+                     f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+    return "\n".join(lines)
+
+
+# ==================== اجرا ====================
+async def run(args) -> dict:
+    import storage
+
+    work_dir = tempfile.mkdtemp(prefix="peak_bench_")
+    users_path = os.path.join(work_dir, "users.json")
+    user_ids = generate_users(args.users, users_path)
+
+    if args.backend == "sqlite":
+        backend = storage.SQLiteBackend(os.path.join(work_dir, "bench.db"))
+        backend.put_users(storage.JsonBackend(users_path).load_all())
+    else:
+        backend = storage.JsonBackend(users_path, os.path.join(work_dir, "support_queue.json"))
+    storage.set_backend(backend)
+
+    selected = args.only or list(SUBSYSTEMS)
+    results = {}
+    server = await MockOpenRouterServer(
+        token_rate=args.token_rate, tokens=args.tokens,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, seed=1
+    ).start()
+    try:
+        if "peak_ai" in selected:
+            results["peak_ai"] = await bench_peak_ai(server, args.requests, args.concurrency)
+        if "sales_ai" in selected:
+            results["sales_ai"] = await bench_sales_ai(server, args.requests, args.concurrency)
+        if "quota" in selected:
+            results["quota"] = await bench_quota(user_ids, args.operations, args.concurrency)
+        if "sales_handler" in selected:
+            # جلسه Telethon در پوشه موقت ساخته شود؛ قوانین فروش و فایل‌های زبان کنارش کپی می‌شوند
+            for name in ("sales_intents.json", "fa.json", "en.json"):
+                if os.path.exists(name):
+                    shutil.copy(name, work_dir)
+            cwd = os.getcwd()
+            os.chdir(work_dir)
+            try:
+                results["sales_handler"] = await bench_sales_handler(user_ids, args.operations, args.concurrency)
+            finally:
+                os.chdir(cwd)
+    finally:
+        await server.stop()
+        storage.get_store().flush()
+        backend.close()
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="بنچمارک PeakTube با سرویس‌های ساختگی")
+    parser.add_argument("--only", nargs="+", choices=SUBSYSTEMS)
+    parser.add_argument("--users", type=int, default=1000, help="تعداد کاربران مصنوعی (۱ هزار تا ۱ میلیون)")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="sqlite")
+    parser.add_argument("--requests", type=int, default=200, help="تعداد درخواست‌های AI")
+    parser.add_argument("--operations", type=int, default=5000, help="تعداد عملیات سهمیه / رویدادهای فروش")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--token-rate", type=float, default=500.0)
+    parser.add_argument("--tokens", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="پسرفت مجاز نسبت به baseline")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--generate-users", type=int, metavar="N", help="فقط تولید users.json با N کاربر")
+    parser.add_argument("--output", default="users.json", help="مسیر خروجی --generate-users")
+    args = parser.parse_args(argv)
+
+    if args.generate_users:
+        generate_users(args.generate_users, args.output)
+        print(f"{args.generate_users} کاربر مصنوعی → {args.output}")
+        return 0
+
+    results = asyncio.run(run(args))
+    report = format_report(results)
+    print(report)
+    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+        f.write(report + "\n")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nbaseline ذخیره شد → {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nپسرفت نسبت به baseline:")
+            for line in regressions:
+                print(f"  • {line}")
+            return 1
+        print("\nبدون پسرفت نسبت به baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
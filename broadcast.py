@@ -0,0 +1,354 @@
+# broadcast.py
+"""
+ارسال پیام همگانی به کاربران با رعایت محدودیت‌های سرعت تلگرام
+- گیرنده‌ها به صورت جریانی (صفحه‌به‌صفحه) از UserStore خوانده می‌شوند، نه با load_all
+- فیلتر بر اساس پلن، زبان و فعالیت اخیر
+- محدودکننده سطل توکن سراسری؛ با FloodWait کل ارسال متوقف و گیرنده برای بعد زمان‌بندی می‌شود
+- پیشرفت در broadcast_checkpoint.json ذخیره می‌شود و ارسال قطع‌شده از همان‌جا ادامه پیدا می‌کند
+- گزارش: تعداد موفق / ناموفق / مسدود و نرخ ارسال (سازگار با متن admin_broadcast_sent)
+"""
+
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+
+from metrics import get_registry
+from storage import atomic_write_json, get_store, load_config_section
+from telegram_stream import flood_wait_seconds
+
+logger = logging.getLogger("PeakBroadcast")
+
+BROADCAST_CHECKPOINT_FILE = "broadcast_checkpoint.json"
+DEFAULT_LANGUAGE = "fa"
+
+# فیلدهایی که با فعالیت کاربر به‌روز می‌شوند (جدیدترین مقدار = آخرین فعالیت)
+ACTIVITY_FIELDS = ("last_reset", "ai_window_start_time", "last_monthly_reset", "joined_at", "created_at")
+
+BROADCAST_MESSAGES = get_registry().counter(
+    "peak_broadcast_messages_total", "نتیجه ارسال پیام‌های همگانی", ("result",))
+
+
+# ==================== فیلتر گیرنده‌ها ====================
+def last_activity(user: dict) -> datetime | None:
+    latest = None
+    for name in ACTIVITY_FIELDS:
+        value = user.get(name)
+        if not value:
+            continue
+        try:
+            moment = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            continue
+        if latest is None or moment > latest:
+            latest = moment
+    return latest
+
+
+@dataclass
+class BroadcastFilter:
+    plans: list[str] = field(default_factory=list)
+    languages: list[str] = field(default_factory=list)
+    active_within_days: float | None = None
+
+    def matches(self, user: dict, now: datetime | None = None) -> bool:
+        if self.plans and (user.get("plan") or "free") not in self.plans:
+            return False
+        if self.languages and (user.get("language") or DEFAULT_LANGUAGE) not in self.languages:
+            return False
+        if self.active_within_days is not None:
+            activity = last_activity(user)
+            now = now or datetime.now()
+            if activity is None or now - activity > timedelta(days=self.active_within_days):
+                return False
+        return True
+
+
+# ==================== محدودکننده سرعت ====================
+class TokenBucket:
+    """سطل توکن async با امکان توقف کامل (برای FloodWait)"""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """توقف همه ارسال‌ها تا seconds ثانیه دیگر؛ بعد از آن سطل خالی شروع می‌شود"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated_at = time.monotonic()
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# ==================== گزارش ====================
+@dataclass
+class BroadcastReport:
+    broadcast_id: str
+    scanned: int = 0
+    matched: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    retries: int = 0
+    flood_waits: int = 0
+    elapsed: float = 0.0
+    done: bool = False
+
+    @property
+    def throughput(self) -> float:
+        """پیام موفق در ثانیه"""
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def render(self, template: str) -> str:
+        """قالب admin_broadcast_sent از fa.json / en.json ({sent} / {failed} / {total})"""
+        return template.format(sent=self.sent, failed=self.failed + self.blocked, total=self.matched)
+
+
+def _is_permanent(error: Exception) -> bool:
+    """کاربر ربات را مسدود کرده، حساب حذف شده یا چت در دسترس نیست؛ تلاش مجدد فایده‌ای ندارد"""
+    name = type(error).__name__
+    if any(part in name for part in ("Forbidden", "Blocked", "Deactivated", "PeerIdInvalid", "ChatNotFound")):
+        return True
+    text = str(error).lower()
+    return "blocked" in text or "deactivated" in text or "chat not found" in text
+
+
+# ==================== موتور ارسال ====================
+class BroadcastEngine:
+    def __init__(self, send, store=None, rate: float = 25.0, burst: float | None = None,
+                 concurrency: int = 8, min_retry_delay: float = 1.0, max_attempts: int = 3,
+                 retry_delay: float = 5.0, checkpoint_path: str = BROADCAST_CHECKPOINT_FILE,
+                 checkpoint_every: int = 100, page_size: int = 500):
+        """
+        send: تابع async با امضای send(user_id, user) که پیام را برای یک کاربر ارسال می‌کند
+        store: UserStore (پیش‌فرض: get_store())
+        min_retry_delay: حداقل فاصله تلاش مجدد برای یک چت (هر چت در هر دور فقط یک پیام می‌گیرد)
+        """
+        self.send = send
+        self.store = store
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.min_retry_delay = min_retry_delay
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.page_size = page_size
+
+    # ---------- نقطه بازیابی ----------
+    def _load_checkpoints(self) -> dict:
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning("فایل پیشرفت ارسال همگانی خوانده نشد: %s", e)
+            return {}
+
+    def _save_checkpoint(self, report: BroadcastReport, last_id, retries: list, audience: BroadcastFilter):
+        checkpoints = self._load_checkpoints()
+        checkpoints[report.broadcast_id] = {
+            "report": asdict(report),
+            "last_id": last_id,
+            "retries": retries,
+            "filter": asdict(audience),
+            "updated_at": datetime.now().isoformat(),
+        }
+        atomic_write_json(self.checkpoint_path, checkpoints)
+
+    def progress(self, broadcast_id: str) -> BroadcastReport | None:
+        """آخرین گزارش ذخیره‌شده یک ارسال همگانی (در حال اجرا، قطع‌شده یا تمام‌شده)"""
+        checkpoint = self._load_checkpoints().get(broadcast_id)
+        return BroadcastReport(**checkpoint["report"]) if checkpoint else None
+
+    # ---------- ارسال ----------
+    async def _deliver(self, user_id: int, user: dict, attempts: int, report: BroadcastReport,
+                       retries: list) -> None:
+        await self.bucket.acquire()
+        try:
+            await self.send(user_id, user)
+        except Exception as e:
+            wait = flood_wait_seconds(e)
+            if wait is not None:
+                # FloodWait: توقف سراسری و زمان‌بندی دوباره همین گیرنده (بدون مصرف تلاش)
+                self.bucket.pause(wait)
+                report.flood_waits += 1
+                BROADCAST_MESSAGES.inc(result="flood_wait")
+                logger.warning("FloodWait در ارسال همگانی؛ %.0f ثانیه توقف", wait)
+                heapq.heappush(retries, (time.time() + wait, user_id, attempts))
+                return
+            if _is_permanent(e):
+                report.blocked += 1
+                BROADCAST_MESSAGES.inc(result="blocked")
+                return
+            attempts += 1
+            if attempts >= self.max_attempts:
+                report.failed += 1
+                BROADCAST_MESSAGES.inc(result="failed")
+                logger.warning("ارسال همگانی به %s بعد از %d تلاش ناموفق ماند: %s", user_id, attempts, e)
+                return
+            report.retries += 1
+            BROADCAST_MESSAGES.inc(result="retry")
+            delay = max(self.retry_delay * attempts, self.min_retry_delay)
+            heapq.heappush(retries, (time.time() + delay, user_id, attempts))
+            return
+        report.sent += 1
+        BROADCAST_MESSAGES.inc(result="sent")
+
+    async def _run_batch(self, batch: list, report: BroadcastReport, retries: list):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(item):
+            async with semaphore:
+                await self._deliver(*item, report, retries)
+
+        await asyncio.gather(*(deliver(item) for item in batch))
+
+    def _due_retries(self, retries: list, store, wait_all: bool = False) -> list:
+        now = time.time()
+        batch = []
+        while retries and (retries[0][0] <= now or wait_all):
+            _, user_id, attempts = heapq.heappop(retries)
+            user = store.get(user_id)
+            if user is not None:
+                batch.append((user_id, dict(user), attempts))
+        return batch
+
+    async def run(self, broadcast_id: str, audience: BroadcastFilter | None = None,
+                  progress=None) -> BroadcastReport:
+        """
+        اجرا یا ادامه ارسال همگانی broadcast_id
+        progress: تابع اختیاری (sync یا async) که بعد از هر نقطه بازیابی با گزارش فعلی صدا زده می‌شود
+        """
+        store = self.store or get_store()
+        checkpoint = self._load_checkpoints().get(broadcast_id)
+        if checkpoint is not None:
+            report = BroadcastReport(**checkpoint["report"])
+            if report.done:
+                return report
+            audience = BroadcastFilter(**checkpoint["filter"])
+            last_id = checkpoint["last_id"]
+            retries = [tuple(item) for item in checkpoint["retries"]]
+            heapq.heapify(retries)
+            logger.info("ادامه ارسال همگانی %s از بعد از کاربر %s", broadcast_id, last_id)
+        else:
+            report = BroadcastReport(broadcast_id)
+            audience = audience or BroadcastFilter()
+            last_id = None
+            retries = []
+
+        started = time.monotonic() - report.elapsed
+
+        async def checkpoint_now():
+            report.elapsed = time.monotonic() - started
+            await asyncio.to_thread(self._save_checkpoint, report, last_id, list(retries), audience)
+            if progress is not None:
+                result = progress(report)
+                if asyncio.iscoroutine(result):
+                    await result
+
+        try:
+            batch = []
+            now = datetime.now()
+            # پلن در کوئری بک‌اند فیلتر می‌شود؛ زبان و فعالیت روی رکورد
+            # report.scanned = تعداد رکوردهای پیمایش‌شده با همین فیلتر تا نقطه بازیابی؛
+            # اگر کاربر last_id حذف شده باشد، بک‌اند JSON از همین موقعیت ادامه می‌دهد
+            for user_id, user in store.iter_users(after_id=last_id, plans=audience.plans or None,
+                                                  batch_size=self.page_size,
+                                                  after_position=report.scanned if last_id is not None else None):
+                report.scanned += 1
+                if audience.matches(user, now):
+                    report.matched += 1
+                    batch.append((user_id, user, 0))
+                if len(batch) >= self.checkpoint_every:
+                    await self._run_batch(batch + self._due_retries(retries, store), report, retries)
+                    last_id = user_id
+                    batch = []
+                    await checkpoint_now()
+                    now = datetime.now()
+                else:
+                    last_id = user_id
+            await self._run_batch(batch + self._due_retries(retries, store), report, retries)
+            await checkpoint_now()
+
+            # تلاش‌های باقی‌مانده (FloodWait یا خطای موقت)
+            while retries:
+                await asyncio.sleep(max(0.0, retries[0][0] - time.time()))
+                await self._run_batch(self._due_retries(retries, store), report, retries)
+                await checkpoint_now()
+
+            report.done = True
+            await checkpoint_now()
+        except asyncio.CancelledError:
+            # پیشرفت تا آخرین دسته کامل‌شده ذخیره است؛ دسته نیمه‌کاره در اجرای بعدی دوباره ارسال می‌شود
+            logger.info("ارسال همگانی %s متوقف شد؛ قابل ادامه از نقطه بازیابی", broadcast_id)
+            raise
+
+        logger.info(
+            "ارسال همگانی %s تمام شد: موفق %d، ناموفق %d، مسدود %d از %d (%.1f پیام در ثانیه)",
+            broadcast_id, report.sent, report.failed, report.blocked, report.matched, report.throughput
+        )
+        return report
+
+
+# ==================== توابع ارسال آماده ====================
+def _text_for(text, user: dict) -> str:
+    """text: یک متن ثابت یا دیکشنری زبان → متن"""
+    if isinstance(text, dict):
+        return text.get(user.get("language") or DEFAULT_LANGUAGE) or text.get(DEFAULT_LANGUAGE) or next(iter(text.values()))
+    return text
+
+
+def bot_sender(bot, text, parse_mode: str | None = "HTML"):
+    """ارسال با Bot در python-telegram-bot (bot.send_message)"""
+    async def send(user_id: int, user: dict):
+        await bot.send_message(chat_id=user_id, text=_text_for(text, user), parse_mode=parse_mode)
+    return send
+
+
+def client_sender(client, text, parse_mode: str | None = "html"):
+    """ارسال با کلاینت Telethon (client.send_message)"""
+    async def send(user_id: int, user: dict):
+        await client.send_message(user_id, _text_for(text, user), parse_mode=parse_mode)
+    return send
+
+
+def create_broadcast_engine(send, store=None) -> BroadcastEngine:
+    """موتور ارسال همگانی با تنظیمات بخش broadcast در config.json"""
+    config = load_config_section("broadcast")
+    burst = config.get("burst")
+    return BroadcastEngine(
+        send,
+        store=store,
+        rate=float(config.get("rate", 25.0)),
+        burst=float(burst) if burst is not None else None,
+        concurrency=int(config.get("concurrency", 8)),
+        min_retry_delay=float(config.get("min_retry_delay", 1.0)),
+        max_attempts=int(config.get("max_attempts", 3)),
+        retry_delay=float(config.get("retry_delay", 5.0)),
+        checkpoint_path=config.get("checkpoint_path") or BROADCAST_CHECKPOINT_FILE,
+        checkpoint_every=int(config.get("checkpoint_every", 100)),
+        page_size=int(config.get("page_size", 500)),
+    )
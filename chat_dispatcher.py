@@ -0,0 +1,166 @@
+# chat_dispatcher.py
+"""
+توزیع رویدادهای یوزربات فروش بین صف‌های FIFO هر چت و یک استخر محدود از کارگرها
+- پیام‌های یک چت به ترتیب و پشت سر هم پردازش می‌شوند (فیش از انتخاب پلن جلو نمی‌زند)
+- حداکثر max_workers هندلر هم‌زمان در حال کار هستند
+- فشار معکوس: با رسیدن تعداد پیام‌های معلق به max_pending، submit منتظر می‌ماند
+- صف چت‌های بیکار بعد از idle_timeout حذف می‌شود
+- مکث‌های نمایشی (pause) جایگاه کارگر را اشغال نمی‌کنند
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+
+from metrics import get_registry
+
+logger = logging.getLogger("PeakDispatcher")
+
+QUEUE_WAIT_SECONDS = get_registry().histogram(
+    "peak_sales_queue_wait_seconds", "زمان انتظار پیام در صف چت تا شروع پردازش")
+
+
+class _SlotLease:
+    """جایگاه کارگر task جاری؛ held=False یعنی در pause پس داده شده و هنوز دوباره گرفته نشده"""
+
+    __slots__ = ("slots", "held")
+
+    def __init__(self, slots: asyncio.Semaphore):
+        self.slots = slots
+        self.held = True
+
+
+# جایگاه کارگری که task فعلی در اختیار دارد (برای آزادسازی موقت در pause)
+_current_slot: contextvars.ContextVar[_SlotLease | None] = contextvars.ContextVar(
+    "peak_dispatch_slot", default=None)
+
+
+async def pause(seconds: float):
+    """
+    مکث نمایشی (مثلاً «در حال ضبط صدا…») بدون اشغال جایگاه کارگر
+    ترتیب پیام‌های همان چت حفظ می‌شود چون صف چت تا پایان هندلر منتظر می‌ماند
+    """
+    lease = _current_slot.get()
+    if lease is None or not lease.held:
+        await asyncio.sleep(seconds)
+        return
+    lease.held = False
+    lease.slots.release()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        # اگر گرفتن دوباره لغو شود، held=False می‌ماند و _drain جایگاهی آزاد نمی‌کند
+        await lease.slots.acquire()
+        lease.held = True
+
+
+class _ChatQueue:
+    __slots__ = ("items", "wakeup", "task", "handled")
+
+    def __init__(self):
+        self.items: deque = deque()
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.handled = 0
+
+
+class ChatDispatcher:
+    def __init__(self, handler, max_workers: int = 8, max_pending: int = 1000, idle_timeout: float = 30.0):
+        """handler: تابع async که برای هر آیتم صدا زده می‌شود"""
+        self.handler = handler
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+        self._slots = asyncio.Semaphore(max_workers)
+        self._capacity = asyncio.Semaphore(max_pending)
+        self._queues: dict[int, _ChatQueue] = {}
+        self._pending = 0
+        self._busy = 0
+        self.stats = {"submitted": 0, "handled": 0, "errors": 0, "backpressure_waits": 0, "reaped": 0}
+
+        registry = get_registry()
+        registry.gauge("peak_sales_queue_depth", "پیام‌های معلق در همه صف‌های چت",
+                       callback=lambda: self._pending)
+        registry.gauge("peak_sales_active_chats", "تعداد صف‌های چت فعال",
+                       callback=lambda: len(self._queues))
+        registry.gauge("peak_sales_busy_workers", "هندلرهای در حال اجرا (شامل مکث‌های نمایشی)",
+                       callback=lambda: self._busy)
+
+    async def submit(self, chat_id: int, item):
+        """افزودن به صف چت؛ در صورت پر بودن ظرفیت کل، تا آزاد شدن جا منتظر می‌ماند"""
+        if self._capacity.locked():
+            self.stats["backpressure_waits"] += 1
+        await self._capacity.acquire()
+
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = _ChatQueue()
+        queue.items.append((item, time.perf_counter()))
+        self._pending += 1
+        self.stats["submitted"] += 1
+        if queue.task is None or queue.task.done():
+            queue.task = asyncio.get_running_loop().create_task(self._drain(chat_id, queue))
+        else:
+            queue.wakeup.set()
+
+    async def _drain(self, chat_id: int, queue: _ChatQueue):
+        """پردازش ترتیبی صف یک چت؛ بعد از idle_timeout بیکاری، صف حذف می‌شود"""
+        while True:
+            if not queue.items:
+                queue.wakeup.clear()
+                try:
+                    await asyncio.wait_for(queue.wakeup.wait(), timeout=self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if not queue.items:
+                        if self._queues.get(chat_id) is queue:
+                            del self._queues[chat_id]
+                        self.stats["reaped"] += 1
+                        return
+                continue
+
+            item, enqueued_at = queue.items.popleft()
+            await self._slots.acquire()
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - enqueued_at)
+            lease = _SlotLease(self._slots)
+            token = _current_slot.set(lease)
+            self._busy += 1
+            try:
+                await self.handler(item)
+                self.stats["handled"] += 1
+                queue.handled += 1
+            except Exception:
+                self.stats["errors"] += 1
+                logger.exception("خطا در پردازش پیام چت %s", chat_id)
+            finally:
+                self._busy -= 1
+                _current_slot.reset(token)
+                if lease.held:
+                    self._slots.release()
+                self._pending -= 1
+                self._capacity.release()
+
+    async def join(self, timeout: float | None = None):
+        """انتظار تا خالی شدن همه صف‌ها (برای خاموش شدن)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._pending:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(0.05)
+
+    async def close(self):
+        tasks = [queue.task for queue in self._queues.values() if queue.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._queues.clear()
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "pending": self._pending,
+            "active_chats": len(self._queues),
+            "busy_workers": self._busy,
+            "deepest_queue": max((len(q.items) for q in self._queues.values()), default=0),
+        }
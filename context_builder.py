@@ -0,0 +1,178 @@
+# context_builder.py
+"""
+سازنده زمینه گفتگو برای PeakAI
+- جمع‌آوری آخرین نوبت‌های گفتگو در سقف بودجه توکن
+- تخمین سریع و محلی تعداد توکن (بدون tokenizer خارجی)
+- خلاصه غلتان (rolling) نوبت‌های قدیمی‌تر که به صورت تدریجی به‌روز و برای هر گفتگو کش می‌شود
+نتیجه: اندازه prompt و تأخیر محدود و قابل پیش‌بینی می‌ماند
+"""
+
+import re
+import threading
+from collections import OrderedDict, deque
+
+from conversations import ConversationStore, get_conversation_store
+from storage import load_config_section
+
+# سربار تقریبی هر پیام در قالب چت (نقش، جداکننده‌ها)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?؟\n])\s")
+
+ROLE_LABELS = {"user": "کاربر", "assistant": "دستیار"}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    تخمین تعداد توکن: حدود ۴ کاراکتر لاتین یا ۲ کاراکتر فارسی برای هر توکن
+    تعداد کاراکترهای غیر ASCII از اختلاف طول بایتی UTF-8 به دست می‌آید (محاسبه در C، بسیار سریع)
+    """
+    if not text:
+        return 0
+    non_ascii = len(text.encode("utf-8")) - len(text)
+    ascii_chars = max(0, len(text) - non_ascii)
+    return ascii_chars // 4 + non_ascii // 2 + 1
+
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def _summary_line(message: dict, max_chars: int = 160) -> str:
+    """خلاصه استخراجی یک نوبت: اولین جمله، کوتاه‌شده"""
+    content = " ".join((message.get("content") or "").split())
+    first = _SENTENCE_END_RE.split(content, maxsplit=1)[0]
+    if len(first) > max_chars:
+        first = first[:max_chars].rstrip() + "…"
+    return f"{ROLE_LABELS.get(message.get('role'), message.get('role'))}: {first}"
+
+
+class _RollingSummary:
+    __slots__ = ("upto_id", "lines", "tokens")
+
+    def __init__(self):
+        self.upto_id = 0
+        self.lines: deque = deque()
+        self.tokens = 0
+
+
+class ContextBuilder:
+    def __init__(
+        self,
+        store: ConversationStore | None = None,
+        token_budget: int = 3000,
+        summary_tokens: int = 400,
+        max_recent_messages: int = 40,
+        max_cached_summaries: int = 5000,
+    ):
+        self.store = store or get_conversation_store()
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.max_recent_messages = max_recent_messages
+        self.max_cached_summaries = max_cached_summaries
+        self._summaries: "OrderedDict[str, _RollingSummary]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _summary_for(self, conversation_id: str) -> _RollingSummary:
+        summary = self._summaries.get(conversation_id)
+        if summary is None:
+            summary = self._summaries[conversation_id] = _RollingSummary()
+            while len(self._summaries) > self.max_cached_summaries:
+                self._summaries.popitem(last=False)
+        else:
+            self._summaries.move_to_end(conversation_id)
+        return summary
+
+    def _summarized_upto(self, conversation_id: str) -> int:
+        """شناسه آخرین پیامی که خلاصه کش‌شده تا آن را پوشش می‌دهد (۰ یعنی خلاصه‌ای وجود ندارد)"""
+        with self._lock:
+            summary = self._summaries.get(conversation_id)
+            return summary.upto_id if summary is not None else 0
+
+    def _update_summary(self, user_id: int, conversation_id: str, boundary_id: int) -> str:
+        """
+        افزودن نوبت‌هایی که از پنجره اخیر بیرون افتاده‌اند (id < boundary_id) به خلاصه
+        فقط پیام‌های جدید نسبت به دفعه قبل خوانده می‌شوند
+        """
+        with self._lock:
+            summary = self._summary_for(conversation_id)
+            if boundary_id - 1 > summary.upto_id:
+                older = self.store.get_messages(
+                    user_id, conversation_id, limit=self.max_recent_messages * 2,
+                    before_id=boundary_id, after_id=summary.upto_id
+                )
+                for message in older:
+                    line = _summary_line(message)
+                    summary.lines.append(line)
+                    summary.tokens += estimate_tokens(line) + 1
+                summary.upto_id = boundary_id - 1
+                # قدیمی‌ترین خطوط خلاصه در صورت عبور از بودجه حذف می‌شوند
+                while summary.lines and summary.tokens > self.summary_tokens:
+                    summary.tokens -= estimate_tokens(summary.lines.popleft()) + 1
+            return "\n".join(summary.lines)
+
+    def build(self, user_id: int, conversation_id: str, system_prompt: str, user_message: str) -> list:
+        """
+        ساخت پیام‌های درخواست: system (+ خلاصه قبلی) + نوبت‌های اخیر در بودجه + پیام فعلی
+        """
+        recent = self.store.get_messages(user_id, conversation_id, limit=self.max_recent_messages)
+        # اگر پیام فعلی قبلاً در تاریخچه ذخیره شده، دوباره اضافه نمی‌شود
+        if recent and recent[-1].get("role") == "user" and recent[-1].get("content") == user_message:
+            recent = recent[:-1]
+        # پنجره عین متن همیشه بعد از بخش خلاصه‌شده شروع می‌شود (هیچ نوبتی دو بار در prompt نمی‌آید)
+        summarized_upto = self._summarized_upto(conversation_id)
+        if summarized_upto:
+            recent = [m for m in recent if m["id"] > summarized_upto]
+
+        fixed = (estimate_tokens(system_prompt) + estimate_tokens(user_message)
+                 + 2 * MESSAGE_OVERHEAD_TOKENS + self.summary_tokens)
+        budget = max(0, self.token_budget - fixed)
+
+        selected = []
+        used = 0
+        for message in reversed(recent):
+            cost = message_tokens(message)
+            if used + cost > budget:
+                break
+            selected.append(message)
+            used += cost
+        selected.reverse()
+
+        if selected:
+            boundary_id = selected[0]["id"]
+        elif recent:
+            boundary_id = recent[-1]["id"] + 1
+        else:
+            boundary_id = summarized_upto + 1 if summarized_upto else 0
+        summary = self._update_summary(user_id, conversation_id, boundary_id) if boundary_id else ""
+
+        system_content = system_prompt
+        if summary:
+            system_content += "\n\nخلاصه بخش‌های قبلی گفتگو:\n" + summary
+
+        return [
+            {"role": "system", "content": system_content},
+            *({"role": m["role"], "content": m["content"]} for m in selected),
+            {"role": "user", "content": user_message},
+        ]
+
+    def forget(self, conversation_id: str):
+        """حذف خلاصه کش‌شده (مثلاً بعد از حذف گفتگو)"""
+        with self._lock:
+            self._summaries.pop(conversation_id, None)
+
+
+_builder: ContextBuilder | None = None
+
+
+def get_context_builder() -> ContextBuilder:
+    """سازنده مشترک پروسه (تنظیمات از بخش ai_context در config.json)"""
+    global _builder
+    if _builder is None:
+        config = load_config_section("ai_context")
+        _builder = ContextBuilder(
+            token_budget=int(config.get("token_budget", 3000)),
+            summary_tokens=int(config.get("summary_tokens", 400)),
+            max_recent_messages=int(config.get("max_recent_messages", 40)),
+        )
+    return _builder
@@ -0,0 +1,284 @@
+# conversations.py
+"""
+ذخیره‌سازی گفتگوهای پشتیبانی هوشمند (ai_conversations) جدا از رکورد کاربر
+جدول‌های SQLite فقط-افزودنی با ایندکس (user_id, conversation_id, timestamp)
+- فهرست صفحه‌بندی‌شده برای صفحات ai_history_*
+- بارگذاری تنبل پیام‌های هر گفتگو (صفحه به صفحه)
+- نگهداری محدود (retention) و فشرده‌سازی
+"""
+
+import json
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from storage import DEFAULT_DB_FILE, load_config_section
+
+
+class ConversationStore:
+    def __init__(self, db_path: str = DEFAULT_DB_FILE):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS ai_conversations (
+                    conversation_id TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    title TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    message_count INTEGER NOT NULL DEFAULT 0,
+                    extra TEXT NOT NULL DEFAULT '{}'
+                );
+                CREATE INDEX IF NOT EXISTS idx_conv_user_updated
+                    ON ai_conversations(user_id, updated_at);
+
+                CREATE TABLE IF NOT EXISTS ai_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    conversation_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_msg_user_conv_ts
+                    ON ai_messages(user_id, conversation_id, timestamp);
+                CREATE INDEX IF NOT EXISTS idx_msg_conv_id
+                    ON ai_messages(conversation_id, id);
+            """)
+
+    # ---------- نوشتن ----------
+    def create_conversation(self, user_id: int, title: str = "", conversation_id: str | None = None,
+                            created_at: str | None = None, extra: dict | None = None) -> str:
+        conversation_id = conversation_id or str(uuid.uuid4())
+        now_iso = created_at or datetime.now().isoformat()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO ai_conversations "
+                "(conversation_id, user_id, title, created_at, updated_at, extra) VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, int(user_id), title, now_iso, now_iso,
+                 json.dumps(extra or {}, ensure_ascii=False))
+            )
+        return conversation_id
+
+    def append_message(self, user_id: int, conversation_id: str, role: str, content: str,
+                       timestamp: str | None = None, title: str = ""):
+        """افزودن یک پیام؛ اگر گفتگو وجود نداشت ساخته می‌شود"""
+        timestamp = timestamp or datetime.now().isoformat()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO ai_conversations "
+                    "(conversation_id, user_id, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (conversation_id, int(user_id), title or content[:40], timestamp, timestamp)
+                )
+                self._conn.execute(
+                    "INSERT INTO ai_messages (user_id, conversation_id, role, content, timestamp) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (int(user_id), conversation_id, role, content, timestamp)
+                )
+                self._conn.execute(
+                    "UPDATE ai_conversations SET updated_at = ?, message_count = message_count + 1 "
+                    "WHERE conversation_id = ?",
+                    (timestamp, conversation_id)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def import_conversations(self, user_id: int, conversations: list) -> int:
+        """وارد کردن ai_conversations قدیمی یک کاربر (ساختار users.json)؛ بازگشت: تعداد پیام‌ها"""
+        imported = 0
+        for conv in conversations or []:
+            conversation_id = conv.get("conversation_id") or str(uuid.uuid4())
+            messages = conv.get("messages") or []
+            extra = {k: v for k, v in conv.items()
+                     if k not in ("conversation_id", "user_id", "title", "messages", "created_at", "updated_at")}
+            created_at = conv.get("created_at") or (messages[0].get("timestamp") if messages else None)
+            with self._lock:
+                exists = self._conn.execute(
+                    "SELECT 1 FROM ai_conversations WHERE conversation_id = ?", (conversation_id,)
+                ).fetchone()
+            if exists:
+                continue
+            self.create_conversation(user_id, conv.get("title", ""), conversation_id, created_at, extra)
+            for msg in messages:
+                self.append_message(
+                    user_id, conversation_id, msg.get("role", "user"), msg.get("content", ""),
+                    msg.get("timestamp")
+                )
+                imported += 1
+        return imported
+
+    def delete_conversation(self, user_id: int, conversation_id: str) -> bool:
+        """حذف گفتگو فقط توسط صاحب آن؛ بازگشت: آیا حذف شد"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                cur = self._conn.execute(
+                    "DELETE FROM ai_conversations WHERE conversation_id = ? AND user_id = ?",
+                    (conversation_id, int(user_id))
+                )
+                if cur.rowcount:
+                    self._conn.execute(
+                        "DELETE FROM ai_messages WHERE conversation_id = ?", (conversation_id,)
+                    )
+                self._conn.execute("COMMIT")
+                return cur.rowcount > 0
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # ---------- خواندن ----------
+    @staticmethod
+    def _conv_row(row) -> dict:
+        conv = json.loads(row[6]) if row[6] else {}
+        conv.update({
+            "conversation_id": row[0],
+            "user_id": row[1],
+            "title": row[2],
+            "created_at": row[3],
+            "updated_at": row[4],
+            "message_count": row[5],
+        })
+        return conv
+
+    _SELECT_CONV = ("SELECT conversation_id, user_id, title, created_at, updated_at, message_count, extra "
+                    "FROM ai_conversations")
+
+    def list_conversations(self, user_id: int, page: int = 0, page_size: int = 10) -> tuple[list, int]:
+        """
+        فهرست گفتگوهای کاربر (جدیدترین اول) بدون بارگذاری پیام‌ها
+        بازگشت: (گفتگوهای این صفحه، تعداد کل)
+        """
+        with self._lock:
+            total = self._conn.execute(
+                "SELECT COUNT(*) FROM ai_conversations WHERE user_id = ?", (int(user_id),)
+            ).fetchone()[0]
+            rows = self._conn.execute(
+                self._SELECT_CONV + " WHERE user_id = ? ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+                (int(user_id), page_size, page * page_size)
+            ).fetchall()
+        return [self._conv_row(row) for row in rows], total
+
+    def get_conversation(self, user_id: int, conversation_id: str) -> dict | None:
+        """اطلاعات گفتگو؛ اگر متعلق به کاربر نباشد None (برای ai_history_access_denied)"""
+        with self._lock:
+            row = self._conn.execute(
+                self._SELECT_CONV + " WHERE conversation_id = ? AND user_id = ?",
+                (conversation_id, int(user_id))
+            ).fetchone()
+        return self._conv_row(row) if row else None
+
+    def get_messages(self, user_id: int, conversation_id: str, limit: int = 50,
+                     before_id: int | None = None, after_id: int | None = None) -> list:
+        """
+        آخرین پیام‌های یک گفتگو به ترتیب زمانی (بارگذاری تنبل)
+        برای صفحه قبلی، کوچک‌ترین id همین صفحه را به عنوان before_id بدهید
+        after_id: فقط پیام‌های با id بزرگ‌تر (برای به‌روزرسانی تدریجی)
+        """
+        query = ("SELECT id, role, content, timestamp FROM ai_messages "
+                 "WHERE user_id = ? AND conversation_id = ?")
+        params: list = [int(user_id), conversation_id]
+        if before_id is not None:
+            query += " AND id < ?"
+            params.append(before_id)
+        if after_id is not None:
+            query += " AND id > ?"
+            params.append(after_id)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            {
+                "id": row[0],
+                "role": row[1],
+                "content": row[2],
+                "timestamp": row[3],
+                "user_id": int(user_id),
+                "conversation_id": conversation_id,
+            }
+            for row in reversed(rows)
+        ]
+
+    # ---------- نگهداری ----------
+    def compact(self, retention_days: int | None = None, max_messages_per_conversation: int | None = None,
+                vacuum: bool = False) -> int:
+        """
+        حذف گفتگوهای قدیمی‌تر از retention_days و پیام‌های اضافه هر گفتگو
+        بازگشت: تعداد پیام‌های حذف‌شده
+        """
+        removed = 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if retention_days:
+                    cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat()
+                    removed += self._conn.execute(
+                        "DELETE FROM ai_messages WHERE conversation_id IN "
+                        "(SELECT conversation_id FROM ai_conversations WHERE updated_at < ?)",
+                        (cutoff,)
+                    ).rowcount
+                    self._conn.execute("DELETE FROM ai_conversations WHERE updated_at < ?", (cutoff,))
+                if max_messages_per_conversation:
+                    removed += self._conn.execute(
+                        "DELETE FROM ai_messages WHERE id IN ("
+                        " SELECT id FROM (SELECT id, ROW_NUMBER() OVER ("
+                        "  PARTITION BY conversation_id ORDER BY id DESC) AS rn FROM ai_messages)"
+                        " WHERE rn > ?)",
+                        (max_messages_per_conversation,)
+                    ).rowcount
+                    self._conn.execute(
+                        "UPDATE ai_conversations SET message_count = (SELECT COUNT(*) FROM ai_messages "
+                        "WHERE ai_messages.conversation_id = ai_conversations.conversation_id)"
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            if vacuum:
+                self._conn.execute("VACUUM")
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def load_conversations_config() -> dict:
+    """بخش conversations در config.json (مسیر دیتابیس و سیاست نگهداری)"""
+    return load_config_section("conversations")
+
+
+def get_conversation_store() -> ConversationStore:
+    """فروشگاه گفتگوها (یک نمونه برای کل پروسه)"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = load_conversations_config()
+                _store = ConversationStore(config.get("db_path") or DEFAULT_DB_FILE)
+    return _store
+
+
+def compact_conversations() -> int:
+    """فشرده‌سازی طبق سیاست نگهداری config.json"""
+    config = load_conversations_config()
+    return get_conversation_store().compact(
+        retention_days=config.get("retention_days"),
+        max_messages_per_conversation=config.get("max_messages_per_conversation"),
+    )
@@ -0,0 +1,186 @@
+# health_monitor.py
+"""
+پایشگر سلامت OpenRouter در پس‌زمینه
+- پروب سبک دوره‌ای (اطلاعات کلید API به جای کل فهرست مدل‌ها)
+- نگهداری نتیجه و صدک‌های تأخیر در حافظه ← check_health بدون I/O شبکه و O(1)
+- کش فهرست مدل‌ها با اعتبارسنجی مجدد ETag / If-None-Match
+- تغذیه مسیریاب مدل‌ها با وضعیت سلامت و تأخیر
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+import httpx
+
+from http_client import SharedHTTPClient, get_shared_client
+from model_router import ModelRouter
+from storage import load_config_section
+
+logger = logging.getLogger("PeakHealth")
+
+PROBE_URL = "https://openrouter.ai/api/v1/auth/key"
+MODELS_URL = "https://openrouter.ai/api/v1/models"
+
+
+async def probe(http: SharedHTTPClient, api_key: str, timeout: float = 10.0) -> tuple[bool, int | None, float]:
+    """یک پروب سبک؛ بازگشت: (سالم، کد وضعیت، تأخیر به ثانیه)"""
+    start = time.perf_counter()
+    try:
+        resp = await http.get(PROBE_URL, headers={"Authorization": f"Bearer {api_key}"}, timeout=timeout)
+        return resp.status_code == 200, resp.status_code, time.perf_counter() - start
+    except httpx.RequestError as e:
+        logger.warning("پروب سلامت ناموفق: %s", e)
+        return False, None, time.perf_counter() - start
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class HealthMonitor:
+    def __init__(
+        self,
+        api_key: str,
+        http_client: SharedHTTPClient | None = None,
+        router: ModelRouter | None = None,
+        interval: float = 30.0,
+        catalogue_interval: float = 3600.0,
+    ):
+        self.api_key = api_key.strip()
+        self.http = http_client or get_shared_client()
+        self.router = router
+        self.interval = interval
+        self.catalogue_interval = catalogue_interval
+
+        self.healthy: bool | None = None
+        self.last_status: int | None = None
+        self.last_checked: float | None = None
+        self._latencies: deque = deque(maxlen=200)
+
+        self._models: list | None = None
+        self._models_etag: str | None = None
+        self._models_fetched: float = 0.0
+        self._task: asyncio.Task | None = None
+        self.stats = {"probes": 0, "failures": 0, "catalogue_fetches": 0, "catalogue_not_modified": 0}
+
+    # ---------- پروب ----------
+    async def check_now(self) -> bool:
+        healthy, status, latency = await probe(self.http, self.api_key)
+        self.healthy = healthy
+        self.last_status = status
+        self.last_checked = time.time()
+        self._latencies.append(latency)
+        self.stats["probes"] += 1
+        if not healthy:
+            self.stats["failures"] += 1
+            logger.warning("OpenRouter ناسالم → کد: %s | تأخیر: %.3f ثانیه", status, latency)
+        if self.router is not None:
+            self.router.record_health(healthy, latency)
+        return healthy
+
+    def is_healthy(self) -> bool:
+        """وضعیت کش‌شده (تا اولین پروب، سالم فرض می‌شود)"""
+        return self.healthy is not False
+
+    def latency_percentiles(self) -> dict:
+        values = sorted(self._latencies)
+        return {
+            "p50": _percentile(values, 0.50),
+            "p95": _percentile(values, 0.95),
+            "p99": _percentile(values, 0.99),
+        }
+
+    def status(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "last_status": self.last_status,
+            "last_checked": self.last_checked,
+            "latency": self.latency_percentiles(),
+            "models_cached": len(self._models or []),
+            **self.stats,
+        }
+
+    # ---------- فهرست مدل‌ها ----------
+    async def get_models(self, force: bool = False) -> list:
+        """فهرست مدل‌ها از کش؛ در صورت قدیمی بودن با If-None-Match اعتبارسنجی می‌شود"""
+        fresh = self._models is not None and time.time() - self._models_fetched < self.catalogue_interval
+        if fresh and not force:
+            return self._models
+
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        if self._models_etag and self._models is not None:
+            headers["If-None-Match"] = self._models_etag
+        try:
+            resp = await self.http.get(MODELS_URL, headers=headers, timeout=20.0)
+        except httpx.RequestError as e:
+            logger.warning("دریافت فهرست مدل‌ها ناموفق: %s", e)
+            return self._models or []
+
+        self._models_fetched = time.time()
+        if resp.status_code == 304:
+            self.stats["catalogue_not_modified"] += 1
+        elif resp.status_code == 200:
+            self.stats["catalogue_fetches"] += 1
+            self._models = resp.json().get("data", [])
+            self._models_etag = resp.headers.get("etag")
+        else:
+            logger.warning("دریافت فهرست مدل‌ها → کد: %d", resp.status_code)
+        return self._models or []
+
+    async def model_available(self, model: str) -> bool:
+        return any(item.get("id") == model for item in await self.get_models())
+
+    # ---------- تسک پس‌زمینه ----------
+    async def _loop(self):
+        while True:
+            try:
+                await self.check_now()
+            except Exception:
+                logger.exception("خطای غیرمنتظره در پایش سلامت")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """شروع پایش دوره‌ای (باید داخل event loop فراخوانی شود)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+
+_monitor: HealthMonitor | None = None
+
+
+def start_health_monitor(api_key: str, router: ModelRouter | None = None) -> HealthMonitor:
+    """ساخت و شروع پایشگر مشترک پروسه (تنظیمات از بخش health در config.json)"""
+    global _monitor
+    if _monitor is None:
+        config = load_config_section("health")
+        _monitor = HealthMonitor(
+            api_key,
+            router=router,
+            interval=float(config.get("interval", 30.0)),
+            catalogue_interval=float(config.get("catalogue_interval", 3600.0)),
+        )
+    _monitor.start()
+    return _monitor
+
+
+def get_health_monitor() -> HealthMonitor | None:
+    """پایشگر مشترک در صورت راه‌اندازی"""
+    return _monitor
@@ -0,0 +1,118 @@
+# http_client.py
+"""
+کلاینت HTTP مشترک برای PeakAI و SalesAI
+یک httpx.AsyncClient با HTTP/2، استخر اتصال محدود و keep-alive؛
+به جای ساختن کلاینت جدید (DNS + TCP + TLS) برای هر درخواست
+"""
+
+import logging
+from contextlib import asynccontextmanager
+
+import httpx
+
+from storage import load_config_section
+
+logger = logging.getLogger("PeakHTTP")
+
+try:
+    import h2  # noqa: F401  (پشتیبانی HTTP/2 در httpx به این بسته نیاز دارد)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class SharedHTTPClient:
+    def __init__(
+        self,
+        http2: bool = True,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 60.0,
+        connect_timeout: float = 10.0,
+        timeout: float = 120.0,
+    ):
+        self.http2 = http2 and HTTP2_AVAILABLE
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("بسته h2 نصب نیست؛ کلاینت مشترک با HTTP/1.1 کار می‌کند")
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._client: httpx.AsyncClient | None = None
+
+        # آمار استفاده مجدد از اتصال
+        self.requests = 0
+        self.new_connections = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """کلاینت زیرین (در صورت بسته بودن دوباره ساخته می‌شود)"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(http2=self.http2, limits=self.limits, timeout=self.timeout)
+        return self._client
+
+    async def _trace(self, event_name: str, info: dict):
+        # هر اتصال TCP جدید یک بار این رویداد را تولید می‌کند؛ درخواست‌های روی اتصال باز آن را ندارند
+        if event_name == "connection.connect_tcp.complete":
+            self.new_connections += 1
+
+    def _extensions(self, kwargs: dict) -> dict:
+        extensions = dict(kwargs.pop("extensions", None) or {})
+        extensions.setdefault("trace", self._trace)
+        return extensions
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        self.requests += 1
+        return await self.client.get(url, extensions=self._extensions(kwargs), **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        self.requests += 1
+        return await self.client.post(url, extensions=self._extensions(kwargs), **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs):
+        """درخواست استریم واقعی (بدنه پاسخ به صورت تدریجی خوانده می‌شود)"""
+        self.requests += 1
+        async with self.client.stream(method, url, extensions=self._extensions(kwargs), **kwargs) as response:
+            yield response
+
+    def metrics(self) -> dict:
+        reuse_rate = 1.0 - (self.new_connections / self.requests) if self.requests else 0.0
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "connection_reuse_rate": round(max(0.0, reuse_rate), 4),
+            "http2": self.http2,
+        }
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+
+_shared_client: SharedHTTPClient | None = None
+
+
+def get_shared_client() -> SharedHTTPClient:
+    """کلاینت مشترک پروسه (تنظیمات از بخش http در config.json)"""
+    global _shared_client
+    if _shared_client is None:
+        config = load_config_section("http")
+        _shared_client = SharedHTTPClient(
+            http2=config.get("http2", True),
+            max_connections=config.get("max_connections", 20),
+            max_keepalive_connections=config.get("max_keepalive_connections", 10),
+            keepalive_expiry=config.get("keepalive_expiry", 60.0),
+        )
+    return _shared_client
+
+
+async def close_shared_client():
+    """بستن کلاینت مشترک هنگام خاموش شدن ربات"""
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.aclose()
+        _shared_client = None
@@ -0,0 +1,110 @@
+# intent_matcher.py
+"""
+تشخیص نیت (دسته کلمات کلیدی) پیام‌های فروش در یک گذر روی متن
+- اتوماتای Aho-Corasick یک بار هنگام شروع برنامه ساخته می‌شود
+- همه دسته‌های یافت‌شده همراه با موقعیت برگردانده می‌شوند (تطبیق‌های هم‌پوشان هم گزارش می‌شوند)
+- نرمال‌سازی فارسی/عربی (ی/ي، ک/ك، نیم‌فاصله، ارقام فارسی و عربی، اعراب و کشیده)
+"""
+
+from collections import deque
+from dataclasses import dataclass
+
+# ی/ک عربی و ارقام فارسی/عربی → معادل استاندارد؛ نیم‌فاصله و فاصله‌های خاص → فاصله
+_CHAR_MAP = str.maketrans({
+    "\u064a": "\u06cc", "\u0649": "\u06cc",   # ي ى → ی
+    "\u0643": "\u06a9",                     # ك → ک
+    "\u0629": "\u0647", "\u06c0": "\u0647",   # ة ۀ → ه
+    "\u0623": "\u0627", "\u0625": "\u0627",   # أ إ → ا
+    "\u200c": " ", "\u00a0": " ",           # نیم‌فاصله و فاصله نشکن
+    "\u200d": None, "\u200e": None, "\u200f": None,
+    **{chr(0x06F0 + i): str(i) for i in range(10)},   # ۰-۹
+    **{chr(0x0660 + i): str(i) for i in range(10)},   # ٠-٩
+})
+
+# اعراب (فتحه، کسره، تنوین، تشدید، ...) و کشیده
+_DROP_CHARS = {chr(c) for c in range(0x064B, 0x0660)} | {"\u0670", "\u0640"}
+
+
+def normalize_text(text: str) -> str:
+    """نرمال‌سازی متن برای تطبیق کلمات کلیدی (حروف کوچک، یکسان‌سازی حروف، فشرده‌سازی فاصله‌ها)"""
+    text = text.lower().translate(_CHAR_MAP)
+    text = "".join(ch for ch in text if ch not in _DROP_CHARS)
+    return " ".join(text.split())
+
+
+@dataclass(frozen=True)
+class IntentMatch:
+    category: str
+    keyword: str
+    start: int   # موقعیت در متن نرمال‌شده
+    end: int
+
+
+class IntentMatcher:
+    def __init__(self, keywords: dict[str, list[str]]):
+        """keywords: دسته → لیست کلمات/عبارات کلیدی (به همان ترتیب اولویت دسته‌ها)"""
+        self.categories_order = list(keywords)
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[list[tuple[str, str]]] = [[]]
+        for category, words in keywords.items():
+            for word in words:
+                normalized = normalize_text(word)
+                if normalized:
+                    self._add(normalized, category)
+        self._build_failure_links()
+
+    def _add(self, word: str, category: str):
+        state = 0
+        for ch in word:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        if (category, word) not in self._output[state]:
+            self._output[state].append((category, word))
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                # خروجی‌های حالت fail هم در این حالت معتبرند
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def find(self, text: str, normalized: bool = False) -> list[IntentMatch]:
+        """همه تطبیق‌ها در یک گذر (موقعیت‌ها نسبت به متن نرمال‌شده)"""
+        if not normalized:
+            text = normalize_text(text)
+        goto, fail, output = self._goto, self._fail, self._output
+        matches = []
+        state = 0
+        for index, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for category, word in output[state]:
+                matches.append(IntentMatch(category, word, index + 1 - len(word), index + 1))
+        return matches
+
+    def categories(self, text: str) -> set[str]:
+        """مجموعه دسته‌های یافت‌شده در متن"""
+        return {match.category for match in self.find(text)}
+
+    def classify(self, text: str) -> str | None:
+        """اولین دسته یافت‌شده به ترتیب اولویت تعریف‌شده در keywords"""
+        found = self.categories(text)
+        for category in self.categories_order:
+            if category in found:
+                return category
+        return None
@@ -0,0 +1,208 @@
+# log_setup.py
+"""
+راه‌اندازی لاگ‌گیری غیرمسدودکننده برای ماژول‌های PeakAI / SalesAI
+- فقط لاگر ریشه QueueHandler دارد و همه لاگرها (PeakHTTP، PeakScheduler، ...) از طریق propagate به آن می‌رسند؛
+  نوشتن فایل و کنسول در نخ جداگانه QueueListener انجام می‌شود
+- چرخش فایل بر اساس حجم یا زمان و فشرده‌سازی gzip فایل‌های قدیمی
+- سطح لاگ در زمان اجرا قابل تغییر است (set_log_level یا متغیر محیطی PEAK_LOG_LEVEL)
+- قالب اختیاری JSON-lines با شناسه درخواست و فیلدهای تأخیر
+وارد کردن ماژول‌ها هیچ فایلی باز نمی‌کند؛ setup_logging() باید در نقطه شروع برنامه صدا زده شود
+"""
+
+import atexit
+import contextvars
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import uuid
+from datetime import datetime, timezone
+
+from storage import load_config_section
+
+TEXT_FORMAT = "[%(asctime)s.%(msecs)03d] [%(levelname)s] [%(name)s] [%(funcName)s:%(lineno)d] %(message)s"
+TEXT_DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+# لاگر → فایل مقصد
+DEFAULT_FILES = {
+    "PeakAI": "peak_ai.log",
+    "SalesAI": "peak_sales_ai.log",
+}
+
+# فایل لاگرهایی که در files فایل اختصاصی ندارند
+DEFAULT_CATCH_ALL_FILE = "peak.log"
+
+# فیلدهای اضافه‌ای که از طریق extra=... به رکورد اضافه شده و در JSON نوشته می‌شوند
+EXTRA_FIELDS = ("request_id", "latency", "ttft", "task", "model", "chars", "status")
+
+# شناسه درخواست جاری (در هر task جداگانه)
+request_id_var: contextvars.ContextVar[str | None] = contextvars.ContextVar("peak_request_id", default=None)
+
+_listener: logging.handlers.QueueListener | None = None
+_configured_loggers: list[str] = []
+
+
+def new_request_id() -> str:
+    """ساخت و ثبت شناسه درخواست برای task جاری"""
+    request_id = uuid.uuid4().hex[:12]
+    request_id_var.set(request_id)
+    return request_id
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "request_id", None) is None:
+            record.request_id = request_id_var.get()
+        return True
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "func": record.funcName,
+            "msg": record.getMessage(),
+        }
+        for name in EXTRA_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _gzip_namer(name: str) -> str:
+    return name + ".gz"
+
+
+def _gzip_rotator(source: str, dest: str):
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def _file_handler(path: str, config: dict) -> logging.Handler:
+    backup_count = int(config.get("backup_count", 5))
+    if config.get("rotation", "size") == "time":
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path, when=config.get("when", "midnight"), backupCount=backup_count,
+            encoding="utf-8", utc=True
+        )
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=int(config.get("max_bytes", 10 * 1024 * 1024)),
+            backupCount=backup_count, encoding="utf-8"
+        )
+    if config.get("compress", True):
+        handler.namer = _gzip_namer
+        handler.rotator = _gzip_rotator
+    return handler
+
+
+class _LoggerNameFilter(logging.Filter):
+    """هر فایل فقط رکوردهای لاگر(های) خودش را می‌نویسد"""
+
+    def __init__(self, name: str):
+        super().__init__()
+        self.logger_name = name
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.name == self.logger_name or record.name.startswith(self.logger_name + ".")
+
+
+class _UnclaimedFilter(logging.Filter):
+    """فایل عمومی فقط رکوردهایی را می‌نویسد که فایل اختصاصی ندارند"""
+
+    def __init__(self, names):
+        super().__init__()
+        self.claimed = [_LoggerNameFilter(name) for name in names]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not any(claimed.filter(record) for claimed in self.claimed)
+
+
+def setup_logging(config: dict | None = None) -> logging.handlers.QueueListener:
+    """
+    راه‌اندازی (یک‌باره) خط لوله لاگ؛ فراخوانی مجدد همان listener قبلی را برمی‌گرداند
+    تنظیمات از بخش logging در config.json خوانده می‌شود
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    config = config if config is not None else load_config_section("logging")
+    if config.get("format", "text") == "json":
+        formatter = JsonLinesFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, datefmt=TEXT_DATEFMT)
+
+    handlers = []
+    files = config.get("files", DEFAULT_FILES)
+    for name, path in files.items():
+        handler = _file_handler(path, config)
+        handler.setFormatter(formatter)
+        handler.addFilter(_LoggerNameFilter(name))
+        handlers.append(handler)
+
+    catch_all = config.get("default_file", DEFAULT_CATCH_ALL_FILE)
+    if catch_all:
+        handler = _file_handler(catch_all, config)
+        handler.setFormatter(formatter)
+        handler.addFilter(_UnclaimedFilter(files))
+        handlers.append(handler)
+
+    if config.get("console", True):
+        console = logging.StreamHandler()
+        console.setLevel(config.get("console_level", "INFO").upper())
+        console.setFormatter(formatter)
+        handlers.append(console)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    level = os.environ.get("PEAK_LOG_LEVEL") or config.get("level", "INFO")
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+    for name in files:
+        logging.getLogger(name).setLevel(level.upper())
+        _configured_loggers.append(name)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return _listener
+
+
+def set_log_level(level: str | int, logger_name: str | None = None):
+    """تغییر سطح لاگ در زمان اجرا (بدون راه‌اندازی مجدد)"""
+    if isinstance(level, str):
+        level = level.upper()
+    names = [logger_name] if logger_name else ["", *(_configured_loggers or DEFAULT_FILES)]
+    for name in names:
+        logging.getLogger(name).setLevel(level)
+
+
+def shutdown_logging():
+    """تخلیه صف و بستن فایل‌ها"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+    _configured_loggers.clear()
+    _listener = None
@@ -0,0 +1,275 @@
+# metrics.py
+"""
+رجیستری درون‌پروسه‌ای متریک‌ها (Counter / Gauge / Histogram) با خروجی متنی سازگار با Prometheus
+و endpoint محلی HTTP ‏/metrics برای پیدا کردن پسرفت‌ها زیر بار بدون جستجو در لاگ‌ها
+"""
+
+import asyncio
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("PeakMetrics")
+
+# باکت‌های پیش‌فرض زمان (ثانیه)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: dict | None = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs += [f'{name}="{_escape(value)}"' for name, value in extra.items()]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str = "", labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"برچسب‌های {self.name} باید {self.labelnames} باشند، دریافت شد: {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += self.samples()
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str = "", labelnames: tuple = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Counter):
+    """مقدار لحظه‌ای؛ با callback مقدار هنگام خروجی گرفتن خوانده می‌شود"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str = "", labelnames: tuple = (), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self) -> list[str]:
+        if self.callback is not None:
+            try:
+                self.set(self.callback())
+            except Exception:
+                logger.exception("خطا در خواندن gauge %s", self.name)
+        return super().samples()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str = "", labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # کلید برچسب → [شمارش هر باکت، مجموع، تعداد]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            items = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+        lines = []
+        for key, bucket_counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, {"le": _format_value(bound)})
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"متریک {name} قبلاً با نوع {metric.kind} ثبت شده است")
+            return metric
+
+    def counter(self, name: str, help_text: str = "", labelnames: tuple = ()) -> Counter:
+        return self._get_or_create(Counter, name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str = "", labelnames: tuple = (), callback=None) -> Gauge:
+        return self._get_or_create(Gauge, name, help_text, labelnames, callback=callback)
+
+    def histogram(self, name: str, help_text: str = "", labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        """خروجی متنی (text exposition format نسخه 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry() -> MetricsRegistry:
+    return _registry
+
+
+# ==================== متریک‌های مشترک ====================
+AI_TIME_TO_FIRST_TOKEN = _registry.histogram(
+    "peak_ai_time_to_first_token_seconds", "زمان تا اولین توکن پاسخ OpenRouter", ("model",))
+AI_STREAM_SECONDS = _registry.histogram(
+    "peak_ai_stream_seconds", "زمان کل استریم پاسخ OpenRouter", ("model",))
+AI_CHARS_PER_SECOND = _registry.histogram(
+    "peak_ai_chars_per_second", "سرعت تولید متن (کاراکتر بر ثانیه)", ("model",),
+    buckets=(10, 25, 50, 100, 200, 400, 800, 1600, 3200))
+AI_UPSTREAM_RESPONSES = _registry.counter(
+    "peak_ai_upstream_responses_total", "پاسخ‌های upstream به تفکیک کد وضعیت", ("model", "status"))
+QUOTA_CHECKS = _registry.counter(
+    "peak_quota_checks_total", "بررسی‌های سهمیه به تفکیک نوع و پلن", ("kind", "plan"))
+QUOTA_DENIALS = _registry.counter(
+    "peak_quota_denials_total", "رد شدن به دلیل پر بودن سهمیه به تفکیک نوع و پلن", ("kind", "plan"))
+AI_SCHEDULER_QUEUE_DEPTH = _registry.gauge(
+    "peak_ai_scheduler_queue_depth", "درخواست‌های AI در صف انتظار زمان‌بند به تفکیک پلن", ("plan",))
+AI_SCHEDULER_IN_FLIGHT = _registry.gauge(
+    "peak_ai_scheduler_in_flight", "درخواست‌های AI در حال اجرا")
+AI_SCHEDULER_WAIT_SECONDS = _registry.histogram(
+    "peak_ai_scheduler_wait_seconds", "زمان انتظار درخواست AI در صف تا پذیرش", ("plan",))
+AI_SCHEDULER_SHED = _registry.counter(
+    "peak_ai_scheduler_shed_total", "درخواست‌های AI حذف‌شده به دلیل بار به تفکیک علت", ("reason",))
+STORAGE_SECONDS = _registry.histogram(
+    "peak_storage_seconds", "تأخیر عملیات بک‌اند ذخیره‌سازی", ("op",))
+SALES_DISPATCH_SECONDS = _registry.histogram(
+    "peak_sales_dispatch_seconds", "زمان اجرای هندلر پیام یوزربات فروش")
+TELEGRAM_STREAM_REPLIES = _registry.counter(
+    "peak_telegram_stream_replies_total", "پاسخ‌های استریم‌شده در تلگرام")
+TELEGRAM_STREAM_EDITS = _registry.counter(
+    "peak_telegram_stream_edits_total", "ویرایش‌های پیام در پاسخ‌های استریم‌شده")
+TELEGRAM_STREAM_EDITS_PER_REPLY = _registry.histogram(
+    "peak_telegram_stream_edits_per_reply", "تعداد ویرایش در هر پاسخ استریم‌شده",
+    buckets=(1, 2, 5, 10, 20, 50, 100))
+TELEGRAM_STREAM_FLOOD_WAITS = _registry.counter(
+    "peak_telegram_stream_flood_waits_total", "خطاهای flood-wait هنگام ویرایش/ارسال پاسخ استریم‌شده")
+TELEGRAM_STREAM_ROLLOVERS = _registry.counter(
+    "peak_telegram_stream_rollovers_total", "شکستن پاسخ در پیام بعدی به دلیل سقف طول تلگرام")
+TELEGRAM_TIME_TO_FIRST_VISIBLE = _registry.histogram(
+    "peak_telegram_time_to_first_visible_seconds", "زمان تا نمایش اولین متن پاسخ در تلگرام")
+
+
+# ==================== endpoint ‏HTTP ====================
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # رد کردن هدرها
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+            body = _registry.render().encode("utf-8")
+        else:
+            status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str | None = None, port: int | None = None) -> asyncio.AbstractServer | None:
+    """
+    راه‌اندازی endpoint ‏/metrics (تنظیمات از بخش metrics در config.json)
+    اگر غیرفعال باشد None برمی‌گرداند
+    """
+    from storage import load_config_section
+
+    config = load_config_section("metrics")
+    if host is None and port is None and not config.get("enabled", False):
+        return None
+    host = host or config.get("host", "127.0.0.1")
+    port = port if port is not None else int(config.get("port", 9464))
+    server = await asyncio.start_server(_handle_request, host, port)
+    logger.info("endpoint متریک‌ها فعال شد → http://%s:%d/metrics", host, port)
+    return server
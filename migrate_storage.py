@@ -0,0 +1,76 @@
+# migrate_storage.py
+# ابزار یک‌باره مهاجرت users.json و support_queue.json به پایگاه داده SQLite
+# گفتگوهای ai_conversations از رکورد کاربر جدا و به جدول گفتگوها منتقل می‌شوند
+# اجرا:
+#   python migrate_storage.py [مسیر_دیتابیس]
+#   python migrate_storage.py --conversations-only [مسیر_دیتابیس]   (فقط جداسازی گفتگوها، بک‌اند فعلی حفظ می‌شود)
+
+import sys
+
+from conversations import ConversationStore
+from storage import DEFAULT_DB_FILE, JsonBackend, SQLiteBackend, get_backend
+
+
+def split_conversations(users: dict, conversations: ConversationStore) -> int:
+    """
+    انتقال ai_conversations از رکوردهای کاربر به ConversationStore
+    رکوردها در جا تغییر می‌کنند؛ بازگشت: تعداد پیام‌های منتقل‌شده
+    """
+    moved = 0
+    for user_id, user in users.items():
+        user_conversations = user.pop("ai_conversations", None)
+        if user_conversations:
+            moved += conversations.import_conversations(int(user_id), user_conversations)
+    return moved
+
+
+def migrate(db_path: str = DEFAULT_DB_FILE) -> tuple[int, int, int]:
+    """
+    کپی کامل کاربران و صف پشتیبانی از فایل‌های JSON به SQLite
+    تکرار اجرا امن است (رکوردهای موجود جایگزین می‌شوند)
+    بازگشت: (تعداد کاربران، تعداد پیام‌های صف پشتیبانی، تعداد پیام‌های گفتگو)
+    """
+    source = JsonBackend()
+    target = SQLiteBackend(db_path)
+    conversations = ConversationStore(db_path)
+    try:
+        users = source.load_all()
+        queue = source.load_support_queue()
+        moved = split_conversations(users, conversations)
+        target.put_users(users)
+        target.save_support_queue(queue)
+        return len(users), len(queue), moved
+    finally:
+        conversations.close()
+        target.close()
+
+
+def migrate_conversations_only(db_path: str = DEFAULT_DB_FILE) -> int:
+    """جداسازی گفتگوها از رکوردهای بک‌اند فعلی و بازنویسی رکوردهای سبک‌شده"""
+    backend = get_backend()
+    conversations = ConversationStore(db_path)
+    try:
+        users = backend.load_all()
+        moved = split_conversations(users, conversations)
+        backend.save_all(users)
+        return moved
+    finally:
+        conversations.close()
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    db_path = args[0] if args else DEFAULT_DB_FILE
+
+    if "--conversations-only" in sys.argv:
+        moved = migrate_conversations_only(db_path)
+        print(f"جداسازی گفتگوها کامل شد → {db_path}")
+        print(f"  • پیام‌های گفتگو: {moved}")
+        sys.exit(0)
+
+    users_count, queue_count, moved = migrate(db_path)
+    print(f"مهاجرت کامل شد → {db_path}")
+    print(f"  • کاربران: {users_count}")
+    print(f"  • پیام‌های صف پشتیبانی: {queue_count}")
+    print(f"  • پیام‌های گفتگو: {moved}")
+    print('\nبرای فعال‌سازی، در config.json مقدار "storage.backend" را "sqlite" قرار دهید.')
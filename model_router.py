@@ -0,0 +1,204 @@
+# model_router.py
+"""
+مسیریابی مدل‌های OpenRouter با زنجیره جایگزین (fallback) و قطع‌کننده مدار برای هر مدل
+- تلاش مجدد با backoff نمایی تصادفی (jitter) فقط وقتی هنوز هیچ توکنی به کاربر نرسیده
+- رعایت هدر Retry-After
+- وضعیت سلامت از نتیجه check_health و نرخ خطای درخواست‌های واقعی
+"""
+
+import logging
+import random
+import time
+from collections import deque
+
+from storage import load_config_section
+
+logger = logging.getLogger("PeakModelRouter")
+
+DEFAULT_MODEL = "stepfun/step-3.5-flash:free"
+
+# وضعیت‌های قطع‌کننده مدار
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    closed: درخواست‌ها عبور می‌کنند
+    open: مدل تا پایان زمان بازیابی کنار گذاشته می‌شود
+    half_open: یک درخواست آزمایشی؛ موفقیت ← closed، شکست ← open
+    """
+
+    def __init__(self, failure_threshold: int = 3, recovery_time: float = 30.0,
+                 error_rate_threshold: float = 0.5, window: int = 20):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.error_rate_threshold = error_rate_threshold
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self._results: deque = deque(maxlen=window)
+        self._probe_in_flight = False
+        self.latency_ewma: float | None = None
+
+    def error_rate(self) -> float:
+        if not self._results:
+            return 0.0
+        return 1.0 - sum(self._results) / len(self._results)
+
+    def allow_request(self, now: float | None = None) -> bool:
+        now = now or time.monotonic()
+        if self.state == OPEN:
+            if now < self.open_until:
+                return False
+            self.state = HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self, latency: float | None = None):
+        self._results.append(1)
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self._probe_in_flight = False
+        if latency is not None:
+            self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+
+    def record_failure(self, retry_after: float | None = None):
+        self._results.append(0)
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        too_many = self.consecutive_failures >= self.failure_threshold
+        rate_high = len(self._results) >= 5 and self.error_rate() >= self.error_rate_threshold
+        if self.state == HALF_OPEN or too_many or rate_high or retry_after:
+            self.trip(max(self.recovery_time, retry_after or 0.0))
+
+    def release_probe(self):
+        """پاسخی که نشانه سلامت یا خرابی مدل نیست (خطای سمت درخواست)؛ فقط جایگاه آزمایشی آزاد می‌شود"""
+        self._probe_in_flight = False
+
+    def trip(self, duration: float):
+        self.state = OPEN
+        self.open_until = max(self.open_until, time.monotonic() + duration)
+
+
+class ModelRouter:
+    def __init__(
+        self,
+        fallback_chain: list[str] | None = None,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        failure_threshold: int = 3,
+        recovery_time: float = 30.0,
+        read_timeout: float = 45.0,
+    ):
+        if max_attempts < 1:
+            raise ValueError(f"max_attempts باید حداقل ۱ باشد (دریافتی: {max_attempts})")
+        self.fallback_chain = list(fallback_chain or [DEFAULT_MODEL])
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.read_timeout = read_timeout
+        self._breaker_args = (failure_threshold, recovery_time)
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self.stats = {"retries": 0, "fallbacks": 0, "exhausted": 0}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(*self._breaker_args)
+        return breaker
+
+    def chain_for(self, preferred: str) -> list[str]:
+        """
+        مدل ترجیحی + بقیه زنجیره (بدون تکرار)
+        جایگزین‌ها بر اساس تأخیر اخیر مرتب می‌شوند؛ مدل‌های بدون داده به ترتیب زنجیره در انتها
+        """
+        fallbacks = [m for m in self.fallback_chain if m != preferred]
+        order = {m: i for i, m in enumerate(fallbacks)}
+
+        def latency_key(model: str):
+            latency = self.breaker(model).latency_ewma
+            return (latency is None, latency or 0.0, order[model])
+
+        return [preferred] + sorted(fallbacks, key=latency_key)
+
+    def pick(self, preferred: str, exclude: set | None = None) -> str:
+        """
+        اولین مدل زنجیره که مدارش اجازه درخواست می‌دهد
+        اگر همه باز باشند، مدلی که زودتر بازیابی می‌شود برگردانده می‌شود
+        """
+        exclude = exclude or set()
+        chain = [m for m in self.chain_for(preferred) if m not in exclude] or self.chain_for(preferred)
+        for model in chain:
+            if self.breaker(model).allow_request():
+                return model
+        return min(chain, key=lambda m: self.breaker(m).open_until)
+
+    def backoff_delay(self, attempt: int, retry_after: float | None = None) -> float:
+        """backoff نمایی با jitter کامل؛ اگر Retry-After آمده و از سقف کمتر است رعایت می‌شود"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def record_success(self, model: str, latency: float | None = None):
+        self.breaker(model).record_success(latency)
+
+    def record_failure(self, model: str, retry_after: float | None = None):
+        breaker = self.breaker(model)
+        breaker.record_failure(retry_after)
+        if breaker.state == OPEN:
+            logger.warning("مدار مدل باز شد → %s | نرخ خطا: %.2f", model, breaker.error_rate())
+
+    def record_rejected(self, model: str):
+        """خطای غیرقابل تکرار سمت درخواست (400 / 401 / 402 ...) در آمار سلامت مدل حساب نمی‌شود"""
+        self.breaker(model).release_probe()
+
+    def record_health(self, healthy: bool, latency: float | None = None):
+        """نتیجه check_health: خرابی API برای همه مدل‌ها یک شکست حساب می‌شود"""
+        for model in self.fallback_chain:
+            if healthy:
+                breaker = self.breaker(model)
+                if latency is not None and breaker.latency_ewma is None:
+                    breaker.latency_ewma = latency
+            else:
+                self.record_failure(model)
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "models": {
+                model: {
+                    "state": b.state,
+                    "error_rate": round(b.error_rate(), 3),
+                    "latency_ewma": b.latency_ewma,
+                }
+                for model, b in self._breakers.items()
+            },
+        }
+
+
+_router: ModelRouter | None = None
+
+
+def get_model_router() -> ModelRouter:
+    """مسیریاب مشترک پروسه (تنظیمات از بخش ai_models در config.json)"""
+    global _router
+    if _router is None:
+        config = load_config_section("ai_models")
+        _router = ModelRouter(
+            fallback_chain=config.get("fallback_chain") or [DEFAULT_MODEL],
+            max_attempts=int(config.get("max_attempts", 3)),
+            base_delay=float(config.get("base_delay", 0.5)),
+            max_delay=float(config.get("max_delay", 8.0)),
+            failure_threshold=int(config.get("failure_threshold", 3)),
+            recovery_time=float(config.get("recovery_time", 30.0)),
+            read_timeout=float(config.get("read_timeout", 45.0)),
+        )
+    return _router
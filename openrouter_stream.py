@@ -0,0 +1,389 @@
+# openrouter_stream.py
+"""
+موتور مشترک استریم چت OpenRouter برای PeakAI و SalesAI
+- پارسر تدریجی SSE (بدون وابستگی به مرز خطوط در chunkها)
+- تجمیع متن با لیست (به جای += رشته)
+- استفاده از orjson در صورت نصب بودن
+- خروجی رویدادهای نوع‌دار: content / finish / usage / error / done
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+
+import httpx
+
+from ai_scheduler import released_slot
+from health_monitor import get_health_monitor, probe
+from http_client import SharedHTTPClient, get_shared_client
+from metrics import AI_CHARS_PER_SECOND, AI_STREAM_SECONDS, AI_TIME_TO_FIRST_TOKEN, AI_UPSTREAM_RESPONSES
+from model_router import ModelRouter
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+CHAT_COMPLETIONS_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# پیام‌های قابل نمایش به کاربر
+MSG_NETWORK_ERROR = "مشکل ارتباط شبکه با سرویس هوش مصنوعی رخ داد."
+MSG_INTERNAL_ERROR = "خطای داخلی در پردازش درخواست. لطفاً با پشتیبانی تماس بگیرید."
+MSG_EMPTY_RESPONSE = "متأسفانه پاسخی تولید نشد. لطفاً دوباره تلاش کنید."
+
+# انواع رویداد استریم
+EVENT_CONTENT = "content"
+EVENT_FINISH = "finish"
+EVENT_USAGE = "usage"
+EVENT_ERROR = "error"
+EVENT_DONE = "done"
+
+# کدهای HTTP که با تلاش مجدد یا مدل جایگزین ممکن است موفق شوند
+RETRYABLE_STATUS = frozenset({408, 409, 425, 429, 500, 502, 503, 504})
+
+
+def _parse_retry_after(value) -> float | None:
+    """هدر Retry-After (فقط حالت ثانیه)"""
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class StreamEvent:
+    """
+    یک رویداد از استریم
+    content: متن delta (برای error: پیام قابل نمایش به کاربر)
+    elapsed: ثانیه از شروع درخواست
+    retryable: آیا خطا با تلاش مجدد/مدل جایگزین قابل جبران است
+    """
+    kind: str
+    content: str = ""
+    finish_reason: str | None = None
+    usage: dict | None = None
+    status_code: int | None = None
+    error: str = ""
+    elapsed: float = 0.0
+    stats: dict = field(default_factory=dict)
+    retryable: bool = False
+    retry_after: float | None = None
+    model: str = ""
+
+
+class SSEParser:
+    """
+    پارسر تدریجی Server-Sent Events
+    هر chunk متنی را می‌گیرد و مقادیر data رویدادهای کامل‌شده را برمی‌گرداند
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._data: list[str] = []
+
+    def feed(self, chunk: str) -> list[str]:
+        text = self._pending + chunk
+        lines = text.splitlines(keepends=True)
+        # خط آخر ناقص (یا \r که ممکن است \n آن در chunk بعدی بیاید) منتظر می‌ماند
+        if lines and (not lines[-1].endswith(("\n", "\r")) or lines[-1].endswith("\r")):
+            self._pending = lines.pop()
+        else:
+            self._pending = ""
+
+        events = []
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if not line:
+                if self._data:
+                    events.append("\n".join(self._data))
+                    self._data = []
+                continue
+            if line[0] == ":":
+                # کامنت SSE (مثل ": OPENROUTER PROCESSING")
+                continue
+            name, _, value = line.partition(":")
+            if name == "data":
+                self._data.append(value[1:] if value.startswith(" ") else value)
+        return events
+
+    def flush(self) -> list[str]:
+        """رویداد باقی‌مانده در پایان استریم (اگر خط خالی پایانی نیامده باشد)"""
+        events = self.feed("\n\n") if self._pending or self._data else []
+        self._pending = ""
+        return events
+
+
+class OpenRouterChat:
+    def __init__(
+        self,
+        api_key: str,
+        title: str,
+        logger: logging.Logger,
+        http_client: SharedHTTPClient | None = None,
+        base_url: str = CHAT_COMPLETIONS_URL,
+        router: ModelRouter | None = None,
+    ):
+        self.api_key = api_key.strip()
+        self.base_url = base_url
+        self.logger = logger
+        self.http = http_client or get_shared_client()
+        # مسیریاب اختیاری: تلاش مجدد، مدل جایگزین و قطع‌کننده مدار
+        self.router = router
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://t.me/PeakTubeBot",
+            "X-Title": title,
+        }
+
+    async def check_health(self) -> bool:
+        """
+        بررسی وضعیت اتصال به OpenRouter
+        اگر پایشگر سلامت در حال اجراست، نتیجه کش‌شده آن بدون I/O شبکه برگردانده می‌شود
+        """
+        monitor = get_health_monitor()
+        if monitor is not None and monitor.running and monitor.last_checked is not None:
+            return monitor.is_healthy()
+
+        self.logger.debug("شروع بررسی سلامت API")
+        try:
+            healthy, status, elapsed = await probe(self.http, self.api_key)
+            self.logger.info("بررسی سلامت → کد: %s | زمان: %.3f ثانیه", status, elapsed)
+            if self.router is not None:
+                self.router.record_health(healthy, elapsed)
+            if healthy:
+                self.logger.debug("اتصال برقرار است")
+            else:
+                self.logger.warning("بررسی سلامت ناموفق → کد: %s", status)
+            return healthy
+        except Exception:
+            self.logger.exception("خطای غیرمنتظره در health check")
+            return False
+
+    async def stream(self, model: str, messages: list, timeout: float | httpx.Timeout = 120.0):
+        """
+        استریم نوع‌دار پاسخ
+        همیشه با یک رویداد done (در صورت موفقیت) یا error پایان می‌یابد
+        """
+        start_time = time.perf_counter()
+        safe_headers = {k: v if k != "Authorization" else f"Bearer {v[:6]}***" for k, v in self.headers.items()}
+        self.logger.debug("ارسال درخواست → URL: %s | مدل: %s | هدرها: %s", self.base_url, model, safe_headers)
+
+        try:
+            async with self.http.stream(
+                "POST",
+                self.base_url,
+                headers=self.headers,
+                json={"model": model, "messages": messages, "stream": True},
+                timeout=timeout
+            ) as response:
+                elapsed_initial = time.perf_counter() - start_time
+                self.logger.info("پاسخ اولیه دریافت شد → کد: %d | زمان تا پاسخ اول: %.3f ثانیه",
+                                 response.status_code, elapsed_initial)
+                AI_UPSTREAM_RESPONSES.inc(model=model, status=response.status_code)
+
+                if response.status_code != 200:
+                    error_body = await response.aread()
+                    error_text = error_body.decode(errors="replace")
+                    self.logger.error("خطای HTTP → کد: %d | بدنه پاسخ: %s", response.status_code, error_text[:1000])
+                    yield StreamEvent(
+                        EVENT_ERROR,
+                        content=f"خطا {response.status_code}: {error_text[:300]}",
+                        status_code=response.status_code,
+                        error=error_text,
+                        elapsed=elapsed_initial,
+                        retryable=response.status_code in RETRYABLE_STATUS,
+                        retry_after=_parse_retry_after(response.headers.get("retry-after")),
+                        model=model,
+                    )
+                    return
+
+                parts: list[str] = []
+                first_token_at: float | None = None
+                usage: dict | None = None
+                parser = SSEParser()
+                done = False
+
+                async for chunk in response.aiter_text():
+                    for data in parser.feed(chunk):
+                        if data == "[DONE]":
+                            done = True
+                            break
+                        try:
+                            payload = _json_loads(data)
+                        except ValueError:
+                            self.logger.debug("خط JSON نامعتبر رد شد")
+                            continue
+
+                        if payload.get("error"):
+                            error = payload["error"]
+                            message = error.get("message", "") if isinstance(error, dict) else str(error)
+                            status = error.get("code") if isinstance(error, dict) else None
+                            self.logger.error("خطای میان استریم → %s", message[:1000])
+                            yield StreamEvent(
+                                EVENT_ERROR,
+                                content=f"خطا {status}: {message[:300]}" if status else MSG_INTERNAL_ERROR,
+                                status_code=status if isinstance(status, int) else None,
+                                error=message,
+                                elapsed=time.perf_counter() - start_time,
+                                retryable=status in RETRYABLE_STATUS,
+                                model=model,
+                            )
+                            return
+
+                        choices = payload.get("choices") or [{}]
+                        choice = choices[0]
+                        content = (choice.get("delta") or {}).get("content")
+                        if content:
+                            now = time.perf_counter() - start_time
+                            if first_token_at is None:
+                                first_token_at = now
+                            parts.append(content)
+                            yield StreamEvent(EVENT_CONTENT, content=content, elapsed=now)
+                        if choice.get("finish_reason"):
+                            yield StreamEvent(EVENT_FINISH, finish_reason=choice["finish_reason"],
+                                              elapsed=time.perf_counter() - start_time)
+                        if payload.get("usage"):
+                            usage = payload["usage"]
+                            yield StreamEvent(EVENT_USAGE, usage=usage, elapsed=time.perf_counter() - start_time)
+                    if done:
+                        break
+
+                total_time = time.perf_counter() - start_time
+                text = "".join(parts)
+                self.logger.info("پاسخ کامل شد → طول: %d کاراکتر | زمان کل: %.3f ثانیه", len(text), total_time)
+                chars_per_sec = len(text) / total_time if total_time > 0 else 0.0
+                AI_STREAM_SECONDS.observe(total_time, model=model)
+                AI_CHARS_PER_SECOND.observe(chars_per_sec, model=model)
+                if first_token_at is not None:
+                    AI_TIME_TO_FIRST_TOKEN.observe(first_token_at, model=model)
+                yield StreamEvent(
+                    EVENT_DONE,
+                    content=text,
+                    usage=usage,
+                    elapsed=total_time,
+                    stats={
+                        "model": model,
+                        "chars": len(text),
+                        "time_to_first_token": first_token_at,
+                        "total_time": total_time,
+                        "chars_per_sec": chars_per_sec,
+                    },
+                )
+
+        except httpx.HTTPStatusError as http_err:
+            try:
+                error_body = await http_err.response.aread()
+                error_text = error_body.decode(errors="replace")
+            except Exception:
+                error_text = "(نتوانست بدنه پاسخ خوانده شود)"
+            self.logger.error("خطای HTTP → کد: %d | بدنه: %s", http_err.response.status_code, error_text[:1000])
+            yield StreamEvent(
+                EVENT_ERROR,
+                content=f"خطای ارتباط (کد {http_err.response.status_code}): {error_text[:300]}",
+                status_code=http_err.response.status_code,
+                error=error_text,
+                elapsed=time.perf_counter() - start_time,
+                retryable=http_err.response.status_code in RETRYABLE_STATUS,
+                model=model,
+            )
+
+        except httpx.RequestError as req_err:
+            self.logger.error("خطای شبکه/درخواست: %s", str(req_err))
+            AI_UPSTREAM_RESPONSES.inc(model=model, status="network_error")
+            yield StreamEvent(EVENT_ERROR, content=MSG_NETWORK_ERROR, error=str(req_err),
+                              elapsed=time.perf_counter() - start_time, retryable=True, model=model)
+
+        except Exception as e:
+            self.logger.exception("خطای غیرمنتظره در استریم")
+            yield StreamEvent(EVENT_ERROR, content=MSG_INTERNAL_ERROR, error=str(e),
+                              elapsed=time.perf_counter() - start_time, model=model)
+
+    async def stream_routed(self, model: str, messages: list):
+        """
+        استریم با تلاش مجدد و زنجیره مدل‌های جایگزین
+        فقط تا قبل از رسیدن اولین توکن تلاش مجدد انجام می‌شود؛ بعد از آن خطا مستقیماً به کاربر می‌رسد
+        """
+        router = self.router
+        timeout = httpx.Timeout(120.0, connect=10.0, read=router.read_timeout)
+        tried: set[str] = set()
+        last_error: StreamEvent | None = None
+
+        for attempt in range(router.max_attempts):
+            current = router.pick(model, exclude=tried)
+            if attempt and current != model:
+                router.stats["fallbacks"] += 1
+                self.logger.info("استفاده از مدل جایگزین → %s (تلاش %d)", current, attempt + 1)
+            tried.add(current)
+            emitted = False
+            retry = False
+
+            # aclosing: با break روی خطای میان استریم، پاسخ HTTP و اتصال فوراً آزاد می‌شوند
+            async with contextlib.aclosing(self.stream(current, messages, timeout=timeout)) as events:
+                async for event in events:
+                    if event.kind == EVENT_ERROR:
+                        # خطاهای سمت درخواست (400 / 401 / 402 ...) به سلامت مدل ربطی ندارند
+                        if event.retryable:
+                            router.record_failure(current, event.retry_after)
+                        else:
+                            router.record_rejected(current)
+                        if event.retryable and not emitted:
+                            last_error = event
+                            retry = True
+                            break
+                        yield event
+                        return
+                    if event.kind == EVENT_CONTENT:
+                        emitted = True
+                    elif event.kind == EVENT_DONE:
+                        router.record_success(current, event.stats.get("time_to_first_token"))
+                    yield event
+
+            if not retry:
+                return
+            if attempt + 1 < router.max_attempts:
+                router.stats["retries"] += 1
+                retry_after = last_error.retry_after if last_error is not None else None
+                status_code = last_error.status_code if last_error is not None else None
+                delay = router.backoff_delay(attempt, retry_after)
+                self.logger.warning("تلاش مجدد بعد از %.2f ثانیه | مدل: %s | کد: %s",
+                                    delay, current, status_code)
+                # ظرفیت زمان‌بند AI در مدت انتظار به درخواست‌های دیگر داده می‌شود
+                async with released_slot():
+                    await asyncio.sleep(delay)
+
+        router.stats["exhausted"] += 1
+        if last_error is None:
+            # هیچ تلاشی انجام نشد؛ مصرف‌کننده همیشه باید یک رویداد خطا ببیند نه None
+            last_error = StreamEvent(EVENT_ERROR, content=MSG_INTERNAL_ERROR,
+                                     error="هیچ تلاشی برای استریم انجام نشد", model=model)
+        yield last_error
+
+    def events(self, model: str, messages: list, timeout: float = 120.0):
+        """استریم نوع‌دار؛ با مسیریاب در صورت وجود"""
+        if self.router is not None:
+            return self.stream_routed(model, messages)
+        return self.stream(model, messages, timeout=timeout)
+
+    async def stream_text(self, model: str, messages: list, timeout: float = 120.0, on_done=None):
+        """
+        استریم متنی (رفتار قبلی generate_response): فقط yield رشته
+        خطاها به صورت پیام قابل نمایش yield می‌شوند
+        on_done: در صورت پاسخ موفق و غیرخالی با رویداد done صدا زده می‌شود
+        """
+        async for event in self.events(model, messages, timeout=timeout):
+            if event.kind == EVENT_CONTENT:
+                yield event.content
+            elif event.kind == EVENT_ERROR:
+                yield event.content
+                return
+            elif event.kind == EVENT_DONE:
+                if not event.content.strip():
+                    self.logger.warning("پاسخ خالی دریافت شد")
+                    yield MSG_EMPTY_RESPONSE
+                elif on_done is not None:
+                    on_done(event)
@@ -0,0 +1,108 @@
+# quota.py
+"""
+پنجره‌های سهمیه مبتنی بر زمان
+وضعیت هر سهمیه فقط (window_start, count) است و مقدار مؤثر در لحظه خواندن محاسبه می‌شود؛
+خواندن هیچ‌وقت چیزی ذخیره نمی‌کند و پنجره در مصرف بعدی جابه‌جا می‌شود
+
+حالت‌ها:
+    fixed        - پنجره ثابت که از اولین مصرف بعد از انقضا شروع می‌شود (رفتار قبلی)
+    token_bucket - سطل توکن: سهمیه به صورت پیوسته و به نسبت limit/period پر می‌شود؛
+                   هیچ لحظه مشترکی برای ریست همه کاربران وجود ندارد
+در حالت token_bucket مقدار window_start زمان آخرین به‌روزرسانی و count مقدار مصرف‌شده (اعشاری) است
+"""
+
+import math
+from datetime import datetime, timedelta
+
+from storage import load_config_section
+
+MODE_FIXED = "fixed"
+MODE_TOKEN_BUCKET = "token_bucket"
+MODES = (MODE_FIXED, MODE_TOKEN_BUCKET)
+
+
+def _parse_time(value) -> datetime | None:
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class QuotaWindow:
+    def __init__(self, period: timedelta, mode: str = MODE_FIXED):
+        if mode not in MODES:
+            raise ValueError(f"حالت سهمیه نامعتبر: {mode}")
+        self.period = period
+        self.mode = mode
+
+    def _rate(self, limit: int) -> float:
+        """سرعت پر شدن سطل (واحد در ثانیه)"""
+        return limit / self.period.total_seconds()
+
+    def used(self, count, window_start, limit: int, now: datetime | None = None) -> float:
+        """مقدار مصرف مؤثر در لحظه now (بدون تغییر وضعیت)"""
+        now = now or datetime.now()
+        start = _parse_time(window_start)
+        count = max(0, count or 0)
+        if start is None:
+            return 0
+        elapsed = (now - start).total_seconds()
+        if self.mode == MODE_TOKEN_BUCKET:
+            return max(0.0, count - max(0.0, elapsed) * self._rate(limit))
+        return 0 if elapsed >= self.period.total_seconds() else count
+
+    def used_count(self, count, window_start, limit: int, now: datetime | None = None) -> int:
+        """مقدار مصرف مؤثر به صورت عدد صحیح (برای نمایش به کاربر)"""
+        return min(limit, math.ceil(self.used(count, window_start, limit, now) - 1e-9))
+
+    def reset_at(self, count, window_start, limit: int, now: datetime | None = None) -> datetime | None:
+        """
+        fixed: پایان پنجره فعلی (None اگر پنجره‌ای فعال نیست)
+        token_bucket: زمان آزاد شدن سهمیه بعدی اگر پر است، وگرنه زمان خالی شدن کامل سطل
+        """
+        now = now or datetime.now()
+        start = _parse_time(window_start)
+        if start is None:
+            return None
+        if self.mode == MODE_TOKEN_BUCKET:
+            used = self.used(count, window_start, limit, now)
+            if used <= 0:
+                return None
+            excess = used - (limit - 1) if used > limit - 1 else used
+            return now + timedelta(seconds=excess / self._rate(limit))
+        end = start + self.period
+        return end if now < end else None
+
+    def consume(self, count, window_start, limit: int, now: datetime | None = None) -> tuple[bool, float, str]:
+        """
+        مصرف یک واحد
+        بازگشت: (ok, new_count, new_window_start_iso) - در صورت رد، وضعیت ورودی بدون تغییر برمی‌گردد
+        """
+        now = now or datetime.now()
+        used = self.used(count, window_start, limit, now)
+        if self.mode == MODE_TOKEN_BUCKET:
+            if used + 1 > limit + 1e-9:
+                return False, count, window_start
+            return True, round(used + 1, 6), now.isoformat()
+
+        start = _parse_time(window_start)
+        if start is None or (now - start) >= self.period:
+            used, window_start = 0, now.isoformat()
+        if used >= limit:
+            return False, used, window_start
+        return True, used + 1, window_start
+
+
+def load_quota_mode() -> str:
+    """حالت سهمیه از بخش quota در config.json (پیش‌فرض: fixed)"""
+    mode = (load_config_section("quota").get("mode") or MODE_FIXED).lower()
+    return mode if mode in MODES else MODE_FIXED
+
+
+_mode = load_quota_mode()
+DOWNLOAD_WINDOW = QuotaWindow(timedelta(days=1), _mode)
+AI_SUPPORT_WINDOW = QuotaWindow(timedelta(hours=5), _mode)
@@ -0,0 +1,392 @@
+# receipt_outbox.py
+"""
+صندوق خروجی پایدار فیش‌های پرداخت (#FINANCE_REPORT) برای ربات اصلی
+- هر فیش قبل از پاسخ به کاربر در جدول receipt_outbox ثبت می‌شود (شناسه کاربر، پلن، مرجع پیام)
+- کلید یکتا (idempotency) از چت و شناسه پیام ساخته می‌شود؛ یک فیش هیچ‌وقت دو بار ثبت نمی‌شود
+- ارسال‌کننده پس‌زمینه مدخل‌های سررسیده را دسته‌ای برمی‌دارد و با فاصله کنترل‌شده ارسال می‌کند
+- تلاش مجدد با backoff نمایی، رعایت FloodWait و علامت failed بعد از max_attempts
+- مدخل‌هایی که هنگام قطع برنامه در حال ارسال بودند، قبل از ارسال مجدد در چت ربات جستجو می‌شوند
+  (تطبیق با شناسه عکس فیش، نه فقط متن کپشن که برای دو فیش یک کاربر و پلن یکسان است)
+"""
+
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+from metrics import get_registry
+from storage import DEFAULT_DB_FILE, load_config_section
+from telegram_stream import flood_wait_seconds
+
+logger = logging.getLogger("PeakReceiptOutbox")
+
+RECEIPT_CAPTION = "#FINANCE_REPORT USER_ID: {user_id} PLAN: {plan}"
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+RECEIPT_DELIVERIES = get_registry().counter(
+    "peak_receipt_deliveries_total", "نتیجه تلاش‌های ارسال فیش به ربات اصلی", ("result",))
+
+
+class ReceiptUnavailable(Exception):
+    """پیام فیش دیگر در دسترس نیست (حذف شده یا بدون عکس)؛ تلاش مجدد فایده‌ای ندارد"""
+
+
+def idempotency_key(chat_id: int, message_id: int) -> str:
+    return f"{chat_id}:{message_id}"
+
+
+class ReceiptOutbox:
+    def __init__(self, client, target, db_path: str = DEFAULT_DB_FILE, batch_size: int = 20,
+                 send_interval: float = 1.0, max_attempts: int = 8, base_delay: float = 5.0,
+                 max_delay: float = 1800.0):
+        """
+        client: کلاینت Telethon
+        target: مقصد فیش‌ها (آیدی عددی ربات اصلی)
+        """
+        self.client = client
+        self.target = target
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.send_interval = send_interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.RLock()
+        self._wakeup: asyncio.Event | None = None
+        self._sender_task: asyncio.Task | None = None
+        # عکس پیام‌های تازه ثبت‌شده؛ تلاش اول بدون دریافت دوباره پیام انجام می‌شود
+        self._media: dict[int, object] = {}
+        self.stats = {"recorded": 0, "duplicates": 0, "sent": 0, "retries": 0, "failed": 0,
+                      "flood_waits": 0, "recovered": 0}
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS receipt_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                user_id INTEGER NOT NULL,
+                plan TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                photo_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                claimed_at REAL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                sent_at REAL,
+                delivered_message_id INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS idx_receipt_outbox_due ON receipt_outbox(status, next_attempt_at);
+        """)
+
+        registry = get_registry()
+        registry.gauge("peak_receipt_outbox_pending", "فیش‌های در انتظار ارسال به ربات اصلی",
+                       callback=lambda: self._count(PENDING, SENDING))
+        registry.gauge("peak_receipt_outbox_failed", "فیش‌هایی که بعد از همه تلاش‌ها ارسال نشدند",
+                       callback=lambda: self._count(FAILED))
+
+    # ---------- ثبت ----------
+    def record(self, user_id: int, plan: str, chat_id: int, message_id: int, media=None) -> bool:
+        """ثبت فیش در صندوق؛ بازگشت: False اگر همین پیام قبلاً ثبت شده بود"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO receipt_outbox"
+                " (idempotency_key, user_id, plan, chat_id, message_id, photo_id, next_attempt_at, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (idempotency_key(chat_id, message_id), user_id, plan, chat_id, message_id,
+                 getattr(media, "id", None), now, now)
+            )
+            if cursor.rowcount == 0:
+                self.stats["duplicates"] += 1
+                return False
+            if media is not None:
+                self._media[cursor.lastrowid] = media
+            self.stats["recorded"] += 1
+        return True
+
+    async def enqueue(self, user_id: int, plan: str, chat_id: int, message_id: int, media=None) -> bool:
+        """ثبت از داخل event loop: نوشتن روی دیسک در thread جدا و بیدار کردن ارسال‌کننده"""
+        recorded = await asyncio.to_thread(self.record, user_id, plan, chat_id, message_id, media)
+        if recorded and self._wakeup is not None:
+            self._wakeup.set()
+        return recorded
+
+    # ---------- وضعیت ----------
+    def _count(self, *statuses: str) -> int:
+        placeholders = ", ".join("?" * len(statuses))
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM receipt_outbox WHERE status IN ({placeholders})", statuses
+            ).fetchone()[0]
+
+    def entries(self, status: str | None = None, limit: int = 50) -> list[dict]:
+        """جدیدترین مدخل‌ها (در صورت تعیین، فقط با وضعیت داده‌شده)"""
+        query = "SELECT * FROM receipt_outbox"
+        params: tuple = ()
+        if status is not None:
+            query += " WHERE status = ?"
+            params = (status,)
+        query += " ORDER BY id DESC LIMIT ?"
+        with self._lock:
+            cursor = self._conn.execute(query, params + (limit,))
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def status(self, limit: int = 20) -> dict:
+        """خلاصه وضعیت صندوق: تعداد به تفکیک وضعیت + فهرست مدخل‌های معلق و ناموفق"""
+        with self._lock:
+            counts = dict(self._conn.execute(
+                "SELECT status, COUNT(*) FROM receipt_outbox GROUP BY status").fetchall())
+        return {
+            "counts": {state: counts.get(state, 0) for state in (PENDING, SENDING, SENT, FAILED)},
+            "pending": self.entries(PENDING, limit) + self.entries(SENDING, limit),
+            "failed": self.entries(FAILED, limit),
+            "stats": dict(self.stats),
+        }
+
+    def retry_failed(self, entry_id: int | None = None) -> int:
+        """بازگرداندن مدخل(های) ناموفق به صف با شمارنده تلاش صفر"""
+        query = ("UPDATE receipt_outbox SET status = ?, attempts = 0, next_attempt_at = ?, last_error = NULL"
+                 " WHERE status = ?")
+        params: tuple = (PENDING, time.time(), FAILED)
+        if entry_id is not None:
+            query += " AND id = ?"
+            params += (entry_id,)
+        with self._lock:
+            changed = self._conn.execute(query, params).rowcount
+        if changed and self._wakeup is not None:
+            self._wakeup.set()
+        return changed
+
+    # ---------- ارسال ----------
+    def _claim_batch(self) -> list[dict]:
+        """برداشتن دسته‌ای مدخل‌های سررسیده و علامت sending در یک تراکنش"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self._conn.execute(
+                    "SELECT * FROM receipt_outbox WHERE status = ? AND next_attempt_at <= ?"
+                    " ORDER BY next_attempt_at, id LIMIT ?",
+                    (PENDING, now, self.batch_size)
+                )
+                columns = [column[0] for column in cursor.description]
+                batch = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                self._conn.executemany(
+                    "UPDATE receipt_outbox SET status = ?, claimed_at = ? WHERE id = ?",
+                    [(SENDING, now, entry["id"]) for entry in batch]
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return batch
+
+    def _update(self, entry_id: int, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE receipt_outbox SET {assignments} WHERE id = ?",
+                               (*fields.values(), entry_id))
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def _photo_for(self, entry: dict):
+        photo = self._media.pop(entry["id"], None)
+        if photo is not None:
+            return photo
+        message = await self.client.get_messages(entry["chat_id"], ids=entry["message_id"])
+        photo = getattr(message, "photo", None)
+        if photo is None:
+            raise ReceiptUnavailable(f"پیام فیش {entry['idempotency_key']} در دسترس نیست")
+        return photo
+
+    async def _deliver(self, entry: dict) -> int | None:
+        caption = RECEIPT_CAPTION.format(user_id=entry["user_id"], plan=entry["plan"])
+        message = await self.client.send_file(self.target, await self._photo_for(entry), caption=caption)
+        return getattr(message, "id", None)
+
+    def _delivered_ids(self) -> set[int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT delivered_message_id FROM receipt_outbox WHERE delivered_message_id IS NOT NULL"
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    async def _find_delivered(self, entry: dict) -> int | None:
+        """
+        جستجوی فیشی که قبل از قطع برنامه ارسال شده ولی ثبت نشده بود (جلوگیری از ارسال تکراری)
+        پیام باید همان عکس (photo_id) را داشته باشد و به مدخل دیگری نسبت داده نشده باشد؛
+        بدون photo_id تصمیم قطعی ممکن نیست و ارسال مجدد بر از دست رفتن فیش ترجیح دارد
+        """
+        if entry.get("photo_id") is None:
+            return None
+        caption = RECEIPT_CAPTION.format(user_id=entry["user_id"], plan=entry["plan"])
+        since = (entry["claimed_at"] or entry["created_at"]) - 60
+        claimed = self._delivered_ids()
+        messages = await self.client.get_messages(self.target, search=caption, limit=20)
+        for message in messages or []:
+            photo = getattr(message, "photo", None)
+            if (getattr(message, "out", False) and photo is not None and photo.id == entry["photo_id"]
+                    and message.id not in claimed and message.date.timestamp() >= since):
+                return message.id
+        return None
+
+    async def recover_interrupted(self) -> int:
+        """
+        مدخل‌های sending باقی‌مانده از اجرای قبلی: اگر در چت ربات پیدا شدند sent، وگرنه به صف برمی‌گردند
+        باید بعد از client.start() و قبل از شروع ارسال فراخوانی شود
+        """
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM receipt_outbox WHERE status = ?", (SENDING,))
+            columns = [column[0] for column in cursor.description]
+            interrupted = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for entry in interrupted:
+            try:
+                delivered_id = await self._find_delivered(entry)
+            except Exception as e:
+                logger.warning("بررسی فیش نیمه‌کاره %s ممکن نشد: %s", entry["idempotency_key"], e)
+                delivered_id = None
+            if delivered_id is not None:
+                self._update(entry["id"], status=SENT, sent_at=time.time(), delivered_message_id=delivered_id)
+                self.stats["recovered"] += 1
+            else:
+                self._update(entry["id"], status=PENDING, next_attempt_at=time.time())
+        return len(interrupted)
+
+    async def _send_one(self, entry: dict) -> float:
+        """ارسال یک مدخل؛ بازگشت: مدت انتظار flood (صفر در حالت عادی)"""
+        try:
+            delivered_id = await self._deliver(entry)
+        except ReceiptUnavailable as e:
+            self._update(entry["id"], status=FAILED, last_error=str(e), attempts=entry["attempts"] + 1)
+            self.stats["failed"] += 1
+            RECEIPT_DELIVERIES.inc(result="unavailable")
+            logger.error("فیش قابل ارسال نیست: %s", e)
+            return 0.0
+        except Exception as e:
+            wait = flood_wait_seconds(e)
+            if wait is not None:
+                # FloodWait جزو تلاش‌های ناموفق حساب نمی‌شود
+                self._update(entry["id"], status=PENDING, next_attempt_at=time.time() + wait,
+                             last_error=f"FloodWait {wait:.0f}s")
+                self.stats["flood_waits"] += 1
+                RECEIPT_DELIVERIES.inc(result="flood_wait")
+                logger.warning("FloodWait در ارسال فیش؛ %.0f ثانیه توقف", wait)
+                return wait
+            attempts = entry["attempts"] + 1
+            if attempts >= self.max_attempts:
+                self._update(entry["id"], status=FAILED, attempts=attempts, last_error=str(e))
+                self.stats["failed"] += 1
+                RECEIPT_DELIVERIES.inc(result="failed")
+                logger.error("ارسال فیش %s بعد از %d تلاش ناموفق ماند: %s",
+                             entry["idempotency_key"], attempts, e)
+            else:
+                self._update(entry["id"], status=PENDING, attempts=attempts, last_error=str(e),
+                             next_attempt_at=time.time() + self._backoff(attempts))
+                self.stats["retries"] += 1
+                RECEIPT_DELIVERIES.inc(result="retry")
+                logger.warning("خطا در ارسال فیش %s (تلاش %d): %s", entry["idempotency_key"], attempts, e)
+            return 0.0
+
+        self._update(entry["id"], status=SENT, attempts=entry["attempts"] + 1, sent_at=time.time(),
+                     delivered_message_id=delivered_id, last_error=None)
+        self.stats["sent"] += 1
+        RECEIPT_DELIVERIES.inc(result="sent")
+        return 0.0
+
+    def _release(self, batch: list[dict], delay: float):
+        """بازگرداندن باقی دسته به صف (بعد از FloodWait) بدون افزایش شمارنده تلاش"""
+        if not batch:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE receipt_outbox SET status = ?, next_attempt_at = ? WHERE id = ? AND status = ?",
+                [(PENDING, time.time() + delay, entry["id"], SENDING) for entry in batch]
+            )
+
+    async def process_batch(self) -> int:
+        """ارسال یک دسته از مدخل‌های سررسیده؛ بازگشت: تعداد مدخل‌های برداشته‌شده"""
+        batch = await asyncio.to_thread(self._claim_batch)
+        for index, entry in enumerate(batch):
+            flood = await self._send_one(entry)
+            if flood:
+                self._release(batch[index + 1:], flood)
+                await asyncio.sleep(flood)
+                break
+            if index + 1 < len(batch):
+                await asyncio.sleep(self.send_interval)
+        return len(batch)
+
+    def _next_due_in(self) -> float | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(next_attempt_at) FROM receipt_outbox WHERE status = ?", (PENDING,)
+            ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    async def _sender_loop(self):
+        while True:
+            try:
+                if await self.process_batch():
+                    continue
+                timeout = self._next_due_in()
+            except Exception as e:
+                logger.exception("خطا در حلقه ارسال فیش‌ها: %s", e)
+                timeout = self.base_delay
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        """بازیابی مدخل‌های نیمه‌کاره و شروع ارسال پس‌زمینه (بعد از client.start())"""
+        if self._sender_task is not None and not self._sender_task.done():
+            return
+        self._wakeup = asyncio.Event()
+        await self.recover_interrupted()
+        self._sender_task = asyncio.get_running_loop().create_task(self._sender_loop())
+
+    async def stop(self):
+        if self._sender_task is not None:
+            self._sender_task.cancel()
+            try:
+                await self._sender_task
+            except asyncio.CancelledError:
+                pass
+            self._sender_task = None
+        # مدخل‌هایی که وسط ارسال قطع شدند در اجرای بعدی با recover_interrupted بررسی می‌شوند
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_receipt_outbox(client, target) -> ReceiptOutbox:
+    """صندوق فیش‌ها با تنظیمات بخش receipt_outbox در config.json"""
+    config = load_config_section("receipt_outbox")
+    return ReceiptOutbox(
+        client,
+        target,
+        db_path=config.get("db_path") or DEFAULT_DB_FILE,
+        batch_size=int(config.get("batch_size", 20)),
+        send_interval=float(config.get("send_interval", 1.0)),
+        max_attempts=int(config.get("max_attempts", 8)),
+        base_delay=float(config.get("base_delay", 5.0)),
+        max_delay=float(config.get("max_delay", 1800.0)),
+    )
@@ -0,0 +1,187 @@
+# response_cache.py
+"""
+کش پاسخ‌های PeakAI برای وظایف summarize / search / idea
+- کلید: (مدل، نوع وظیفه، پیام نرمال‌شده) - لینک‌های یوتیوب به شناسه ویدیو تبدیل می‌شوند
+- لایه حافظه با TTL و حذف LRU (محدود به تعداد و حجم)
+- لایه اختیاری دیسک (SQLite)
+- بازپخش پاسخ کش‌شده به صورت استریم شبیه‌سازی‌شده تا تجربه کاربر در تلگرام تغییر نکند
+"""
+
+import asyncio
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from storage import load_config_section
+
+CACHEABLE_TASKS = ("summarize", "search", "idea")
+
+# همه شکل‌های رایج لینک یوتیوب: watch?v= ، youtu.be/ ، shorts/ ، embed/ ، live/ ، v/
+_YOUTUBE_URL_RE = re.compile(
+    r"(?:https?://)?(?:www\.|m\.|music\.)?"
+    r"(?:youtube\.com/(?:watch\?(?:[^\s#]*?&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)"
+    r"([A-Za-z0-9_-]{11})[^\s]*",
+    re.IGNORECASE,
+)
+_WHITESPACE_RE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = " \t\n.!?؟،,;:«»\"'"
+
+
+def extract_youtube_id(text: str) -> str | None:
+    match = _YOUTUBE_URL_RE.search(text or "")
+    return match.group(1) if match else None
+
+
+def _normalize_text(text: str) -> str:
+    return text.replace("ي", "ی").replace("ك", "ک").replace("\u200c", " ").casefold()
+
+
+def normalize_prompt(message: str) -> str:
+    """
+    نرمال‌سازی پیام برای کلید کش: لینک یوتیوب ← yt:<id>، حروف کوچک، فاصله‌های یکسان
+    (شناسه ویدیو به حروف بزرگ/کوچک حساس است و دست نمی‌خورد)
+    """
+    message = message or ""
+    parts = []
+    last = 0
+    for match in _YOUTUBE_URL_RE.finditer(message):
+        parts.append(_normalize_text(message[last:match.start()]))
+        parts.append(f" yt:{match.group(1)} ")
+        last = match.end()
+    parts.append(_normalize_text(message[last:]))
+    return _WHITESPACE_RE.sub(" ", "".join(parts)).strip(_EDGE_PUNCTUATION)
+
+
+def make_cache_key(model: str, task_type: str, message: str) -> str:
+    raw = f"{model}\x1f{task_type}\x1f{normalize_prompt(message)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        ttl: float = 3600.0,
+        max_entries: int = 1000,
+        max_chars: int = 5_000_000,
+        disk_path: str | None = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self._entries: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+        self._disk: sqlite3.Connection | None = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS ai_response_cache ("
+                " key TEXT PRIMARY KEY, created_at REAL NOT NULL, value TEXT NOT NULL)"
+            )
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    # ---------- لایه حافظه ----------
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._chars > self.max_chars):
+            _, (_, value) = self._entries.popitem(last=False)
+            self._chars -= len(value)
+            self.stats["evictions"] += 1
+
+    def _remember(self, key: str, created_at: float, value: str):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._chars -= len(old[1])
+        self._entries[key] = (created_at, value)
+        self._chars += len(value)
+        self._evict()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if now - created_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return value
+                del self._entries[key]
+                self._chars -= len(value)
+
+            if self._disk is not None:
+                row = self._disk.execute(
+                    "SELECT created_at, value FROM ai_response_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row and now - row[0] < self.ttl:
+                    self._remember(key, row[0], row[1])
+                    self.stats["disk_hits"] += 1
+                    return row[1]
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key: str, value: str):
+        if not value or len(value) > self.max_chars:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            self.stats["stores"] += 1
+            if self._disk is not None:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO ai_response_cache (key, created_at, value) VALUES (?, ?, ?)",
+                    (key, now, value)
+                )
+
+    def purge_expired(self) -> int:
+        """حذف ورودی‌های منقضی از هر دو لایه"""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        with self._lock:
+            for key in [k for k, (created_at, _) in self._entries.items() if created_at <= cutoff]:
+                self._chars -= len(self._entries.pop(key)[1])
+                removed += 1
+            if self._disk is not None:
+                removed += self._disk.execute(
+                    "DELETE FROM ai_response_cache WHERE created_at <= ?", (cutoff,)
+                ).rowcount
+        return removed
+
+    def hit_rate(self) -> float:
+        hits = self.stats["hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def metrics(self) -> dict:
+        return {**self.stats, "entries": len(self._entries), "chars": self._chars,
+                "hit_rate": round(self.hit_rate(), 4)}
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+
+async def replay_stream(text: str, chunk_chars: int = 24, delay: float = 0.02):
+    """بازپخش متن کش‌شده به صورت تکه‌های کوچک (شبیه استریم واقعی)"""
+    for i in range(0, len(text), chunk_chars):
+        yield text[i:i + chunk_chars]
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def load_response_cache() -> ResponseCache | None:
+    """ساخت کش از بخش ai_cache در config.json (اگر فعال نباشد None)"""
+    config = load_config_section("ai_cache")
+    if not config.get("enabled"):
+        return None
+    return ResponseCache(
+        ttl=float(config.get("ttl", 3600)),
+        max_entries=int(config.get("max_entries", 1000)),
+        max_chars=int(config.get("max_chars", 5_000_000)),
+        disk_path=config.get("disk_path") or None,
+    )
@@ -4,53 +4,38 @@
 کاملاً جدا از هوش مصنوعی پشتیبانی (PeakAI)
 """
 
-import httpx
-import json
 import logging
 import asyncio
 import time
 from datetime import datetime
-from pathlib import Path
 
-# تنظیم مسیر فایل لاگ
-LOG_FILE = Path("peak_sales_ai.log")
+from ai_scheduler import AIScheduler, get_ai_scheduler
+from http_client import SharedHTTPClient
+from log_setup import new_request_id
+from model_router import ModelRouter, get_model_router
+from openrouter_stream import CHAT_COMPLETIONS_URL, OpenRouterChat
 
-# تنظیم لاگر
+# هندلرها در log_setup.setup_logging() و فقط در نقطه شروع برنامه اضافه می‌شوند
 logger = logging.getLogger("SalesAI")
-logger.setLevel(logging.DEBUG)
-
-# فرمت لاگ با میلی‌ثانیه
-formatter = logging.Formatter(
-    "[%(asctime)s.%(msecs)03d] [%(levelname)s] [%(funcName)s:%(lineno)d] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-
-# Handler فایل (همه سطوح)
-file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
-file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(formatter)
-
-# Handler کنسول (INFO و بالاتر)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(formatter)
-
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
-logger.propagate = False
-
-logger.info("لاگ‌گیری SalesAI شروع شد → فایل: %s", LOG_FILE.absolute())
 
 
 class SalesAI:
-    def __init__(self, api_key: str, model: str = "stepfun/step-3.5-flash:free"):
+    def __init__(self, api_key: str, model: str = "stepfun/step-3.5-flash:free",
+                 http_client: SharedHTTPClient | None = None, scheduler: AIScheduler | None = None,
+                 router: ModelRouter | None = None):
         """
         مقداردهی اولیه کلاس SalesAI
         این کلاس کاملاً جدا از PeakAI (هوش مصنوعی پشتیبانی) است
         """
         self.api_key = api_key.strip()
         self.model = model.strip()
-        self.base_url = "https://openrouter.ai/api/v1/chat/completions"
+        self.base_url = CHAT_COMPLETIONS_URL
+        # موتور مشترک استریم (کلاینت HTTP مشترک + پارسر تدریجی SSE)
+        self.engine = OpenRouterChat(self.api_key, "PeakTube Sales AI Bot", logger, http_client, self.base_url,
+                                     router or get_model_router())
+        self.http = self.engine.http
+        # زمان‌بند اولویت‌دار مشترک با PeakAI (سقف درخواست‌های هم‌زمان به OpenRouter)
+        self.scheduler = scheduler or get_ai_scheduler()
 
         self.system_prompt = (
             "شما دستیار فروش رسمی ربات PeakTube هستید. "
@@ -65,41 +50,13 @@ class SalesAI:
 
     async def check_health(self) -> bool:
         """بررسی وضعیت اتصال به OpenRouter"""
-        start = time.perf_counter()
-        logger.debug("شروع بررسی سلامت API")
-
-        try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                resp = await client.get(
-                    "https://openrouter.ai/api/v1/models",
-                    headers={"Authorization": f"Bearer {self.api_key}"}
-                )
-
-                elapsed = time.perf_counter() - start
-                logger.info("بررسی سلامت → کد: %d | زمان: %.3f ثانیه", resp.status_code, elapsed)
+        return await self.engine.check_health()
 
-                if resp.status_code == 200:
-                    logger.debug("اتصال برقرار است")
-                    return True
-                else:
-                    logger.warning("بررسی سلامت ناموفق → کد: %d | پاسخ: %s", resp.status_code, resp.text[:300])
-                    return False
-
-        except httpx.RequestError as e:
-            logger.error("خطای شبکه در health check: %s", str(e))
-            return False
-        except Exception as e:
-            logger.exception("خطای غیرمنتظره در health check")
-            return False
-
-    async def generate_sales_response(self, user_message: str, plan_info: dict = None):
+    def build_messages(self, user_message: str, plan_info: dict = None) -> list:
         """
-        تولید پاسخ برای جریان فروش
+        ساخت پیام‌های درخواست فروش
         plan_info شامل: plan_type, duration_days, price, card_number
         """
-        start_time = time.perf_counter()
-        logger.info("درخواست جدید فروش | طول پیام: %d کاراکتر", len(user_message))
-
         # ساخت prompt مخصوص فروش
         sales_context = ""
         if plan_info:
@@ -115,91 +72,37 @@ class SalesAI:
                 f"لطفاً به کاربر توضیح دهید که باید تصویر رسید پرداخت را ارسال کند."
             )
 
-        messages = [
+        return [
             {"role": "system", "content": self.system_prompt + " " + sales_context},
             {"role": "user", "content": user_message}
         ]
 
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://t.me/PeakTubeBot",
-            "X-Title": "PeakTube Sales AI Bot",
-        }
+    async def stream_events(self, user_message: str, plan_info: dict = None):
+        """استریم نوع‌دار (content / finish / usage / error / done) برای دسترسی به آمار توکن و تأخیر"""
+        logger.info("درخواست جدید فروش | طول پیام: %d کاراکتر", len(user_message))
+        async for event in self.engine.events(self.model, self.build_messages(user_message, plan_info)):
+            yield event
 
-        safe_headers = {k: v if k != "Authorization" else f"Bearer {v[:6]}***" for k, v in headers.items()}
-        logger.debug("ارسال درخواست → URL: %s | مدل: %s | هدرها: %s", self.base_url, self.model, safe_headers)
+    async def generate_sales_response(self, user_message: str, plan_info: dict = None,
+                                      plan: str | None = None, lang: str = "fa"):
+        """
+        تولید پاسخ برای جریان فروش
+        plan_info شامل: plan_type, duration_days, price, card_number
+        plan: پلن فعلی کاربر برای اولویت در صف؛ lang: زبان پیام ترافیک بالا
+        """
+        start_time = time.perf_counter()
+        new_request_id()
+        logger.info("درخواست جدید فروش | طول پیام: %d کاراکتر", len(user_message))
 
+        messages = self.build_messages(user_message, plan_info)
+        chars = 0
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(
-                    self.base_url,
-                    headers=headers,
-                    json={
-                        "model": self.model,
-                        "messages": messages,
-                        "stream": True,
-                    }
-                )
-
-                elapsed_initial = time.perf_counter() - start_time
-                logger.info("پاسخ اولیه دریافت شد → کد: %d | زمان تا پاسخ اول: %.3f ثانیه",
-                            response.status_code, elapsed_initial)
-
-                if response.status_code != 200:
-                    error_body = await response.aread()
-                    error_text = error_body.decode(errors="replace")
-                    error_msg = f"خطا {response.status_code}: {error_text[:300]}"
-                    logger.error("خطای HTTP → کد: %d | بدنه پاسخ: %s", response.status_code, error_text[:1000])
-                    yield error_msg
-                    return
-
-                full_text = ""
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
-                        if line.strip() == "data: [DONE]":
-                            break
-                        try:
-                            data = json.loads(line[6:].strip())
-                            delta = data.get("choices", [{}])[0].get("delta", {})
-                            content = delta.get("content", "")
-                            if content:
-                                full_text += content
-                                yield content
-                        except json.JSONDecodeError:
-                            logger.debug("خط JSON نامعتبر رد شد")
-                            continue
-                        except Exception as inner_e:
-                            logger.warning("خطا در پردازش خط استریم: %s", inner_e)
-                            continue
-
-                total_time = time.perf_counter() - start_time
-                logger.info("پاسخ کامل شد → طول: %d کاراکتر | زمان کل: %.3f ثانیه", len(full_text), total_time)
-
-                if not full_text.strip():
-                    logger.warning("پاسخ خالی دریافت شد")
-                    yield "متأسفانه پاسخی تولید نشد. لطفاً دوباره تلاش کنید."
-
-        except httpx.HTTPStatusError as http_err:
-            try:
-                error_body = await http_err.response.aread()
-                error_text = error_body.decode(errors="replace")
-            except:
-                error_text = "(نتوانست بدنه پاسخ خوانده شود)"
-
-            error_msg = f"خطای ارتباط (کد {http_err.response.status_code}): {error_text[:300]}"
-            logger.error("خطای HTTP → کد: %d | بدنه: %s", http_err.response.status_code, error_text[:1000])
-            yield error_msg
-
-        except httpx.RequestError as req_err:
-            logger.error("خطای شبکه/درخواست: %s", str(req_err))
-            yield "مشکل ارتباط شبکه با سرویس هوش مصنوعی رخ داد."
-
-        except Exception as e:
-            logger.exception("خطای غیرمنتظره در generate_sales_response")
-            yield "خطای داخلی در پردازش درخواست. لطفاً با پشتیبانی تماس بگیرید."
-
+            async for chunk in self.scheduler.run_stream(
+                plan, lambda: self.engine.stream_text(self.model, messages), lang
+            ):
+                chars += len(chunk)
+                yield chunk
         finally:
             total_time = time.perf_counter() - start_time
-            logger.debug("پایان متد generate_sales_response | زمان کل: %.3f ثانیه", total_time)
-
+            logger.debug("پایان متد generate_sales_response | زمان کل: %.3f ثانیه", total_time,
+                         extra={"model": self.model, "latency": round(total_time, 3), "chars": chars})
\ No newline at end of file
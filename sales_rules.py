@@ -0,0 +1,162 @@
+# sales_rules.py
+"""
+قوانین مسیریابی یوزربات فروش از فایل sales_intents.json (کنار config.json)
+- مشاوره‌های صوتی: جدول تطبیق دقیق O(1) از متن پیام → پلن و فایل صوتی
+- نیت‌ها: کلمات کلیدی، اولویت و قالب پاسخ؛ با IntentMatcher یک بار کامپایل می‌شوند
+- متن‌های مشترک (مثل vip_consult_*) از fa.json / en.json خوانده می‌شوند (trigger_keys / reply_key)
+- تغییر فایل بدون راه‌اندازی مجدد کلاینت اعمال می‌شود (بررسی mtime)؛ فایل نامعتبر نادیده گرفته می‌شود
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass
+
+from intent_matcher import IntentMatcher
+
+logger = logging.getLogger("PeakSalesRules")
+
+SALES_RULES_FILE = "sales_intents.json"
+LANG_FILES = ("fa.json", "en.json")
+
+# فقط {name} ساده جایگزین می‌شود؛ آکولادهای دیگر متن (مثلاً ایموجی یا JSON) دست‌نخورده می‌مانند
+PLACEHOLDER_RE = re.compile(r"\{(\w+)\}")
+
+
+@dataclass(frozen=True)
+class Consultation:
+    plan: str
+    voice: str
+    reply: str
+
+
+@dataclass(frozen=True)
+class IntentRule:
+    name: str
+    priority: int
+    reply: str
+    parse_mode: str | None = None
+
+    def render(self, **values) -> str:
+        if not values:
+            return self.reply
+        return PLACEHOLDER_RE.sub(lambda m: str(values.get(m.group(1), m.group(0))), self.reply)
+
+
+def _load_lang_texts() -> list[dict]:
+    texts = []
+    for path in LANG_FILES:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                texts.append(json.load(f))
+        except (OSError, json.JSONDecodeError):
+            continue
+    return texts
+
+
+class SalesRules:
+    """نسخه کامپایل‌شده و فقط‌خواندنی قوانین"""
+
+    def __init__(self, data: dict, lang_texts: list[dict] | None = None):
+        lang_texts = _load_lang_texts() if lang_texts is None else lang_texts
+
+        def from_lang(key: str) -> list[str]:
+            return [texts[key] for texts in lang_texts if key in texts]
+
+        # جدول تطبیق دقیق: متن دکمه/پیام آماده → مشاوره
+        self.exact: dict[str, Consultation] = {}
+        default_reply = data.get("consultation_reply", "")
+        for item in data.get("consultations", []):
+            consultation = Consultation(
+                plan=item["plan"],
+                voice=item["voice"],
+                reply=item.get("reply", default_reply).format(plan=item["plan"]),
+            )
+            triggers = list(item.get("triggers", []))
+            for key in item.get("trigger_keys", []):
+                triggers += from_lang(key)
+            for trigger in triggers:
+                self.exact[trigger] = consultation
+
+        # نیت‌ها به ترتیب اولویت (عدد کمتر = اولویت بالاتر)
+        self.intents: dict[str, IntentRule] = {}
+        keywords: dict[str, list[str]] = {}
+        for item in sorted(data.get("intents", []), key=lambda i: i.get("priority", 0)):
+            reply = item.get("reply")
+            if reply is None and item.get("reply_key"):
+                reply = (from_lang(item["reply_key"]) or [""])[0]
+            self.intents[item["name"]] = IntentRule(
+                name=item["name"],
+                priority=item.get("priority", 0),
+                reply=reply or "",
+                parse_mode=item.get("parse_mode"),
+            )
+            keywords[item["name"]] = item.get("keywords", [])
+        self.matcher = IntentMatcher(keywords)
+
+    @property
+    def voices(self) -> list[str]:
+        return sorted({consultation.voice for consultation in self.exact.values()})
+
+    def consultation_for(self, text: str) -> Consultation | None:
+        return self.exact.get(text)
+
+    def match(self, text: str) -> IntentRule | None:
+        """نیت با بالاترین اولویت در بین دسته‌های یافت‌شده"""
+        name = self.matcher.classify(text)
+        return self.intents.get(name) if name else None
+
+
+def load_sales_rules(path: str = SALES_RULES_FILE) -> SalesRules:
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: ریشه فایل قوانین باید یک شیء JSON باشد")
+    return SalesRules(data)
+
+
+class SalesRulesLoader:
+    """
+    بارگذاری تنبل و بارگذاری مجدد خودکار قوانین
+    حداکثر هر check_interval ثانیه یک stat روی فایل انجام می‌شود
+    """
+
+    def __init__(self, path: str = SALES_RULES_FILE, check_interval: float = 2.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._rules: SalesRules | None = None
+        self._mtime: float | None = None
+        self._checked_at = 0.0
+        self.reloads = 0
+
+    def current(self) -> SalesRules:
+        now = time.monotonic()
+        if self._rules is None or now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            self._reload_if_changed()
+        return self._rules
+
+    def _reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            if self._rules is None:
+                raise
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            rules = load_sales_rules(self.path)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            if self._rules is None:
+                raise
+            logger.error("فایل قوانین فروش نامعتبر است؛ نسخه قبلی حفظ شد: %s", e)
+            self._mtime = mtime
+            return
+        if self._rules is not None:
+            logger.info("قوانین فروش دوباره بارگذاری شد ← %s", self.path)
+        self._rules = rules
+        self._mtime = mtime
+        self.reloads += 1
@@ -0,0 +1,195 @@
+# sales_sessions.py
+"""
+وضعیت جلسه فروش یوزربات (آخرین پلن انتخاب‌شده هر کاربر) به جای دیکشنری درون‌حافظه‌ای
+- خواندن O(1) از حافظه برای فیش‌های دریافتی
+- انقضای هر مدخل بعد از ttl و سقف تعداد مدخل‌ها در حافظه (حذف قدیمی‌ترین)
+- ذخیره تأخیری (write-behind) در جدول sales_sessions پایگاه داده محلی
+- بعد از راه‌اندازی مجدد، مدخل‌های منقضی‌نشده با یک کوئری بارگذاری می‌شوند
+"""
+
+import asyncio
+import atexit
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from storage import DEFAULT_DB_FILE, load_config_section
+
+
+class SalesSessionStore:
+    def __init__(self, db_path: str = DEFAULT_DB_FILE, ttl: float = 7 * 24 * 3600,
+                 max_entries: int = 10000, flush_interval: float = 5.0):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        # user_id → (plan, updated_at)
+        self._entries: "OrderedDict[int, tuple[str, float]]" = OrderedDict()
+        # user_id → (plan, updated_at) برای upsert یا None برای حذف
+        self._pending: dict[int, tuple[str, float] | None] = {}
+        self._flusher_task: asyncio.Task | None = None
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "flushes": 0}
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sales_sessions (
+                user_id INTEGER PRIMARY KEY,
+                plan TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_sales_sessions_updated ON sales_sessions(updated_at);
+        """)
+        self._load()
+
+    def _load(self):
+        """بارگذاری جدیدترین مدخل‌های معتبر و پاک کردن منقضی‌ها از دیسک"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            self._conn.execute("DELETE FROM sales_sessions WHERE updated_at < ?", (cutoff,))
+            rows = self._conn.execute(
+                "SELECT user_id, plan, updated_at FROM (SELECT * FROM sales_sessions"
+                " ORDER BY updated_at DESC LIMIT ?) ORDER BY updated_at",
+                (self.max_entries,)
+            ).fetchall()
+            self._entries = OrderedDict((user_id, (plan, updated_at)) for user_id, plan, updated_at in rows)
+
+    # ---------- حافظه ----------
+    def get(self, user_id: int, default: str | None = None) -> str | None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.stats["misses"] += 1
+                return default
+            plan, updated_at = entry
+            if time.time() - updated_at >= self.ttl:
+                self.stats["expired"] += 1
+                self._drop(user_id)
+                return default
+            self.stats["hits"] += 1
+            return plan
+
+    def set(self, user_id: int, plan: str):
+        now = time.time()
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (plan, now)
+            self._pending[user_id] = (plan, now)
+            while len(self._entries) > self.max_entries:
+                old_id, _ = self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+                self._pending[old_id] = None
+
+    def _drop(self, user_id: int):
+        self._entries.pop(user_id, None)
+        self._pending[user_id] = None
+
+    def pop(self, user_id: int, default: str | None = None) -> str | None:
+        with self._lock:
+            plan = self.get(user_id, default)
+            if user_id in self._entries:
+                self._drop(user_id)
+            return plan
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def purge_expired(self) -> int:
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [user_id for user_id, (_, updated_at) in self._entries.items() if updated_at < cutoff]
+            for user_id in expired:
+                self._drop(user_id)
+            self.stats["expired"] += len(expired)
+            return len(expired)
+
+    # ---------- پایگاه داده ----------
+    def flush(self) -> int:
+        """ذخیره تغییرات معلق در یک تراکنش؛ بازگشت: تعداد تغییرات"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            upserts = [(user_id, *entry) for user_id, entry in pending.items() if entry is not None]
+            deletes = [(user_id,) for user_id, entry in pending.items() if entry is None]
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO sales_sessions (user_id, plan, updated_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT(user_id) DO UPDATE SET plan = excluded.plan, updated_at = excluded.updated_at",
+                    upserts
+                )
+                self._conn.executemany("DELETE FROM sales_sessions WHERE user_id = ?", deletes)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                # تغییرات جدیدتر (در صورت وجود) بر تغییرات شکست‌خورده اولویت دارند
+                self._pending = {**pending, **self._pending}
+                raise
+            self.stats["flushes"] += 1
+            return len(pending)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.purge_expired()
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                print(f"خطا در ذخیره جلسه‌های فروش: {e}")
+
+    def start(self):
+        """شروع ذخیره دوره‌ای (باید داخل event loop فراخوانی شود)"""
+        if self._flusher_task is None or self._flusher_task.done():
+            self._flusher_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flusher_task is not None:
+            self._flusher_task.cancel()
+            try:
+                await self._flusher_task
+            except asyncio.CancelledError:
+                pass
+            self._flusher_task = None
+        self.flush()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._conn.close()
+
+
+# ==================== نمونه مشترک ====================
+_sessions: SalesSessionStore | None = None
+_sessions_lock = threading.Lock()
+
+
+def get_sales_sessions() -> SalesSessionStore:
+    """جلسه‌های فروش (یک نمونه برای کل پروسه؛ تنظیمات از بخش sales_sessions در config.json)"""
+    global _sessions
+    if _sessions is None:
+        with _sessions_lock:
+            if _sessions is None:
+                config = load_config_section("sales_sessions")
+                _sessions = SalesSessionStore(
+                    db_path=config.get("db_path") or DEFAULT_DB_FILE,
+                    ttl=float(config.get("ttl_hours", 168)) * 3600,
+                    max_entries=int(config.get("max_entries", 10000)),
+                    flush_interval=float(config.get("flush_interval", 5.0)),
+                )
+    return _sessions
+
+
+@atexit.register
+def _flush_on_exit():
+    if _sessions is not None:
+        try:
+            _sessions.flush()
+        except Exception as e:
+            print(f"خطا در ذخیره نهایی جلسه‌های فروش: {e}")
@@ -4,9 +4,18 @@
 
 import asyncio
 import os
+import time
 from telethon import TelegramClient, events, types
 from telethon import functions
-from telethon.tl.types import DocumentAttributeAudio  # ضروری برای Voice Note واقعی
+
+from chat_dispatcher import ChatDispatcher, pause
+from metrics import SALES_DISPATCH_SECONDS, start_metrics_server
+from receipt_outbox import create_receipt_outbox
+from sales_rules import SalesRulesLoader
+from sales_sessions import get_sales_sessions
+from sender_cache import SenderCache
+from storage import load_config_section
+from voice_cache import VoiceMediaCache
 
 # ==================== تنظیمات ====================
 api_id = 38060006                     # ← api_id خودت را وارد کن
@@ -19,39 +28,37 @@ BOT_ID = 8462120028  # ← آیدی عددی ربات اصلی را اینجا 
 # شماره کارت برای بخش مالی
 CARD_NUMBER = "6037-9919-1234-5678"   # ← شماره کارت واقعی خودت را وارد کن
 
-# فایل‌های صوتی مشاوره (باید در همان پوشه پروژه باشند)
-VOICE_PREMIUM_7D = "premium_7d.mp3"     # پریمیوم ۷ روزه
-VOICE_PREMIUM_1M = "premium_1m.mp3"     # پریمیوم ۳۰ روزه
-VOICE_PRO_7D     = "pro_7d.mp3"         # حرفه‌ای ۷ روزه
-VOICE_PRO_1M     = "pro_1m.mp3"         # حرفه‌ای ۳۰ روزه
-
 # پروکسی (در صورت نیاز)
 proxy = None
 
-# ==================== حافظه موقت پلن انتخاب‌شده کاربر ====================
-# دیکشنری برای ذخیره آخرین پلن انتخاب‌شده توسط هر کاربر
-# کلید: user_id، مقدار: نام فارسی پلن
-user_selected_plan = {}
+# ==================== حافظه پلن انتخاب‌شده کاربر ====================
+# آخرین پلن انتخاب‌شده هر کاربر (کلید: user_id، مقدار: نام فارسی پلن)
+# با انقضای خودکار و ذخیره در پایگاه داده؛ بعد از راه‌اندازی مجدد حفظ می‌شود
+user_selected_plan = get_sales_sessions()
+
+# ==================== قوانین فروش (sales_intents.json) ====================
+# مشاوره‌های صوتی، کلمات کلیدی، اولویت‌ها و متن پاسخ‌ها از فایل خوانده می‌شوند
+# و تغییر فایل بدون راه‌اندازی مجدد کلاینت اعمال می‌شود
+SALES_RULES = SalesRulesLoader()
+
+# ==================== کش هویت خود و فرستنده‌ها ====================
+SENDERS = SenderCache()
 
 # ==================== توابع کمکی ====================
 async def send_voice_with_recording_status(client: TelegramClient, event, file_path: str, duration: float = 1.5):
-    if not os.path.exists(file_path):
-        await event.reply(f"⚠️ فایل صوتی یافت نشد: {os.path.basename(file_path)}\nلطفاً فایل را در پوشه پروژه قرار دهید.")
-        return
-
     await client(functions.messages.SetTypingRequest(
         peer=event.chat_id,
         action=types.SendMessageRecordAudioAction()
     ))
 
-    await asyncio.sleep(duration)
+    await pause(duration)
 
     try:
-        await event.reply(
-            file=file_path,
-            attributes=[DocumentAttributeAudio(duration=60, voice=True)]
-        )
+        # ارسال با مرجع فایل ذخیره‌شده (آپلود فقط بار اول یا بعد از تغییر فایل)
+        await VOICES.send_voice(event.chat_id, file_path, reply_to=event.message.id)
         await client.send_read_acknowledge(event.chat_id, max_id=event.message.id)
+    except FileNotFoundError:
+        await event.reply(f"⚠️ فایل صوتی یافت نشد: {os.path.basename(file_path)}\nلطفاً فایل را در پوشه پروژه قرار دهید.")
     except Exception as e:
         await event.reply(f"⚠️ خطا در ارسال ویس: {str(e)}")
     finally:
@@ -63,90 +70,71 @@ async def send_voice_with_recording_status(client: TelegramClient, event, file_p
 # ==================== کلاینت اصلی ====================
 client = TelegramClient(session_name, api_id, api_hash, proxy=proxy)
 
+# کش مرجع فایل‌های صوتی مشاوره (voice_cache.json)
+VOICES = VoiceMediaCache(client)
+
+# صندوق خروجی پایدار فیش‌ها؛ ارسال به ربات اصلی با تلاش مجدد و بدون ارسال تکراری
+RECEIPTS = create_receipt_outbox(client, BOT_ID)
+
+async def timed_handle_message(event):
+    start = time.perf_counter()
+    try:
+        await handle_message(event)
+    finally:
+        SALES_DISPATCH_SECONDS.observe(time.perf_counter() - start)
+
+# صف FIFO هر چت + استخر محدود کارگرها (تنظیمات از بخش sales_dispatcher در config.json)
+_dispatcher_config = load_config_section("sales_dispatcher")
+DISPATCHER = ChatDispatcher(
+    timed_handle_message,
+    max_workers=int(_dispatcher_config.get("max_workers", 8)),
+    max_pending=int(_dispatcher_config.get("max_pending", 1000)),
+    idle_timeout=float(_dispatcher_config.get("idle_timeout", 30.0)),
+)
+
 @client.on(events.NewMessage(incoming=True))
 async def handler(event):
+    # فقط پیام‌های خصوصی وارد صف می‌شوند
+    if not event.is_private:
+        return
+    await DISPATCHER.submit(event.chat_id, event)
+
+async def handle_message(event):
     # فقط پیام‌های خصوصی
     if not event.is_private:
         return
 
-    # دریافت sender به صورت ایمن
+    # فیلتر پیام‌های خود یوزربات (Self) فقط با sender_id و شناسه کش‌شده (بدون get_me و دریافت entity)
+    if await SENDERS.is_self(client, event.sender_id):
+        return
+
+    # دریافت sender به صورت ایمن (از کش / همراه update / در صورت نیاز از شبکه)
     try:
-        sender = await event.get_sender()
+        sender = await SENDERS.get_sender(event)
     except Exception:
         return
 
     if sender is None:
         return
 
-    # فیلتر امنیتی سخت‌گیرانه: نادیده گرفتن ربات‌ها و پیام‌های خود یوزربات (Self/Out)
+    # فیلتر امنیتی سخت‌گیرانه: نادیده گرفتن ربات‌ها
     if getattr(sender, 'bot', False):
         return
 
-    me = await client.get_me()
-    if sender.id == me.id:
-        return
-
     # دریافت متن پیام و تشخیص تصویر
     text = (event.message.message or "").strip().lower()
     original_text = event.message.message or ""
     has_photo = bool(event.message.photo)
 
-    # تعریف دیکشنری کلمات کلیدی (بخش‌بندی CRM)
-    KEYWORDS = {
-        "سلام": ["سلام", "درود", "سلا", "وقت بخیر", "خسته نباشید", "hi", "hello", "سلام عزیز"],
-        "فنی": ["سرعت", "کیفیت", "حجم", "محدودیت", "قطعی", "فول اچ دی", "4k", "دانلود سریع"],
-        "پشتیبانی": ["ادمین", "پشتیبان", "پشتیبانی", "مدیر", "اپراتور", "وصل کن", "ارتباط با ادمین"],
-        "تخفیف": ["تخفیف", "ارزون", "قیمت آخر", "کد تخفیف", "آف", "حراج"],
-        "اعتماد": ["مطمئن", "اعتماد", "کلاهبرداری", "تضمین", "واقعی", "نمونه کار", "رضایت"],
-        "مالی": ["کارت", "واریز", "شماره حساب", "هزینه", "چجوری بخرم", "پرداخت", "قیمت"],
-        "درخواست_فیش": ["واریز کردم", "پرداخت شد", "فرستادم", "رسید", "فیش", "بفرستم", "انتقال دادم"],
-        "تشکر": ["ممنون", "مرسی", "سپاس", "دمت گرم", "عالی بود", "تشکر", "خوبه"],
-        "خداحافظی": ["خداحافظ", "فعلا", "یا علی", "بای", "خسته نباشی", "موفق باشی"]
-    }
-
-    # اولویت اول: مشاوره‌های صوتی (۴ پلن دقیق) + ذخیره پلن انتخاب‌شده
-    if original_text == "مشاوره_سرویس_هفت_روزه_پرمیوم":
-        user_selected_plan[sender.id] = "پریمیوم هفت‌روزه"  # ذخیره پلن
-        await event.reply(
-            "با درود و احترام؛\n"
-            "درخواست شما جهت دریافت اطلاعات پلن **پریمیوم هفت‌روزه** دریافت شد.\n"
-            "لطفاً به راهنمای صوتی زیر توجه فرمایید:"
-        )
-        await asyncio.sleep(1)
-        await send_voice_with_recording_status(client, event, VOICE_PREMIUM_7D, duration=1.5)
-        return
-
-    elif original_text == "مشاوره_سرویس_یک_ماهه_پرمیوم":
-        user_selected_plan[sender.id] = "پریمیوم یک‌ماهه"  # ذخیره پلن
-        await event.reply(
-            "با درود و احترام؛\n"
-            "درخواست شما جهت دریافت اطلاعات پلن **پریمیوم یک‌ماهه** دریافت شد.\n"
-            "لطفاً به راهنمای صوتی زیر توجه فرمایید:"
-        )
-        await asyncio.sleep(1)
-        await send_voice_with_recording_status(client, event, VOICE_PREMIUM_1M, duration=1.5)
-        return
-
-    elif original_text == "مشاوره_سرویس_هفت_روزه_حرفه_ای":
-        user_selected_plan[sender.id] = "حرفه‌ای هفت‌روزه"  # ذخیره پلن
-        await event.reply(
-            "با درود و احترام؛\n"
-            "درخواست شما جهت دریافت اطلاعات پلن **حرفه‌ای هفت‌روزه** دریافت شد.\n"
-            "لطفاً به راهنمای صوتی زیر توجه فرمایید:"
-        )
-        await asyncio.sleep(1)
-        await send_voice_with_recording_status(client, event, VOICE_PRO_7D, duration=1.5)
-        return
+    rules = SALES_RULES.current()
 
-    elif original_text == "مشاوره_سرویس_یک_ماهه_حرفه_ای":
-        user_selected_plan[sender.id] = "حرفه‌ای یک‌ماهه"  # ذخیره پلن
-        await event.reply(
-            "با درود و احترام؛\n"
-            "درخواست شما جهت دریافت اطلاعات پلن **حرفه‌ای یک‌ماهه** دریافت شد.\n"
-            "لطفاً به راهنمای صوتی زیر توجه فرمایید:"
-        )
-        await asyncio.sleep(1)
-        await send_voice_with_recording_status(client, event, VOICE_PRO_1M, duration=1.5)
+    # اولویت اول: مشاوره‌های صوتی (تطبیق دقیق متن) + ذخیره پلن انتخاب‌شده
+    consultation = rules.consultation_for(original_text)
+    if consultation is not None:
+        user_selected_plan.set(sender.id, consultation.plan)  # ذخیره پلن
+        await event.reply(consultation.reply)
+        await pause(1)
+        await send_voice_with_recording_status(client, event, consultation.voice, duration=1.5)
         return
 
     # اولویت دوم: تشخیص و ارسال خودکار فیش (عکس) + گزارش پلن
@@ -154,19 +142,20 @@ async def handler(event):
         # دریافت پلن انتخاب‌شده (اگر وجود نداشت، نامشخص)
         selected_plan = user_selected_plan.get(sender.id, "نامشخص")
 
-        # ارسال تصویر فیش به ربات اصلی با فرمت دقیق کپشن
+        # ثبت فیش در صندوق خروجی؛ ارسال به ربات اصلی (#FINANCE_REPORT USER_ID: ... PLAN: ...) در پس‌زمینه
         try:
-            await client.send_file(
-                BOT_ID,
-                event.message.photo,
-                caption=f"#FINANCE_REPORT USER_ID: {sender.id} PLAN: {selected_plan}"
+            await RECEIPTS.enqueue(
+                sender.id,
+                selected_plan,
+                event.chat_id,
+                event.message.id,
+                media=event.message.photo,
             )
 
-            # پاکسازی حافظه پلن بعد از ارسال موفق
-            if sender.id in user_selected_plan:
-                del user_selected_plan[sender.id]
+            # پلن در صندوق ثبت شد؛ پاکسازی حافظه پلن
+            user_selected_plan.pop(sender.id)
         except Exception as e:
-            print(f"خطا در ارسال فیش به ربات اصلی: {e}")
+            print(f"خطا در ثبت فیش در صندوق خروجی: {e}")
 
         # پاسخ به کاربر با ذکر پلن
         plan_mention = f"پلن {selected_plan}" if selected_plan != "نامشخص" else "درخواست شما"
@@ -178,92 +167,13 @@ async def handler(event):
         )
         return
 
-    # اولویت سوم: درخواست فیش (بدون عکس اما ادعای پرداخت)
-    if any(word in text for word in KEYWORDS["درخواست_فیش"]):
-        await event.reply(
-            "با درود؛\n"
-            "جهت ثبت و فعال‌سازی اشتراک، لطفاً تصویر (اسکرین‌شات) واضح رسید واریزی خود را در همین‌جا ارسال کنید.\n"
-            "تا زمانی که تصویر رسید دریافت نشود، امکان پردازش و فعال‌سازی وجود ندارد 🙏"
-        )
-        return
-
-    # اولویت چهارم: پاسخ‌های متنی تفکیک‌شده بر اساس کلمات کلیدی
-    responded = False
-
-    if any(word in text for word in KEYWORDS["سلام"]):
-        await event.reply(
-            "با درود و احترام؛\n"
-            "خوش آمدید به واحد فروش PeakTube 🌹\n"
-            "در خدمت شما هستیم. لطفاً پلن مورد نظر یا سوال خود را مطرح فرمایید."
-        )
-        responded = True
-
-    elif any(word in text for word in KEYWORDS["فنی"]):
-        await event.reply(
-            "با درود؛\n"
-            "در پلن‌های VIP ما:\n"
-            "• حداکثر سرعت دانلود (بدون محدودیت پهنای باند)\n"
-            "• کیفیت تا ۴K و بالاتر (در پلن حرفه‌ای)\n"
-            "• بدون محدودیت حجمی یا تعداد دانلود روزانه\n"
-            "• پایداری بالا و بدون قطعی\n"
-            "تجربه‌ای کاملاً حرفه‌ای خواهید داشت 🚀"
-        )
-        responded = True
-
-    elif any(word in text for word in KEYWORDS["پشتیبانی"]):
-        await event.reply(
-            "با درود؛\n"
-            "شما مستقیماً با واحد فروش در ارتباط هستید.\n"
-            "تمام سوالات و درخواست‌های شما در سریع‌ترین زمان ممکن بررسی و پاسخ داده می‌شود.\n"
-            "لطفاً سوال خود را مطرح فرمایید 🙏"
-        )
-        responded = True
-
-    elif any(word in text for word in KEYWORDS["تخفیف"]):
-        await event.reply(
-            "با درود؛\n"
-            "بهترین ارزش خرید در پلن‌های یک‌ماهه است!\n"
-            "با انتخاب پلن یک‌ماهه، هزینه روزانه به حداقل می‌رسد.\n"
-            "توصیه ما: پلن حرفه‌ای یک‌ماهه برای بهترین تجربه و ارزش 💎"
-        )
-        responded = True
-
-    elif any(word in text for word in KEYWORDS["اعتماد"]):
-        await event.reply(
-            "با درود؛\n"
-            "PeakTube با بیش از دو سال فعالیت موفق و هزاران کاربر راضی،\n"
-            "یکی از معتبرترین سرویس‌های دانلود یوتیوب در ایران است.\n"
-            "پرداخت مستقیم به مدیریت و فعال‌سازی دستی، تضمین امنیت و سرعت شماست.\n"
-            "رضایت شما اولویت ماست 🌟"
-        )
-        responded = True
-
-    elif any(word in text for word in KEYWORDS["مالی"]):
-        await event.reply(
-            f"با درود و احترام؛\n"
-            f"جهت پرداخت، لطفاً مبلغ پلن انتخابی را به شماره کارت زیر واریز نمایید:\n\n"
-            f"💳 `{CARD_NUMBER}`\n"
-            f"🏛 بانک ملت - به نام مدیریت PeakTube\n\n"
-            f"پس از واریز، تصویر رسید را در همین چت ارسال فرمایید تا بلافاصله پردازش شود.",
-            parse_mode='md'
-        )
-        responded = True
-
-    elif any(word in text for word in KEYWORDS["تشکر"]):
-        await event.reply(
-            "سپاس فراوان از لطف و اعتماد شما 🙏\n"
-            "خوشحالیم که در خدمتتان بودیم.\n"
-            "در صورت نیاز مجدد، همیشه در دسترس هستیم 🌹"
-        )
-        responded = True
-
-    elif any(word in text for word in KEYWORDS["خداحافظی"]):
-        await event.reply(
-            "با آرزوی موفقیت برای شما؛\n"
-            "در صورت نیاز مجدد، با کمال میل در خدمت هستیم 🌟\n"
-            "روز خوبی داشته باشید!"
-        )
-        responded = True
+    # اولویت سوم و چهارم: درخواست فیش (بدون عکس) و پاسخ‌های متنی بر اساس کلمات کلیدی
+    # بین دسته‌های یافت‌شده، دسته با بالاترین اولویت در فایل قوانین پاسخ داده می‌شود
+    intent = rules.match(text)
+    if intent is not None:
+        # parse_mode فقط در صورت تعیین در فایل ارسال می‌شود (در غیر این صورت پیش‌فرض کلاینت)
+        options = {"parse_mode": intent.parse_mode} if intent.parse_mode else {}
+        await event.reply(intent.render(card_number=CARD_NUMBER), **options)
 
 # ==================== اجرا ====================
 async def main():
@@ -272,16 +182,25 @@ async def main():
     print("  • حافظه موقت برای آخرین پلن انتخاب‌شده هر کاربر")
     print("  • گزارش دقیق پلن در کپشن فیش (#FINANCE_REPORT USER_ID: ... PLAN: ...)")
     print("  • ذکر نام پلن در تاییدیه به کاربر")
-    print("  • پاکسازی خودکار حافظه پس از ارسال موفق فیش")
+    print("  • پاکسازی خودکار حافظه پس از ثبت فیش")
+    print("  • صندوق خروجی پایدار فیش‌ها با تلاش مجدد خودکار")
     print("\nفایل‌های صوتی مورد نیاز:")
-    print(f"  - {VOICE_PREMIUM_7D}")
-    print(f"  - {VOICE_PREMIUM_1M}")
-    print(f"  - {VOICE_PRO_7D}")
-    print(f"  - {VOICE_PRO_1M}")
+    for voice in SALES_RULES.current().voices:
+        print(f"  - {voice}")
     print("\nبرای خروج Ctrl+C بزنید.")
 
+    await start_metrics_server()
     await client.start()
-    await client.run_until_disconnected()
+    await SENDERS.load_self(client)
+    user_selected_plan.start()
+    await RECEIPTS.start()
+    try:
+        await client.run_until_disconnected()
+    finally:
+        await DISPATCHER.join(timeout=10)
+        await DISPATCHER.close()
+        await RECEIPTS.stop()
+        await user_selected_plan.stop()
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,116 @@
+# sender_cache.py
+"""
+کش هویت یوزربات و فرستنده پیام‌ها برای مسیر داغ sales_userbot
+- شناسه خود یوزربات یک بار هنگام شروع خوانده می‌شود (بدون get_me در هر پیام)
+- بررسی «پیام از خودم» فقط با event.sender_id و بدون دریافت entity
+- entity فرستنده در کش محدود با انقضای TTL نگه داشته می‌شود؛ entity همراه update بدون درخواست شبکه استفاده می‌شود
+- شمارنده درخواست‌های شبکه‌ای صرفه‌جویی‌شده (کل برای rate() در Prometheus و پنجره لغزان ۶۰ ثانیه‌ای)
+"""
+
+import time
+from collections import OrderedDict, deque
+
+from metrics import get_registry
+
+SENDER_LOOKUPS = get_registry().counter(
+    "peak_sales_sender_lookups_total", "دریافت فرستنده به تفکیک منبع (cache / update / network)", ("source",))
+GET_ME_AVOIDED = get_registry().counter(
+    "peak_sales_get_me_avoided_total", "فراخوانی‌های get_me که با شناسه کش‌شده حذف شدند")
+LOOKUPS_AVOIDED = get_registry().counter(
+    "peak_sales_lookups_avoided_total", "درخواست‌های شبکه‌ای (get_me / get_sender) که با کش حذف شدند")
+
+RATE_WINDOW = 60.0
+
+
+class SenderCache:
+    def __init__(self, ttl: float = 600.0, max_entries: int = 5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.self_id: int | None = None
+        self._entries: "OrderedDict[int, tuple[float, object]]" = OrderedDict()
+        self.stats = {"cache_hits": 0, "from_update": 0, "network_lookups": 0, "get_me_avoided": 0, "evictions": 0}
+        # [ثانیه، تعداد] صرفه‌جویی‌های ۶۰ ثانیه اخیر
+        self._recent: deque = deque()
+
+    def _note_avoided(self):
+        LOOKUPS_AVOIDED.inc()
+        second = int(time.monotonic())
+        if self._recent and self._recent[-1][0] == second:
+            self._recent[-1][1] += 1
+        else:
+            self._recent.append([second, 1])
+
+    # ---------- هویت خود یوزربات ----------
+    async def load_self(self, client) -> int:
+        """یک بار بعد از client.start() فراخوانی شود"""
+        me = await client.get_me()
+        self.self_id = me.id
+        return self.self_id
+
+    async def is_self(self, client, sender_id: int | None) -> bool:
+        if self.self_id is None:
+            await self.load_self(client)
+        else:
+            self.stats["get_me_avoided"] += 1
+            GET_ME_AVOIDED.inc()
+            self._note_avoided()
+        return sender_id == self.self_id
+
+    # ---------- فرستنده ----------
+    def _remember(self, sender_id: int, sender):
+        self._entries.pop(sender_id, None)
+        self._entries[sender_id] = (time.monotonic(), sender)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def get_sender(self, event):
+        """entity فرستنده: کش → entity همراه update → درخواست شبکه (event.get_sender)"""
+        sender_id = event.sender_id
+        entry = self._entries.get(sender_id)
+        if entry is not None:
+            stored_at, sender = entry
+            if time.monotonic() - stored_at < self.ttl:
+                self._entries.move_to_end(sender_id)
+                self.stats["cache_hits"] += 1
+                SENDER_LOOKUPS.inc(source="cache")
+                self._note_avoided()
+                return sender
+            del self._entries[sender_id]
+
+        # Telethon entityهای موجود در خود update را بدون درخواست شبکه روی event.sender قرار می‌دهد
+        sender = getattr(event, "sender", None)
+        if sender is not None:
+            self.stats["from_update"] += 1
+            SENDER_LOOKUPS.inc(source="update")
+            self._note_avoided()
+        else:
+            sender = await event.get_sender()
+            self.stats["network_lookups"] += 1
+            SENDER_LOOKUPS.inc(source="network")
+        if sender is not None:
+            self._remember(sender_id, sender)
+        return sender
+
+    def forget(self, sender_id: int):
+        self._entries.pop(sender_id, None)
+
+    # ---------- آمار ----------
+    @property
+    def lookups_avoided(self) -> int:
+        return self.stats["cache_hits"] + self.stats["from_update"] + self.stats["get_me_avoided"]
+
+    def avoided_last_minute(self) -> int:
+        """صرفه‌جویی‌های ۶۰ ثانیه اخیر (نه میانگین از زمان شروع)"""
+        cutoff = int(time.monotonic() - RATE_WINDOW)
+        while self._recent and self._recent[0][0] <= cutoff:
+            self._recent.popleft()
+        return sum(count for _, count in self._recent)
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "lookups_avoided": self.lookups_avoided,
+            "avoided_last_minute": self.avoided_last_minute(),
+        }
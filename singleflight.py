@@ -0,0 +1,117 @@
+# singleflight.py
+"""
+یکی‌سازی درخواست‌های هم‌زمان یکسان (single-flight)
+چند درخواست با کلید یکسان به یک استریم upstream متصل می‌شوند؛
+تکه‌ها در یک بافر مشترک نگه داشته می‌شوند و به همه مشترکین (حتی دیرآمده‌ها، از ابتدای بافر) می‌رسند
+"""
+
+import asyncio
+import logging
+
+from ai_scheduler import QueueFullError
+
+logger = logging.getLogger("PeakSingleFlight")
+
+
+class _Flight:
+    __slots__ = ("chunks", "done", "error", "updated", "subscribers", "task", "context")
+
+    def __init__(self):
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.updated = asyncio.Event()
+        self.subscribers = 0
+        self.task: asyncio.Task | None = None
+        self.context = None
+
+    def notify(self):
+        # بیدار کردن همه منتظرها و ساختن Event تازه برای تکه بعدی
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+
+class SingleFlight:
+    def __init__(self, expected_errors: tuple = ()):
+        """
+        expected_errors: خطاهای کنترلی (مثلاً QueueFullError حذف بار) که بدون traceback به مشترکین می‌رسند
+        """
+        self.expected_errors = tuple(expected_errors)
+        self._flights: dict[str, _Flight] = {}
+        self.stats = {"upstream_requests": 0, "coalesced": 0}
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def _produce(self, key: str, flight: _Flight, factory):
+        try:
+            async for chunk in factory():
+                flight.chunks.append(chunk)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            # هر flight فقط یک بار به اینجا می‌رسد؛ مشترکین همان خطا را بدون لاگ دوباره دریافت می‌کنند
+            if isinstance(e, self.expected_errors):
+                logger.debug("استریم مشترک با خطای مورد انتظار پایان یافت: %r", e)
+            else:
+                logger.exception("خطا در استریم مشترک")
+            flight.error = e
+        finally:
+            flight.done = True
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.notify()
+
+    async def stream(self, key: str, factory, context=None, on_join=None):
+        """
+        استریم مشترک برای key
+        factory: تابعی بدون آرگومان که async generator رشته‌ای upstream را می‌سازد
+        context: داده دلخواه درخواست اول (مثلاً نوبت زمان‌بند) که در اختیار بعدی‌ها قرار می‌گیرد
+        on_join: برای درخواست‌های متصل‌شده با context درخواست اول صدا زده می‌شود
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            flight.context = context
+            self._flights[key] = flight
+            flight.task = asyncio.get_running_loop().create_task(self._produce(key, flight, factory))
+            self.stats["upstream_requests"] += 1
+        else:
+            self.stats["coalesced"] += 1
+            logger.info("درخواست یکسان به استریم در جریان متصل شد | مشترکین: %d", flight.subscribers + 1)
+            if on_join is not None:
+                on_join(flight.context)
+
+        flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                updated = flight.updated
+                while index < len(flight.chunks):
+                    yield flight.chunks[index]
+                    index += 1
+                if flight.done:
+                    break
+                await updated.wait()
+            if flight.error is not None and not isinstance(flight.error, asyncio.CancelledError):
+                raise flight.error
+        finally:
+            flight.subscribers -= 1
+            # اگر همه مشترکین رفتند، ادامه دادن upstream بی‌فایده است
+            if flight.subscribers == 0 and not flight.done and flight.task is not None:
+                flight.task.cancel()
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+
+_shared: SingleFlight | None = None
+
+
+def get_single_flight() -> SingleFlight:
+    """نمونه مشترک پروسه (بین همه نمونه‌های PeakAI)"""
+    global _shared
+    if _shared is None:
+        _shared = SingleFlight(expected_errors=(QueueFullError,))
+    return _shared
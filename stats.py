@@ -1,54 +1,110 @@
 # stats.py
-import json
-import os
-from datetime import datetime, timedelta
+import asyncio
+import math
+import weakref
+from datetime import datetime
 
-USERS_FILE = "users.json"
+from metrics import QUOTA_CHECKS, QUOTA_DENIALS
+from quota import AI_SUPPORT_WINDOW, DOWNLOAD_WINDOW, MODE_TOKEN_BUCKET
+from storage import USERS_FILE, get_store
+
+# قفل هر کاربر برای عملیات بررسی-و-مصرف (فقط تا وقتی استفاده می‌شود در حافظه می‌ماند)
+_user_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _user_lock(user_id: int) -> asyncio.Lock:
+    key = str(user_id)
+    lock = _user_locks.get(key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[key] = lock
+    return lock
 
 def load_users() -> dict:
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+    """
+    بارگذاری کل کاربران - فقط برای عملیات گروهی (آمار ادمین، ارسال همگانی)
+    برای یک کاربر از get_user استفاده کنید
+    """
+    return get_store().load_all()
 
 def save_users(users: dict):
-    with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+    get_store().save_all(users)
+
+def get_user(user_id: int) -> dict | None:
+    """رکورد کاربر از کش حافظه (تغییرات سطح اول خودکار ثبت می‌شوند)"""
+    return get_store().get(user_id)
+
+def save_user(user_id: int, user: dict, durable: bool = False):
+    """
+    ثبت رکورد کاربر در کش
+    durable=True: نوشتن فوری همین کاربر (برای شمارنده‌ها)، در غیر این صورت ذخیره دسته‌ای
+    """
+    get_store().put(user_id, user, durable=durable)
 
 def get_plan_limit(plan: str) -> int:
     limits = {'free': 3, 'premium': 20, 'professional': 999}
     return limits.get(plan, 3)
 
-def reset_if_needed(user_id: int):
-    users = load_users()
-    user_key = str(user_id)
-    if user_key not in users:
-        return
+def _record_quota_check(kind: str, plan: str, allowed: bool):
+    """ثبت متریک بررسی سهمیه (و رد شدن) به تفکیک پلن"""
+    QUOTA_CHECKS.inc(kind=kind, plan=plan)
+    if not allowed:
+        QUOTA_DENIALS.inc(kind=kind, plan=plan)
 
-    user = users[user_key]
-    last_reset_str = user.get('last_reset')
-    if not last_reset_str:
-        user['last_reset'] = datetime.now().isoformat()
-        user['downloads_today'] = 0
-        save_users(users)
-        return
+# فیلدهای هر سهمیه روی رکورد: (شمارنده خام، سطح اعشاری سطل، شروع پنجره)
+# در حالت token_bucket سطح اعشاری در فیلد جداگانه نگه داشته می‌شود و شمارنده خام
+# (که ربات اصلی و users.json می‌خوانند) مثل قبل عدد صحیح می‌ماند
+DOWNLOAD_FIELDS = ('downloads_today', 'downloads_bucket', 'last_reset')
+AI_FIELDS = ('ai_used_count', 'ai_bucket', 'ai_window_start_time')
 
-    last_reset = datetime.fromisoformat(last_reset_str)
-    now = datetime.now()
+def _quota_state(window, user: dict, fields) -> tuple:
+    """(مقدار مصرف ذخیره‌شده، شروع پنجره) برای محاسبه با QuotaWindow"""
+    count_field, level_field, start_field = fields
+    count = user.get(count_field, 0) or 0
+    level = user.get(level_field) if window.mode == MODE_TOKEN_BUCKET else None
+    # اگر شمارنده خام بیرون از این ماژول تغییر کرده (مثلاً ریست دستی)، همان معتبر است
+    if level is not None and math.ceil(level - 1e-9) == count:
+        count = level
+    return count, user.get(start_field)
 
-    if (now - last_reset) >= timedelta(days=1):
-        user['downloads_today'] = 0
-        user['last_reset'] = now.isoformat()
-        save_users(users)
+def _store_quota(window, user: dict, fields, used, window_start):
+    count_field, level_field, start_field = fields
+    if window.mode == MODE_TOKEN_BUCKET:
+        user[level_field] = used
+        user[count_field] = math.ceil(used - 1e-9)
+    else:
+        user[count_field] = used
+        if level_field in user:
+            user.pop(level_field)
+    user[start_field] = window_start
+
+def _reset_downloads(user: dict) -> bool:
+    """
+    جابه‌جایی صریح پنجره روزانه روی رکورد؛ True اگر رکورد تغییر کرد
+    (فقط برای سازگاری با کدهایی که فیلدهای خام را می‌خوانند؛ مسیرهای خواندن به آن نیاز ندارند)
+    """
+    limit = get_plan_limit(user.get('plan', 'free'))
+    count, start = _quota_state(DOWNLOAD_WINDOW, user, DOWNLOAD_FIELDS)
+    used = DOWNLOAD_WINDOW.used(count, start, limit)
+    if start and used == count:
+        return False
+    _store_quota(DOWNLOAD_WINDOW, user, DOWNLOAD_FIELDS, used, datetime.now().isoformat())
+    return True
+
+def reset_if_needed(user_id: int):
+    user = get_user(user_id)
+    if user is None:
+        return
+
+    if _reset_downloads(user):
+        save_user(user_id, user)
 
 def get_user_stats(user_id: int) -> dict:
     """
     منبع حقیقت واحد برای آمار کاربر
+    فقط خواندنی: شمارنده روزانه بر اساس زمان محاسبه می‌شود و چیزی ذخیره نمی‌شود
     """
-    reset_if_needed(user_id)
-    users = load_users()
-    user_key = str(user_id)
-    if user_key not in users:
+    user = get_user(user_id)
+    if user is None:
         return {
             'plan': 'free',
             'downloads_today': 0,
@@ -57,11 +113,12 @@ def get_user_stats(user_id: int) -> dict:
             'username': f"User_{user_id}"
         }
 
-    user = users[user_key]
     plan = user.get('plan', 'free')
     limit = get_plan_limit(plan)
     # اطمینان از اینکه downloads_today منفی نشود
-    downloads_today = max(0, user.get('downloads_today', 0))
+    downloads_today = max(0, DOWNLOAD_WINDOW.used_count(
+        *_quota_state(DOWNLOAD_WINDOW, user, DOWNLOAD_FIELDS), limit
+    ))
     remaining = max(0, limit - downloads_today)
 
     return {
@@ -72,18 +129,17 @@ def get_user_stats(user_id: int) -> dict:
         'username': user.get('username', f"User_{user_id}")
     }
 
-def increment_daily_download(user_id: int):
+def _consume_download(user_id: int) -> tuple[dict, bool, int, int]:
     """
-    فقط بعد از دانلود موفق فراخوانی شود
+    جابه‌جایی پنجره + بررسی سقف + افزایش شمارنده روی رکورد (بدون ذخیره)
+    بازگشت: (user, consumed, current, limit)
     """
-    reset_if_needed(user_id)
-    users = load_users()
-    user_key = str(user_id)
+    user = get_user(user_id)
 
     # اگر کاربر وجود نداشت، یک رکورد اولیه می‌سازیم
-    if user_key not in users:
+    if user is None:
         now_iso = datetime.now().isoformat()
-        users[user_key] = {
+        user = {
             'plan': 'free',
             'downloads_today': 0,
             'downloads_total': 0,
@@ -93,22 +149,41 @@ def increment_daily_download(user_id: int):
             'ai_window_start_time': now_iso,
         }
 
-    user = users[user_key]
     plan = user.get('plan', 'free')
     limit = get_plan_limit(plan)
 
-    # نرمال‌سازی مقدار فعلی
-    current = max(0, user.get('downloads_today', 0))
+    ok, count, window_start = DOWNLOAD_WINDOW.consume(
+        *_quota_state(DOWNLOAD_WINDOW, user, DOWNLOAD_FIELDS), limit
+    )
+    current = DOWNLOAD_WINDOW.used_count(count, window_start, limit)
+    _record_quota_check("download", plan, ok)
+
+    # اگر همین حالا هم به سقف رسیده‌ایم، دیگر افزایش نمی‌دهیم (و چیزی تغییر نمی‌کند)
+    if not ok:
+        return user, False, current, limit
 
-    # اگر همین حالا هم به سقف رسیده‌ایم، دیگر افزایش نمی‌دهیم
-    if current >= limit:
-        user['downloads_today'] = current
-    else:
-        user['downloads_today'] = current + 1
-        user['downloads_total'] = user.get('downloads_total', 0) + 1
+    _store_quota(DOWNLOAD_WINDOW, user, DOWNLOAD_FIELDS, count, window_start)
+    user['downloads_total'] = user.get('downloads_total', 0) + 1
+    return user, True, current, limit
 
-    users[user_key] = user
-    save_users(users)
+def increment_daily_download(user_id: int):
+    """
+    فقط بعد از دانلود موفق فراخوانی شود
+    """
+    user, consumed, _, _ = _consume_download(user_id)
+    if consumed:
+        save_user(user_id, user, durable=True)
+
+async def try_consume_download(user_id: int) -> tuple[bool, int, int]:
+    """
+    بررسی و مصرف اتمیک یک سهمیه دانلود (جابه‌جایی پنجره، بررسی سقف و افزایش در یک بخش بحرانی)
+    بازگشت: (consumed: bool, current: int, limit: int)
+    """
+    async with _user_lock(user_id):
+        user, consumed, current, limit = _consume_download(user_id)
+        if consumed:
+            await asyncio.to_thread(save_user, user_id, user, True)
+        return consumed, current, limit
 
 def can_user_download(user_id: int) -> tuple[bool, int, int]:
     """
@@ -118,6 +193,7 @@ def can_user_download(user_id: int) -> tuple[bool, int, int]:
     stats = get_user_stats(user_id)
     limit = get_plan_limit(stats['plan'])
     current = max(0, stats['downloads_today'])
+    _record_quota_check("download", stats['plan'], current < limit)
     # اگر current >= limit باشد، اجازه دانلود نداریم و current را همواره در بازه [0, limit] می‌بینیم
     return (
         current < limit,
@@ -125,114 +201,116 @@ def can_user_download(user_id: int) -> tuple[bool, int, int]:
         limit
     )
 
+def _reset_ai_window(user: dict) -> bool:
+    """
+    جابه‌جایی صریح پنجره ۵ ساعته AI روی رکورد؛ True اگر رکورد تغییر کرد
+    (فقط برای سازگاری؛ مسیرهای خواندن به آن نیاز ندارند)
+    """
+    count, start = _quota_state(AI_SUPPORT_WINDOW, user, AI_FIELDS)
+    used = AI_SUPPORT_WINDOW.used(count, start, 10)
+    if start and used == count:
+        return False
+    _store_quota(AI_SUPPORT_WINDOW, user, AI_FIELDS, used, datetime.now().isoformat())
+    return True
+
 def reset_ai_limit_if_needed(user_id: int):
     """
     بررسی و بازنشانی محدودیت AI در صورت نیاز (هر 5 ساعت)
     """
-    users = load_users()
-    user_key = str(user_id)
-    if user_key not in users:
-        return
-    
-    user = users[user_key]
-    ai_window_start_str = user.get('ai_window_start_time')
-    
-    # اگر فیلد وجود نداشت، آن را ایجاد می‌کنیم
-    if not ai_window_start_str:
-        now = datetime.now()
-        user['ai_window_start_time'] = now.isoformat()
-        user['ai_used_count'] = 0
-        save_users(users)
+    user = get_user(user_id)
+    if user is None:
         return
-    
-    ai_window_start = datetime.fromisoformat(ai_window_start_str)
-    now = datetime.now()
-    
-    # اگر 5 ساعت گذشته باشد، بازنشانی می‌کنیم
-    if (now - ai_window_start) >= timedelta(hours=5):
-        user['ai_used_count'] = 0
-        user['ai_window_start_time'] = now.isoformat()
-        save_users(users)
+
+    if _reset_ai_window(user):
+        save_user(user_id, user)
 
 def check_ai_support_limit(user_id: int) -> tuple[bool, int, int, str | None]:
     """
     بررسی محدودیت پشتیبانی هوشمند برای کاربر
-    فقط برای کاربران FREE اعمال می‌شود
+    فقط برای کاربران FREE اعمال می‌شود - فقط خواندنی، چیزی ذخیره نمی‌شود
     بازگشت:
         can_use: آیا کاربر می‌تواند از پشتیبانی هوشمند استفاده کند؟
         current_count: تعداد استفاده‌های فعلی در بازه ۵ ساعته
         limit: سقف مجاز استفاده در هر بازه
         reset_time_iso: زمان ریست محدودیت به صورت ISO (رشته) یا None
     """
-    users = load_users()
-    user_key = str(user_id)
+    user = get_user(user_id)
     
     # اگر کاربر وجود نداشت، اجازه می‌دهیم (کاربر جدید)
-    if user_key not in users:
+    if user is None:
+        _record_quota_check("ai", "free", True)
         return (True, 0, 10, None)
     
-    user = users[user_key]
     plan = user.get('plan', 'free').lower()
     
     # اگر پلن FREE نیست، محدودیتی نداریم
     if plan != 'free':
+        _record_quota_check("ai", plan, True)
         return (True, 0, 999999, None)
     
-    # برای کاربران FREE، محدودیت را بررسی می‌کنیم
-    reset_ai_limit_if_needed(user_id)
-    
-    # دوباره بارگذاری می‌کنیم چون ممکن است reset شده باشد
-    users = load_users()
-    user = users[user_key]
-    
-    ai_used_count = user.get('ai_used_count', 0)
+    # برای کاربران FREE، محدودیت را بر اساس زمان محاسبه می‌کنیم
     limit = 10
-
-    # محاسبه زمان ریست بعدی بر اساس زمان شروع پنجره ۵ ساعته
-    ai_window_start_str = user.get('ai_window_start_time')
-    reset_time_iso: str | None = None
-    if ai_window_start_str:
-        try:
-            ai_window_start = datetime.fromisoformat(ai_window_start_str)
-            reset_time = ai_window_start + timedelta(hours=5)
-            reset_time_iso = reset_time.isoformat()
-        except Exception:
-            # در صورت خطای پارس، مقدار None برمی‌گردانیم
-            reset_time_iso = None
+    count, start = _quota_state(AI_SUPPORT_WINDOW, user, AI_FIELDS)
+    ai_used_count = AI_SUPPORT_WINDOW.used_count(count, start, limit)
+    _record_quota_check("ai", plan, ai_used_count < limit)
     
-    return (ai_used_count < limit, ai_used_count, limit, reset_time_iso)
+    return (ai_used_count < limit, ai_used_count, limit, _ai_reset_time_iso(count, start, limit))
+
+def _ai_reset_time_iso(count, window_start, limit: int) -> str | None:
+    """زمان ریست بعدی محدودیت AI به صورت ISO (None اگر پنجره‌ای فعال نیست)"""
+    reset_time = AI_SUPPORT_WINDOW.reset_at(count, window_start, limit)
+    return reset_time.isoformat() if reset_time else None
+
+def _consume_ai(user: dict) -> tuple[bool, int, int, str | None]:
+    """جابه‌جایی پنجره + بررسی سقف + افزایش شمارنده AI روی رکورد (بدون ذخیره)"""
+    limit = 10
+    ok, count, window_start = AI_SUPPORT_WINDOW.consume(
+        *_quota_state(AI_SUPPORT_WINDOW, user, AI_FIELDS), limit
+    )
+    if ok:
+        _store_quota(AI_SUPPORT_WINDOW, user, AI_FIELDS, count, window_start)
+    current = AI_SUPPORT_WINDOW.used_count(count, window_start, limit)
+    return (ok, current, limit, _ai_reset_time_iso(count, window_start, limit))
 
 def increment_ai_support_usage(user_id: int):
     """
     افزایش تعداد استفاده از پشتیبانی هوشمند
     فقط برای کاربران FREE اعمال می‌شود
     """
-    users = load_users()
-    user_key = str(user_id)
+    user = get_user(user_id)
     
-    if user_key not in users:
+    if user is None:
         return
     
-    user = users[user_key]
     plan = user.get('plan', 'free').lower()
     
     # اگر پلن FREE نیست، نیازی به ثبت استفاده نیست
     if plan != 'free':
         return
     
-    # بررسی و بازنشانی در صورت نیاز
-    reset_ai_limit_if_needed(user_id)
-    
-    # دوباره بارگذاری می‌کنیم
-    users = load_users()
-    user = users[user_key]
-    
-    # افزایش تعداد استفاده
-    current_count = user.get('ai_used_count', 0)
-    user['ai_used_count'] = current_count + 1
-    
-    # اگر اولین استفاده است، زمان شروع را تنظیم می‌کنیم
-    if not user.get('ai_window_start_time'):
-        user['ai_window_start_time'] = datetime.now().isoformat()
-    
-    save_users(users)
\ No newline at end of file
+    # جابه‌جایی پنجره در صورت نیاز و افزایش تعداد استفاده
+    if _consume_ai(user)[0]:
+        save_user(user_id, user, durable=True)
+
+async def try_consume_ai(user_id: int) -> tuple[bool, int, int, str | None]:
+    """
+    بررسی و مصرف اتمیک یک سهمیه پشتیبانی هوشمند (فقط برای کاربران FREE)
+    بازگشت مانند check_ai_support_limit؛ current_count مقدار بعد از مصرف است
+    """
+    async with _user_lock(user_id):
+        user = get_user(user_id)
+
+        # کاربر جدید یا پلن غیر FREE: بدون محدودیت و بدون ثبت
+        plan = 'free' if user is None else user.get('plan', 'free').lower()
+        if user is None:
+            _record_quota_check("ai", plan, True)
+            return (True, 0, 10, None)
+        if plan != 'free':
+            _record_quota_check("ai", plan, True)
+            return (True, 0, 999999, None)
+
+        result = _consume_ai(user)
+        _record_quota_check("ai", plan, result[0])
+        if result[0]:
+            await asyncio.to_thread(save_user, user_id, user, True)
+        return result
\ No newline at end of file
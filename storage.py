@@ -0,0 +1,714 @@
+# storage.py
+"""
+لایه ذخیره‌سازی کاربران و صف پشتیبانی
+دو بک‌اند با رابط یکسان: JSON (سازگار با نسخه قبلی) و SQLite (حالت WAL، ایندکس‌شده)
+انتخاب بک‌اند از بخش "storage" در config.json انجام می‌شود
+"""
+
+import asyncio
+import atexit
+import copy
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+from metrics import STORAGE_SECONDS
+
+USERS_FILE = "users.json"
+SUPPORT_QUEUE_FILE = "support_queue.json"
+CONFIG_FILE = "config.json"
+DEFAULT_DB_FILE = "peak.db"
+
+# فیلدهایی که در SQLite ستون جداگانه (و در صورت نیاز ایندکس) دارند
+# بقیه فیلدهای رکورد کاربر به صورت JSON در ستون data نگه داشته می‌شوند
+USER_COLUMNS = (
+    "username",
+    "plan",
+    "language",
+    "downloads_today",
+    "downloads_total",
+    "last_reset",
+    "ai_used_count",
+    "ai_window_start_time",
+    "subscription_end",
+)
+
+
+def atomic_write_json(path: str, data):
+    """
+    نوشتن اتمیک: فایل موقت در همان پوشه + fsync + os.replace
+    در صورت کرش وسط نوشتن، فایل قبلی سالم باقی می‌ماند
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def iter_json_object(path: str, chunk_size: int = 65536):
+    """
+    پیمایش جریانی (key, value) های شیء سطح بالای یک فایل JSON
+    فایل تکه‌تکه خوانده می‌شود و در هر لحظه فقط یک مقدار در حافظه است
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ""
+        position = 0
+        eof = False
+
+        def fill() -> bool:
+            nonlocal buffer, position, eof
+            if eof:
+                return False
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+                return False
+            buffer = buffer[position:] + chunk
+            position = 0
+            return True
+
+        def skip_whitespace():
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position].isspace():
+                    position += 1
+                if position < len(buffer) or not fill():
+                    return
+
+        def expect(chars: str) -> str:
+            skip_whitespace()
+            if position >= len(buffer) or buffer[position] not in chars:
+                raise ValueError(f"ساختار JSON نامعتبر در {path}: انتظار {chars!r}")
+            return buffer[position]
+
+        def decode():
+            nonlocal position
+            skip_whitespace()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if not fill():
+                        raise
+                    continue
+                # مقدار عددی ممکن است در مرز تکه بریده شده باشد (مثلاً "1." از "1.5")
+                if (end >= len(buffer) or buffer[end] in ".eE+-0123456789") and fill():
+                    continue
+                position = end
+                return value
+
+        if expect("{"):
+            position += 1
+        if expect("}\"") == "}":
+            return
+        while True:
+            key = decode()
+            expect(":")
+            position += 1
+            yield key, decode()
+            if expect(",}") == "}":
+                return
+            position += 1
+
+
+class JsonBackend:
+    """
+    بک‌اند فایل JSON - کل فایل در هر نوشتن بازنویسی می‌شود
+    خواندن تک‌کاربر از نسخه پارس‌شده کش‌شده انجام می‌شود که با تغییر فایل (mtime/اندازه/inode) باطل می‌شود
+    """
+
+    name = "json"
+
+    def __init__(self, users_file: str = USERS_FILE, support_file: str = SUPPORT_QUEUE_FILE):
+        self.users_file = users_file
+        self.support_file = support_file
+        self._lock = threading.Lock()
+        self._snapshot: dict | None = None
+        self._snapshot_stamp: tuple | None = None
+
+    # ---------- کاربران ----------
+    def load_all(self) -> dict:
+        if os.path.exists(self.users_file):
+            with open(self.users_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {}
+
+    def save_all(self, users: dict):
+        atomic_write_json(self.users_file, users)
+        with self._lock:
+            self._snapshot = None
+
+    def _cached_users(self) -> dict:
+        """نسخه پارس‌شده فایل؛ فقط وقتی فایل عوض شده باشد دوباره خوانده می‌شود (فقط‌خواندنی)"""
+        try:
+            st = os.stat(self.users_file)
+        except FileNotFoundError:
+            return {}
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self._lock:
+            if self._snapshot is None or self._snapshot_stamp != stamp:
+                self._snapshot = self.load_all()
+                self._snapshot_stamp = stamp
+            return self._snapshot
+
+    def get_user(self, user_id: int) -> dict | None:
+        user = self._cached_users().get(str(user_id))
+        # کپی تا تغییر رکورد توسط فراخواننده نسخه کش‌شده را خراب نکند
+        return copy.deepcopy(user) if user is not None else None
+
+    def _iter_matching(self, plans):
+        for key, user in iter_json_object(self.users_file):
+            if plans is not None and (user.get("plan") or "free") not in plans:
+                continue
+            yield key, user
+
+    def iter_users(self, after_id: int | None = None, plans=None, batch_size: int = 500,
+                   after_position: int | None = None):
+        """
+        پیمایش جریانی کاربران به ترتیب فایل (بدون بارگذاری کل فایل)
+        after_id: ادامه از بعد از این کاربر (برای از سرگیری)
+        after_position: تعداد کاربرانی که با همین فیلتر قبلاً پیمایش شده‌اند؛
+        اگر after_id در این فاصله حذف شده باشد، ادامه از همین موقعیت انجام می‌شود
+        LookupError اگر after_id پیدا نشود و after_position داده نشده باشد
+        """
+        if not os.path.exists(self.users_file):
+            return
+        plans = set(plans) if plans else None
+        if after_id is None:
+            for key, user in self._iter_matching(plans):
+                yield int(key), user
+            return
+
+        found = False
+        for key, user in iter_json_object(self.users_file):
+            if not found:
+                found = key == str(after_id)
+                continue
+            if plans is not None and (user.get("plan") or "free") not in plans:
+                continue
+            yield int(key), user
+        if found:
+            return
+        if after_position is None:
+            raise LookupError(f"نقطه از سرگیری (کاربر {after_id}) در {self.users_file} پیدا نشد")
+        # خود after_id آخرین رکورد پیمایش‌شده بود و با حذف آن رکوردهای بعدی یک خانه جلو آمده‌اند
+        resume_at = max(0, after_position - 1)
+        print(f"کاربر {after_id} (نقطه از سرگیری) حذف شده است؛ ادامه از موقعیت {resume_at}")
+        for index, (key, user) in enumerate(self._iter_matching(plans)):
+            if index >= resume_at:
+                yield int(key), user
+
+    def put_user(self, user_id: int, user: dict):
+        users = self.load_all()
+        users[str(user_id)] = user
+        self.save_all(users)
+
+    def put_users(self, users: dict):
+        """به‌روزرسانی چند کاربر با یک بار خواندن و نوشتن فایل"""
+        all_users = self.load_all()
+        for user_id, user in users.items():
+            all_users[str(user_id)] = user
+        self.save_all(all_users)
+
+    def delete_user(self, user_id: int):
+        users = self.load_all()
+        if users.pop(str(user_id), None) is not None:
+            self.save_all(users)
+
+    # ---------- صف پشتیبانی ----------
+    def load_support_queue(self) -> list:
+        if os.path.exists(self.support_file):
+            with open(self.support_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return []
+
+    def save_support_queue(self, queue: list):
+        atomic_write_json(self.support_file, queue)
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """
+    بک‌اند SQLite در حالت WAL
+    هر کاربر یک سطر است؛ خواندن/به‌روزرسانی یک کاربر فقط همان سطر را لمس می‌کند
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db_path: str = DEFAULT_DB_FILE):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    plan TEXT NOT NULL DEFAULT 'free',
+                    language TEXT,
+                    downloads_today INTEGER NOT NULL DEFAULT 0,
+                    downloads_total INTEGER NOT NULL DEFAULT 0,
+                    last_reset TEXT,
+                    ai_used_count INTEGER NOT NULL DEFAULT 0,
+                    ai_window_start_time TEXT,
+                    subscription_end TEXT,
+                    data TEXT NOT NULL DEFAULT '{}'
+                );
+                CREATE INDEX IF NOT EXISTS idx_users_plan ON users(plan);
+                CREATE INDEX IF NOT EXISTS idx_users_downloads_today ON users(downloads_today);
+                CREATE INDEX IF NOT EXISTS idx_users_ai_window ON users(ai_window_start_time, ai_used_count);
+                CREATE INDEX IF NOT EXISTS idx_users_subscription_end ON users(subscription_end);
+
+                CREATE TABLE IF NOT EXISTS support_queue (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    status TEXT,
+                    created_at TEXT,
+                    data TEXT NOT NULL DEFAULT '{}'
+                );
+                CREATE INDEX IF NOT EXISTS idx_support_status ON support_queue(status);
+                CREATE INDEX IF NOT EXISTS idx_support_user ON support_queue(user_id);
+            """)
+
+    # ---------- تبدیل سطر <-> رکورد ----------
+    @staticmethod
+    def _row_to_user(row) -> dict:
+        user = json.loads(row[-1]) if row[-1] else {}
+        for name, value in zip(USER_COLUMNS, row[1:-1]):
+            if value is not None:
+                user[name] = value
+        return user
+
+    @staticmethod
+    def _user_to_row(user_id: int, user: dict) -> tuple:
+        extra = {k: v for k, v in user.items() if k not in USER_COLUMNS}
+        values = [user.get(name) for name in USER_COLUMNS]
+        # ستون‌های NOT NULL
+        values[USER_COLUMNS.index("plan")] = user.get("plan") or "free"
+        for name in ("downloads_today", "downloads_total", "ai_used_count"):
+            values[USER_COLUMNS.index(name)] = user.get(name) or 0
+        return (int(user_id), *values, json.dumps(extra, ensure_ascii=False))
+
+    _SELECT_USER = "SELECT id, " + ", ".join(USER_COLUMNS) + ", data FROM users"
+    _UPSERT_USER = (
+        "INSERT OR REPLACE INTO users (id, " + ", ".join(USER_COLUMNS) + ", data) "
+        "VALUES (" + ", ".join("?" * (len(USER_COLUMNS) + 2)) + ")"
+    )
+
+    # ---------- کاربران ----------
+    def get_user(self, user_id: int) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(self._SELECT_USER + " WHERE id = ?", (int(user_id),)).fetchone()
+        return self._row_to_user(row) if row else None
+
+    def put_user(self, user_id: int, user: dict):
+        with self._lock:
+            self._conn.execute(self._UPSERT_USER, self._user_to_row(user_id, user))
+
+    def put_users(self, users: dict):
+        """درج/جایگزینی دسته‌ای در یک تراکنش"""
+        rows = [self._user_to_row(uid, u) for uid, u in users.items()]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(self._UPSERT_USER, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete_user(self, user_id: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM users WHERE id = ?", (int(user_id),))
+
+    def load_all(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute(self._SELECT_USER).fetchall()
+        return {str(row[0]): self._row_to_user(row) for row in rows}
+
+    def iter_users(self, after_id: int | None = None, plans=None, batch_size: int = 500,
+                   after_position: int | None = None):
+        """
+        پیمایش صفحه‌ای کاربران به ترتیب id (keyset؛ هر صفحه یک کوئری کوتاه)
+        فیلتر plan از ایندکس idx_users_plan استفاده می‌کند
+        after_position لازم نیست: id > after_id حتی اگر آن کاربر حذف شده باشد درست است
+        """
+        last_id = -1 if after_id is None else int(after_id)
+        plan_clause = ""
+        plan_params: tuple = ()
+        if plans:
+            plan_params = tuple(plans)
+            plan_clause = " AND plan IN (" + ", ".join("?" * len(plan_params)) + ")"
+        query = self._SELECT_USER + " WHERE id > ?" + plan_clause + " ORDER BY id LIMIT ?"
+        while True:
+            with self._lock:
+                rows = self._conn.execute(query, (last_id, *plan_params, batch_size)).fetchall()
+            for row in rows:
+                yield row[0], self._row_to_user(row)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def save_all(self, users: dict):
+        """جایگزینی کامل جدول کاربران (برای سازگاری با save_users قدیمی)"""
+        rows = [self._user_to_row(uid, u) for uid, u in users.items()]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM users")
+                self._conn.executemany(self._UPSERT_USER, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # ---------- صف پشتیبانی ----------
+    def load_support_queue(self) -> list:
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM support_queue ORDER BY id").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def save_support_queue(self, queue: list):
+        rows = [
+            (item.get("id"), item.get("user_id"), item.get("status"), item.get("created_at"),
+             json.dumps(item, ensure_ascii=False))
+            for item in queue
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM support_queue")
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO support_queue (id, user_id, status, created_at, data) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# ==================== کش نوشتن-با-تأخیر کاربران ====================
+class UserRecord(dict):
+    """
+    رکورد کاربر که با هر تغییر سطح اول، خودش را در UserStore کثیف (dirty) علامت می‌زند
+    برای تغییر فیلدهای تودرتو (مثل support) باید mark_dirty صدا زده شود
+    تغییرات سطح اول زیر قفل store انجام می‌شوند تا کپی هنگام ذخیره (در نخ دیگر) نیمه‌کاره نباشد
+    """
+
+    __slots__ = ("_store", "_key")
+
+    def __init__(self, store: "UserStore", key: str, data: dict):
+        super().__init__(data)
+        self._store = store
+        self._key = key
+
+    def _touch(self):
+        self._store.mark_dirty(self._key, record=self)
+
+    def __setitem__(self, key, value):
+        with self._store._lock:
+            super().__setitem__(key, value)
+            self._touch()
+
+    def __delitem__(self, key):
+        with self._store._lock:
+            super().__delitem__(key)
+            self._touch()
+
+    def update(self, *args, **kwargs):
+        with self._store._lock:
+            super().update(*args, **kwargs)
+            self._touch()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        with self._store._lock:
+            had_key = key in self
+            value = super().pop(key, *default)
+            if had_key:
+                self._touch()
+            return value
+
+    def popitem(self):
+        with self._store._lock:
+            item = super().popitem()
+            self._touch()
+            return item
+
+    def clear(self):
+        with self._store._lock:
+            super().clear()
+            self._touch()
+
+
+class UserStore:
+    """
+    کش درون‌پروسه‌ای رکوردهای کاربر روی یک بک‌اند
+    - خواندن‌ها از حافظه سرو می‌شوند (هر کاربر فقط یک بار از بک‌اند خوانده می‌شود)
+    - تغییرات کثیف علامت می‌خورند و به صورت دسته‌ای ذخیره می‌شوند:
+      هر flush_interval ثانیه (تسک پس‌زمینه) یا وقتی تعداد کثیف‌ها به max_dirty برسد
+    - تغییرات durable (شمارنده‌ها) بلافاصله برای همان کاربر نوشته می‌شوند
+    - flush() صریح برای خاموش شدن (و به صورت خودکار در atexit)
+    - حداکثر max_records رکورد در حافظه می‌ماند؛ قدیمی‌ترین رکوردهای تمیز (LRU) کنار گذاشته می‌شوند
+    """
+
+    def __init__(self, backend, flush_interval: float = 5.0, max_dirty: int = 200, max_records: int = 10000):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+        self.max_records = max_records
+        self._records: "OrderedDict[str, UserRecord]" = OrderedDict()
+        self._dirty: set[str] = set()
+        self._lock = threading.RLock()
+        self._flusher_task: asyncio.Task | None = None
+        self.stats = {"hits": 0, "misses": 0, "flushes": 0, "records_flushed": 0, "evictions": 0}
+
+    def _evict(self):
+        """کنار گذاشتن قدیمی‌ترین رکوردهای تمیز تا رسیدن به max_records (رکوردهای کثیف تا flush می‌مانند)"""
+        if len(self._records) <= self.max_records:
+            return
+        for key in list(self._records):
+            if len(self._records) <= self.max_records:
+                break
+            if key not in self._dirty:
+                del self._records[key]
+                self.stats["evictions"] += 1
+
+    def _copy(self, key: str) -> dict:
+        # کپی عمیق: فیلدهای تودرتو (مثل support) با نسخه در حال ذخیره مشترک نمی‌مانند
+        return copy.deepcopy(dict(self._records[key]))
+
+    # ---------- خواندن ----------
+    def get(self, user_id: int) -> UserRecord | None:
+        key = str(user_id)
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None:
+                self._records.move_to_end(key)
+                self.stats["hits"] += 1
+                return record
+            self.stats["misses"] += 1
+            with STORAGE_SECONDS.time(op="get_user"):
+                data = self.backend.get_user(user_id)
+            if data is None:
+                return None
+            record = UserRecord(self, key, data)
+            self._records[key] = record
+            self._evict()
+            return record
+
+    # ---------- نوشتن ----------
+    def put(self, user_id: int, user: dict, durable: bool = False) -> UserRecord:
+        key = str(user_id)
+        with self._lock:
+            record = self._records.get(key)
+            if record is None or record is not user:
+                record = UserRecord(self, key, user)
+                self._records[key] = record
+            self._records.move_to_end(key)
+            self.mark_dirty(key, durable=durable)
+            self._evict()
+            return record
+
+    def mark_dirty(self, user_id, durable: bool = False, record: UserRecord | None = None):
+        """record: رکوردی که تغییر کرده؛ اگر از کش کنار گذاشته شده بود دوباره برگردانده می‌شود"""
+        key = str(user_id)
+        with self._lock:
+            if key not in self._records:
+                if record is None:
+                    return
+                self._records[key] = record
+            if durable:
+                self._dirty.discard(key)
+                with STORAGE_SECONDS.time(op="put_user"):
+                    self.backend.put_user(int(key), self._copy(key))
+                return
+            self._dirty.add(key)
+            if len(self._dirty) >= self.max_dirty:
+                self.flush()
+
+    def delete(self, user_id: int):
+        key = str(user_id)
+        with self._lock:
+            self._records.pop(key, None)
+            self._dirty.discard(key)
+            self.backend.delete_user(user_id)
+
+    def flush(self) -> int:
+        """ذخیره فقط رکوردهای کثیف در یک عملیات دسته‌ای؛ بازگشت: تعداد رکوردها"""
+        with self._lock:
+            if not self._dirty:
+                return 0
+            batch = {key: self._copy(key) for key in self._dirty if key in self._records}
+            with STORAGE_SECONDS.time(op="flush"):
+                self.backend.put_users(batch)
+            self._dirty.clear()
+            self.stats["flushes"] += 1
+            self.stats["records_flushed"] += len(batch)
+            self._evict()
+            return len(batch)
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self._dirty)
+
+    # ---------- عملیات گروهی ----------
+    def load_all(self) -> dict:
+        """همه کاربران (بعد از ذخیره تغییرات معلق)"""
+        with self._lock:
+            self.flush()
+            with STORAGE_SECONDS.time(op="load_all"):
+                return self.backend.load_all()
+
+    def iter_users(self, after_id: int | None = None, plans=None, batch_size: int = 500,
+                   after_position: int | None = None):
+        """
+        پیمایش جریانی (user_id, رکورد) از بک‌اند بعد از ذخیره تغییرات معلق
+        ترتیب پیمایش ثابت است (SQLite: id، JSON: ترتیب فایل) و با after_id از سر گرفته می‌شود
+        after_position: تعداد رکوردهای قبلاً پیمایش‌شده با همین plans (پشتیبان after_id حذف‌شده در JSON)
+        """
+        self.flush()
+        yield from self.backend.iter_users(after_id=after_id, plans=plans, batch_size=batch_size,
+                                           after_position=after_position)
+
+    def save_all(self, users: dict):
+        """جایگزینی کامل کاربران؛ کش دور ریخته می‌شود"""
+        with self._lock:
+            with STORAGE_SECONDS.time(op="save_all"):
+                self.backend.save_all(users)
+            self._records.clear()
+            self._dirty.clear()
+
+    # ---------- تسک پس‌زمینه ----------
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                print(f"خطا در ذخیره دوره‌ای کاربران: {e}")
+
+    def start(self):
+        """شروع ذخیره دوره‌ای (باید داخل event loop فراخوانی شود)"""
+        if self._flusher_task is None or self._flusher_task.done():
+            self._flusher_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def stop(self):
+        """توقف تسک پس‌زمینه و ذخیره نهایی"""
+        if self._flusher_task is not None:
+            self._flusher_task.cancel()
+            try:
+                await self._flusher_task
+            except asyncio.CancelledError:
+                pass
+            self._flusher_task = None
+        self.flush()
+
+
+# ==================== انتخاب بک‌اند ====================
+_backend = None
+_store = None
+_backend_lock = threading.Lock()
+
+
+def load_config_section(section: str) -> dict:
+    """خواندن یک بخش از config.json (در صورت نبود یا خطا: دیکشنری خالی)"""
+    if os.path.exists(CONFIG_FILE):
+        try:
+            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f).get(section, {}) or {}
+        except (OSError, json.JSONDecodeError):
+            pass
+    return {}
+
+
+def load_storage_config() -> dict:
+    """خواندن بخش storage از config.json (پیش‌فرض: JSON)"""
+    return load_config_section("storage")
+
+
+def create_backend(config: dict | None = None):
+    config = load_storage_config() if config is None else config
+    kind = (config.get("backend") or "json").lower()
+    if kind == "sqlite":
+        return SQLiteBackend(config.get("sqlite_path") or DEFAULT_DB_FILE)
+    if kind == "json":
+        return JsonBackend()
+    raise ValueError(f"بک‌اند ذخیره‌سازی نامعتبر: {kind}")
+
+
+def get_backend():
+    """بک‌اند فعال (یک نمونه برای کل پروسه)"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend()
+    return _backend
+
+
+def set_backend(backend):
+    """جایگزینی بک‌اند فعال (مثلاً بعد از مهاجرت یا در اسکریپت‌ها)"""
+    global _backend, _store
+    with _backend_lock:
+        if _store is not None:
+            _store.flush()
+        _backend = backend
+        _store = None
+
+
+def get_store() -> UserStore:
+    """کش کاربران روی بک‌اند فعال (یک نمونه برای کل پروسه)"""
+    global _store
+    if _store is None:
+        backend = get_backend()
+        with _backend_lock:
+            if _store is None:
+                config = load_storage_config()
+                _store = UserStore(
+                    backend,
+                    flush_interval=float(config.get("flush_interval", 5.0)),
+                    max_dirty=int(config.get("flush_max_dirty", 200)),
+                    max_records=int(config.get("cache_max_records", 10000)),
+                )
+    return _store
+
+
+@atexit.register
+def _flush_on_exit():
+    if _store is not None:
+        try:
+            _store.flush()
+        except Exception as e:
+            print(f"خطا در ذخیره نهایی کاربران: {e}")
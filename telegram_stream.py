@@ -0,0 +1,244 @@
+# telegram_stream.py
+"""
+نمایش پاسخ استریم‌شده PeakAI / SalesAI در تلگرام با ویرایش دسته‌ای و کنترل‌شده پیام
+- تجمیع deltaها و ویرایش پیام با فاصله زمانی/اندازه‌ای مشخص (نه به ازای هر delta)
+- تطبیق فاصله ویرایش با خطاهای flood-wait (RetryAfter در python-telegram-bot، FloodWaitError در Telethon)
+- شکستن متن در سقف ۴۰۹۶ کاراکتر تلگرام و ادامه در پیام‌های بعدی
+- آمار: تعداد ویرایش در هر پاسخ و زمان تا اولین متن قابل مشاهده
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from metrics import (
+    TELEGRAM_STREAM_EDITS,
+    TELEGRAM_STREAM_EDITS_PER_REPLY,
+    TELEGRAM_STREAM_FLOOD_WAITS,
+    TELEGRAM_STREAM_REPLIES,
+    TELEGRAM_STREAM_ROLLOVERS,
+    TELEGRAM_TIME_TO_FIRST_VISIBLE,
+)
+
+logger = logging.getLogger("PeakTelegramStream")
+
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+
+def flood_wait_seconds(error: Exception) -> float | None:
+    """مدت انتظار flood از خطای کتابخانه تلگرام (None اگر خطای flood نیست)"""
+    value = getattr(error, "retry_after", None)  # python-telegram-bot: RetryAfter
+    if value is None and type(error).__name__.startswith("FloodWait"):
+        value = getattr(error, "seconds", None)  # Telethon: FloodWaitError
+    if value is None:
+        return None
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_not_modified(error: Exception) -> bool:
+    text = str(error).lower()
+    return "not modified" in text or "messagenotmodified" in type(error).__name__.lower()
+
+
+def split_text(text: str, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH) -> tuple[str, str]:
+    """
+    جدا کردن بخش قابل ارسال؛ ترجیحاً روی خط جدید یا فاصله در ۲۰٪ پایانی سقف
+    head + tail همیشه برابر text است (فاصله مرز در ابتدای tail می‌ماند)
+    """
+    if len(text) <= limit:
+        return text, ""
+    window_start = int(limit * 0.8)
+    cut = text.rfind("\n", window_start, limit)
+    if cut == -1:
+        cut = text.rfind(" ", window_start, limit)
+    if cut == -1:
+        cut = limit
+    return text[:cut], text[cut:]
+
+
+async def default_send(target, text: str):
+    """ارسال پیام پاسخ؛ target پیام ورودی کاربر است (reply_text در PTB، reply در Telethon)"""
+    if hasattr(target, "reply_text"):
+        return await target.reply_text(text)
+    return await target.reply(text)
+
+
+async def default_edit(message, text: str):
+    if hasattr(message, "edit_text"):
+        return await message.edit_text(text)
+    return await message.edit(text)
+
+
+@dataclass
+class StreamReplyStats:
+    edits: int = 0
+    messages: int = 0
+    flood_waits: int = 0
+    chars: int = 0
+    time_to_first_visible: float | None = None
+    total_time: float = 0.0
+
+
+@dataclass
+class TelegramStreamMetrics:
+    """آمار تجمیعی همه پاسخ‌ها (هم‌زمان در رجیستری /metrics هم ثبت می‌شود)"""
+    replies: int = 0
+    edits: int = 0
+    flood_waits: int = 0
+    first_visible_times: list = field(default_factory=list)
+
+    def record(self, stats: StreamReplyStats):
+        self.replies += 1
+        self.edits += stats.edits
+        self.flood_waits += stats.flood_waits
+        if stats.time_to_first_visible is not None:
+            self.first_visible_times.append(stats.time_to_first_visible)
+            del self.first_visible_times[:-1000]
+            TELEGRAM_TIME_TO_FIRST_VISIBLE.observe(stats.time_to_first_visible)
+        TELEGRAM_STREAM_REPLIES.inc()
+        TELEGRAM_STREAM_EDITS.inc(stats.edits)
+        TELEGRAM_STREAM_EDITS_PER_REPLY.observe(stats.edits)
+        if stats.flood_waits:
+            TELEGRAM_STREAM_FLOOD_WAITS.inc(stats.flood_waits)
+        if stats.messages > 1:
+            TELEGRAM_STREAM_ROLLOVERS.inc(stats.messages - 1)
+
+    def snapshot(self) -> dict:
+        times = sorted(self.first_visible_times)
+        return {
+            "replies": self.replies,
+            "edits_per_reply": self.edits / self.replies if self.replies else 0.0,
+            "flood_waits": self.flood_waits,
+            "time_to_first_visible_p50": times[len(times) // 2] if times else None,
+        }
+
+
+metrics = TelegramStreamMetrics()
+
+
+class TelegramStreamWriter:
+    def __init__(
+        self,
+        target,
+        send=default_send,
+        edit=default_edit,
+        placeholder=None,
+        min_interval: float = 1.0,
+        max_interval: float = 10.0,
+        min_chars: int = 60,
+        max_length: int = TELEGRAM_MAX_MESSAGE_LENGTH,
+    ):
+        """
+        target: پیام کاربر (برای send)
+        placeholder: پیام موجود (مثلاً «در حال پردازش…») که اولین متن روی آن ویرایش می‌شود
+        min_interval / min_chars: حداقل فاصله زمانی و حداقل متن جدید بین دو ویرایش
+        """
+        self.target = target
+        self.send = send
+        self.edit = edit
+        self.base_interval = min_interval
+        self.interval = min_interval
+        self.max_interval = max_interval
+        self.min_chars = min_chars
+        self.max_length = max_length
+
+        self.stats = StreamReplyStats()
+        self._message = placeholder
+        self._text = ""           # متن پیام فعلی (بخش تکمیل‌نشده)
+        self._shown = ""          # آخرین متن نمایش‌داده‌شده در پیام فعلی
+        self._parts: list[str] = []
+        self._last_edit = 0.0
+        self._blocked_until = 0.0
+        self._start = time.perf_counter()
+
+    # ---------- ارتباط با تلگرام ----------
+    async def _call(self, func, *args):
+        """اجرای send/edit با مدیریت flood-wait؛ بازگشت نتیجه یا None در صورت عدم موفقیت"""
+        while True:
+            try:
+                return await func(*args)
+            except Exception as e:
+                wait = flood_wait_seconds(e)
+                if wait is None:
+                    if _is_not_modified(e):
+                        return None
+                    raise
+                self.stats.flood_waits += 1
+                # فاصله ویرایش‌ها را بزرگ‌تر می‌کنیم تا دوباره به محدودیت نخوریم
+                self.interval = min(self.max_interval, max(self.interval * 2, wait))
+                logger.warning("flood-wait تلگرام: %.1f ثانیه | فاصله جدید ویرایش: %.1f", wait, self.interval)
+                await asyncio.sleep(wait)
+
+    async def _show(self, text: str):
+        # فاصله/خط جدید مرز تقسیم فقط در نمایش پیام بعدی حذف می‌شود؛ متن اصلی دست نمی‌خورد
+        if self._parts:
+            text = text.lstrip()
+        if not text or text == self._shown:
+            return
+        if self._message is None:
+            self._message = await self._call(self.send, self.target, text)
+            self.stats.messages += 1
+        else:
+            await self._call(self.edit, self._message, text)
+            self.stats.edits += 1
+        self._shown = text
+        self._last_edit = time.perf_counter()
+        if self.stats.time_to_first_visible is None:
+            self.stats.time_to_first_visible = self._last_edit - self._start
+        # بعد از ویرایش موفق، فاصله به آرامی به مقدار پایه برمی‌گردد
+        self.interval = max(self.base_interval, self.interval * 0.9)
+
+    async def _roll_over(self):
+        """پیام فعلی در سقف طول بسته می‌شود و ادامه در پیام جدید"""
+        while len(self._text) > self.max_length:
+            head, tail = split_text(self._text, self.max_length)
+            await self._show(head)
+            self._parts.append(head)
+            self._message = None
+            self._shown = ""
+            self._text = tail
+
+    # ---------- رابط اصلی ----------
+    async def feed(self, chunk: str):
+        if not chunk:
+            return
+        self._text += chunk
+        self.stats.chars += len(chunk)
+        if len(self._text) > self.max_length:
+            await self._roll_over()
+
+        now = time.perf_counter()
+        first = self.stats.time_to_first_visible is None
+        due = now - self._last_edit >= self.interval and len(self._text) - len(self._shown) >= self.min_chars
+        if first or due:
+            await self._show(self._text)
+
+    async def finish(self) -> StreamReplyStats:
+        await self._roll_over()
+        await self._show(self._text)
+        self.stats.total_time = time.perf_counter() - self._start
+        metrics.record(self.stats)
+        return self.stats
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts) + self._text
+
+
+async def stream_to_telegram(chunks, target, **kwargs) -> tuple[str, StreamReplyStats]:
+    """
+    مصرف async generator پاسخ (مثل PeakAI.generate_response) و نمایش تدریجی آن در تلگرام
+    بازگشت: (متن کامل، آمار این پاسخ)
+    """
+    writer = TelegramStreamWriter(target, **kwargs)
+    async for chunk in chunks:
+        await writer.feed(chunk)
+    stats = await writer.finish()
+    return writer.text, stats
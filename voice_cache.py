@@ -0,0 +1,203 @@
+# voice_cache.py
+"""
+کش فایل‌های صوتی مشاوره فروش روی تلگرام
+- هر فایل فقط یک بار (یا بعد از تغییر محتوا، با هش SHA-256) آپلود می‌شود
+- مرجع InputDocument ‏(id / access_hash / file_reference) روی دیسک ذخیره و ارسال‌های بعدی با مرجع انجام می‌شود
+- در FILE_REFERENCE_EXPIRED مرجع از پیام اصلی تازه می‌شود (و در صورت شکست، آپلود مجدد)
+- مدت واقعی صدا یک بار از هدر فریم‌های MP3 خوانده می‌شود
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from telethon.errors import FileReferenceExpiredError
+from telethon.tl.types import DocumentAttributeAudio, InputDocument
+
+from storage import atomic_write_json
+
+logger = logging.getLogger("PeakVoiceCache")
+
+VOICE_CACHE_FILE = "voice_cache.json"
+
+# ==================== مدت MP3 ====================
+_BITRATES = {
+    # (نسخه MPEG1؟, لایه) → kbps
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def _parse_frame_header(header: bytes) -> tuple[int, int, int] | None:
+    """(طول فریم، تعداد نمونه، نرخ نمونه‌برداری) یا None اگر هدر معتبر نیست"""
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = 4 - ((header[1] >> 1) & 0x03)
+    bitrate_index = (header[2] >> 4) & 0x0F
+    rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    samples = 1152 if (layer == 2 or mpeg1) else 576
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate
+
+
+def probe_mp3_duration(path: str) -> float:
+    """مدت فایل MP3 (ثانیه) با پیمایش هدر فریم‌ها؛ برای CBR و VBR درست است"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    # رد کردن تگ ID3v2
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        offset = 10 + size
+    total = 0.0
+    while offset + 4 <= len(data):
+        frame = _parse_frame_header(data[offset:offset + 4])
+        if frame is None:
+            # بازیابی هم‌گامی (داده خراب یا تگ ID3v1 در انتها)
+            next_sync = data.find(b"\xff", offset + 1)
+            if next_sync == -1:
+                break
+            offset = next_sync
+            continue
+        length, samples, sample_rate = frame
+        if length <= 0:
+            break
+        total += samples / sample_rate
+        offset += length
+    return total
+
+
+# ==================== کش مرجع فایل ====================
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class VoiceMediaCache:
+    def __init__(self, client, path: str = VOICE_CACHE_FILE):
+        self.client = client
+        self.path = path
+        self._entries: dict[str, dict] = {}
+        # هش فقط وقتی دوباره محاسبه می‌شود که اندازه یا زمان تغییر فایل عوض شده باشد
+        self._fingerprints: dict[str, tuple[int, float, str]] = {}
+        self.stats = {"uploads": 0, "reference_sends": 0, "reference_refreshes": 0}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning("کش فایل‌های صوتی خوانده نشد؛ از نو ساخته می‌شود: %s", e)
+            self._entries = {}
+
+    def _save(self):
+        atomic_write_json(self.path, self._entries)
+
+    def _content_hash(self, file_path: str) -> str:
+        stat = os.stat(file_path)
+        cached = self._fingerprints.get(file_path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            return cached[2]
+        digest = file_sha256(file_path)
+        self._fingerprints[file_path] = (stat.st_size, stat.st_mtime, digest)
+        return digest
+
+    def _entry(self, file_path: str) -> tuple[dict | None, str]:
+        """مدخل معتبر کش (با هش فعلی فایل) و هش فعلی؛ FileNotFoundError اگر فایل نیست"""
+        key = os.path.basename(file_path)
+        digest = self._content_hash(file_path)
+        entry = self._entries.get(key)
+        if entry is None or entry.get("sha256") != digest:
+            return None, digest
+        return entry, digest
+
+    def duration(self, file_path: str) -> int:
+        entry, digest = self._entry(file_path)
+        if entry is not None and entry.get("duration"):
+            return entry["duration"]
+        return max(1, round(probe_mp3_duration(file_path)))
+
+    @staticmethod
+    def _input_document(entry: dict) -> InputDocument:
+        return InputDocument(
+            id=entry["id"],
+            access_hash=entry["access_hash"],
+            file_reference=bytes.fromhex(entry["file_reference"]),
+        )
+
+    def _remember(self, file_path: str, digest: str, duration: int, message):
+        document = message.media.document
+        self._entries[os.path.basename(file_path)] = {
+            "sha256": digest,
+            "duration": duration,
+            "id": document.id,
+            "access_hash": document.access_hash,
+            "file_reference": document.file_reference.hex(),
+            "origin_chat_id": message.chat_id,
+            "origin_message_id": message.id,
+        }
+        self._save()
+
+    async def _refresh_reference(self, entry: dict) -> bool:
+        """گرفتن file_reference تازه از پیامی که فایل اولین بار با آن ارسال شد"""
+        try:
+            message = await self.client.get_messages(entry["origin_chat_id"], ids=entry["origin_message_id"])
+        except Exception as e:
+            logger.warning("پیام مبدأ فایل صوتی در دسترس نیست: %s", e)
+            return False
+        document = getattr(getattr(message, "media", None), "document", None)
+        if document is None or document.id != entry["id"]:
+            return False
+        entry["access_hash"] = document.access_hash
+        entry["file_reference"] = document.file_reference.hex()
+        self._save()
+        self.stats["reference_refreshes"] += 1
+        return True
+
+    async def send_voice(self, chat, file_path: str, reply_to: int | None = None):
+        """
+        ارسال ویس؛ با مرجع ذخیره‌شده در صورت وجود، در غیر این صورت آپلود و ذخیره مرجع
+        FileNotFoundError اگر فایل روی دیسک نباشد
+        """
+        entry, digest = self._entry(file_path)
+        if entry is not None:
+            for attempt in range(2):
+                try:
+                    message = await self.client.send_file(chat, self._input_document(entry), reply_to=reply_to)
+                    self.stats["reference_sends"] += 1
+                    return message
+                except FileReferenceExpiredError:
+                    if attempt or not await self._refresh_reference(entry):
+                        break
+            logger.info("مرجع فایل صوتی منقضی شد؛ آپلود مجدد %s", file_path)
+
+        duration = self.duration(file_path)
+        message = await self.client.send_file(
+            chat,
+            file_path,
+            reply_to=reply_to,
+            attributes=[DocumentAttributeAudio(duration=duration, voice=True)],
+        )
+        self.stats["uploads"] += 1
+        self._remember(file_path, digest, duration, message)
+        return message